@@ -6,18 +6,42 @@ Version: 2.4.0 - Enhanced HDMI Control
 """
 
 import asyncio
+import bisect
+import hashlib
+import heapq
+import io
+import ipaddress
+import itertools
+import math
+import os
+import random
 import re
+import shlex
+import sqlite3
+import struct
 import subprocess
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar, copy_context
 from datetime import datetime
-from typing import Optional, Dict, Any, List
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Callable, Awaitable, Annotated, Mapping, NamedTuple, Tuple
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Query, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, Response
 from pydantic import BaseModel
 import uvicorn
 import json
 
+try:
+    from PIL import Image
+except ImportError:  # Optional: thumbnails are then cached as full-size PNGs
+    Image = None
+
 # ==============================================================================
 # --- 1. CORE CONFIGURATION ---
 # ==============================================================================
@@ -28,377 +52,3690 @@ ADB_PATH = r"C:\Users\LOQ 15\Downloads\platform-tools-latest-windows\platform-to
 # Set the network port for this server to run on
 PORT = 3001
 
+# How shell commands reach the TVs:
+#   "session"    - one long-lived `adb shell` process per TV, commands are sent over its stdin
+#   "wire"       - talk the ADB host protocol directly to the local adb server (no processes at all)
+#   "subprocess" - spawn a new adb process for every command (the old behaviour)
+ADB_TRANSPORT = "session"
+
+# The adb server used by the "wire" transport, and how many sockets may be open to it at once
+ADB_SERVER_HOST = "127.0.0.1"
+ADB_SERVER_PORT = 5037
+ADB_WIRE_MAX_SOCKETS = 16
+
+# Maximum number of ADB operations (processes, sockets or session commands) in flight across all TVs
+ADB_MAX_IN_FLIGHT = 8
+
+# Record/replay of ADB traffic, for reproducing production timing without the TVs.
+# ADB_RECORD_FILE: append every ADB command (shell and host, any transport) with its duration and
+#   result, and every API request, to this JSONL file.
+# ADB_REPLAY_FILE: contact no TV at all; each command is answered from this recording after its
+#   recorded duration times ADB_REPLAY_SPEED (1 = original timing, 0.5 = twice as fast, 0 = instant).
+#   `python bench-adb-api.py --replay <file>` also plays the recorded API requests back.
+# Long-lived streams (focus watchers, screen captures, video pushes) are neither recorded nor replayed.
+ADB_RECORD_FILE: Optional[str] = None
+ADB_REPLAY_FILE: Optional[str] = None
+ADB_REPLAY_SPEED = 1.0
+ADB_REPLAY_MAX_GAP = 10  # Idle stretches of the recording longer than this many seconds are cut short
+
+# ADB work is dispatched by priority class, both in each TV's command queue and for the
+# ADB_MAX_IN_FLIGHT slots: rental timeouts first, then interactive requests, then background
+# polling and fleet checks. Every PRIORITY_AGING_SECONDS spent waiting counts as one class
+# higher, so background work is delayed but never starved.
+PRIORITY_AGING_SECONDS = 5
+
+# Background fleet poller: seconds between polls, and how long each cached field stays valid
+FLEET_POLL_INTERVAL = 10
+FLEET_STATE_TTL = {
+    "online": 30,
+    "hdmi_status": 20,
+    "focused_app": 20,
+}
+
+# SQLite file where pending rental timeouts are kept, so they survive a server restart
+RENTAL_TIMER_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rental-timers.db")
+TIMER_CLAIM_TTL = 60  # Seconds a worker may take to fire a timeout before another worker fires it again
+
+# Seconds before a rental's deadline at which its TV is pre-warmed: the ADB link is checked (and
+# reconnected if needed), the shell session is woken up and the timeout video is looked up, so
+# the timeout itself starts on a hot path. 0 turns pre-warming off.
+RENTAL_PREWARM_SECONDS = 30
+
+# Number of uvicorn worker processes. With more than one, the state the workers have to agree on
+# (rental timers, per-TV command locks, SSE events, the fleet cache) goes through a shared SQLite
+# database in WAL mode, and one elected worker runs the timers, the fleet poller and the watchers.
+WORKERS = 1
+SHARED_STATE_BACKEND = "sqlite" if WORKERS > 1 else "local"
+SHARED_STATE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shared-state.db")
+LEADER_LEASE_TTL = 10      # Seconds the leader's lease lasts; it is renewed every third of that
+DEVICE_LEASE_TTL = 60      # Upper bound on how long one worker may hold a TV's command lock
+SHARED_SYNC_INTERVAL = 0.2  # Seconds between checks for events and timer changes from other workers
+SHARED_EVENT_RETENTION = 2000  # Events kept in the shared table
+
+# Server-Sent Events: seconds between keep-alive comments, events kept per topic for
+# Last-Event-ID replay, and events buffered per client before the oldest are dropped.
+# A rental's replay buffer is dropped SSE_FINISHED_RENTAL_TTL seconds after it fired or was stopped.
+SSE_HEARTBEAT_INTERVAL = 15
+SSE_REPLAY_BUFFER_SIZE = 100
+SSE_CLIENT_QUEUE_SIZE = 200
+SSE_FINISHED_RENTAL_TTL = 60
+
+# Maximum number of TVs a batch endpoint works on at the same time
+BATCH_MAX_CONCURRENCY = 6
+
+# Asynchronous jobs: slow endpoints called with ?async=true answer at once with a job id and run
+# on a pool of JOB_WORKERS workers. At most JOB_QUEUE_SIZE jobs may wait (more are refused with 503).
+# Finished jobs stay readable at /jobs/{id} for JOB_RESULT_TTL seconds, and at most JOB_TABLE_SIZE are kept.
+JOB_WORKERS = 8
+JOB_QUEUE_SIZE = 500
+JOB_RESULT_TTL = 600
+JOB_TABLE_SIZE = 5000
+
+# Closed-loop HDMI switching: a `sleep N` step in a switch sequence is only an upper bound.
+# While waiting, the focused window is polled (starting every HDMI_POLL_INTERVAL seconds and
+# backing off by HDMI_POLL_BACKOFF) and the sequence moves on as soon as the focus changes.
+HDMI_POLL_INTERVAL = 0.15
+HDMI_POLL_BACKOFF = 1.5
+HDMI_SETTLE_DELAY = 0.2      # Extra pause after a change is seen, so the new window accepts keys
+HDMI_MIN_STEP_DELAY = 0.3    # Learned waits never shrink below this
+HDMI_CONFIRM_TIMEOUT = 4     # Seconds to wait for the final input to show up in hdmi_status_map
+
+# Timeout video playback: the media player package, the end-to-end deadline for one playback,
+# and how long to wait for the player to take focus after a launch command
+VLC_PACKAGE = "org.videolan.vlc"
+PLAYBACK_DEADLINE = 12
+PLAYBACK_CONFIRM_TIMEOUT = 5
+
+# Focus checks read `dumpsys` output as it arrives and stop at the first focus line;
+# at most this many bytes are read if the line never shows up
+DUMPSYS_MAX_BYTES = 64 * 1024
+
+# Reconnecting offline TVs: one `adb connect` at a time per TV, retried in the background with
+# exponential backoff (CONNECT_BACKOFF_BASE seconds, doubling up to CONNECT_BACKOFF_MAX, with
+# jitter). Requests wait at most CONNECT_WAIT seconds for an attempt, then fail fast.
+CONNECT_TIMEOUT = 10
+CONNECT_BACKOFF_BASE = 2
+CONNECT_BACKOFF_MAX = 120
+CONNECT_WAIT = 3
+
+# Live read-only queries (HDMI status, connection tests, /devices): concurrent identical queries
+# share one ADB call, and the answer is reused for this many seconds. Any other command sent to
+# a TV drops that TV's entries. At most QUERY_CACHE_SIZE answers are kept (least recently used go first).
+QUERY_CACHE_TTL = {
+    "hdmi_status": 1.0,
+    "test_connection": 1.0,
+    "online": 1.0,
+    "devices": 2.0,
+}
+QUERY_CACHE_SIZE = 1024
+
+# Optional push-based TV state: one long-lived logcat stream per TV in ALL_TV_IPS reports window
+# focus changes, so input and app changes reach the fleet state and SSE without polling.
+FOCUS_WATCHER_ENABLED = False
+FOCUS_WATCHER_COMMAND = "logcat -b events -v brief -T 1 input_focus:I am_focused_activity:I *:S"
+FOCUS_WATCHER_DEBOUNCE = 0.3   # Seconds to let a burst of focus events settle before reading the focus
+FOCUS_WATCHER_RETRY = 5        # Seconds before a dropped watcher stream is reopened
+
+# Screen captures (/screenshot). A capture is a multi-megabyte transfer, so captures get their own
+# fleet-wide cap instead of taking ADB_MAX_IN_FLIGHT slots from commands. The thumbnail wall keeps
+# downscaled captures (JPEG, longest side THUMBNAIL_SIZE pixels; needs `pip install pillow`)
+# in an LRU of at most THUMBNAIL_CACHE_BYTES. Without Pillow the full PNG is kept instead, and
+# the LRU holds up to THUMBNAIL_CACHE_ENTRIES captures whatever their size, so the wall is not
+# re-captured because a few full-size PNGs filled the byte budget. A thumbnail is fresh for
+# THUMBNAIL_TTL seconds, and a TV is captured for thumbnails at most once per
+# THUMBNAIL_MIN_INTERVAL seconds, however often the wall is refreshed.
+SCREENSHOT_COMMAND = "screencap -p"
+SCREENSHOT_MAX_IN_FLIGHT = 4
+SCREENSHOT_TIMEOUT = 15
+SCREENSHOT_CHUNK_SIZE = 64 * 1024
+THUMBNAIL_SIZE = 320
+THUMBNAIL_QUALITY = 70
+THUMBNAIL_TTL = 15
+THUMBNAIL_MIN_INTERVAL = 10
+THUMBNAIL_CACHE_BYTES = 16 * 1024 * 1024
+THUMBNAIL_CACHE_ENTRIES = 64
+
+# Timeout video sync (/sync-timeout-video). TIMEOUT_VIDEO_SOURCE is the master copy on this PC; every
+# TV gets it at its profile's video_path. A TV is pushed to only when its copy differs: same size and
+# mtime counts as current, same size with another mtime is settled by md5sum. At most
+# VIDEO_SYNC_CONCURRENCY pushes run at once, sharing VIDEO_SYNC_BANDWIDTH bytes per second (0 = no
+# limit). `adb push` cannot be throttled, so outside the "wire" transport only the concurrency cap applies.
+TIMEOUT_VIDEO_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hot.mp4")
+VIDEO_SYNC_CONCURRENCY = 3
+VIDEO_SYNC_BANDWIDTH = 8 * 1024 * 1024
+VIDEO_SYNC_TIMEOUT = 600       # Seconds one push may take
+VIDEO_SYNC_CHECK_TIMEOUT = 60  # Seconds for the on-TV stat/md5sum
+
+# WebSocket remote (/ws/remote/{tv_ip}; uvicorn needs `pip install websockets` to serve it). Presses
+# are sent in arrival order, and presses arriving within REMOTE_BATCH_WINDOW seconds of each other go
+# out as one `input keyevent k1 k2 ...` (at most REMOTE_BATCH_MAX_KEYS). A key that changes the focused
+# window (FOCUS_CHANGING_KEYS) ends its batch, and the next batch waits REMOTE_FOCUS_SETTLE seconds.
+REMOTE_BATCH_WINDOW = 0.008
+REMOTE_BATCH_MAX_KEYS = 16
+REMOTE_FOCUS_SETTLE = 0.3
+REMOTE_QUEUE_SIZE = 64
+REMOTE_KEY_TIMEOUT = 5
+
 # --- 2. TV DEVICE CONFIGURATION ---
-# This is the central place to manage all your TVs.
-# To add a new TV, add its IP address and define its command sequences.
-TV_CONFIGS = {
-    # Configuration for the Xiaomi TV
-    "192.168.1.20": {
-        "model": "xiaomi",
-        "video_path": "/sdcard/Movies/hot.mp4",
-        # Command sequence to switch to the correct HDMI input for rentals
-        "hdmi_switch_commands": [
-            "input keyevent 178",  # Open TV Input source menu
-            "sleep 2",             # Wait for the menu to appear
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 23"    # DPAD_CENTER (Selects the input)
-        ],
-        # List of commands to try for playing the timeout video
-        "play_video_commands": [
-            'am start -n org.videolan.vlc/org.videolan.vlc.gui.video.VideoPlayerActivity -d "file://{video_path}" --activity-clear-top',
-            'am start -a android.intent.action.VIEW -d "file://{video_path}" -t "video/mp4" --activity-clear-top'
-        ]
-    },
-    
-    # NEW: Specific configuration for the exceptional TCL TV
-    "192.168.1.35": {
-        "model": "tcl-special",
-        "video_path": "/sdcard/Movies/hot.mp4",
-        # Custom command sequence: input, down x4, ok
-        "hdmi_switch_commands": [
-            "input keyevent 178",  # Open TV Input source menu
-            "sleep 2",             # Wait for the menu to appear
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 23"    # DPAD_CENTER (Selects the input)
-        ],
-        "play_video_commands": [
-            'am start -a android.intent.action.VIEW -d "file://{video_path}" -t "video/*" org.videolan.vlc'
-        ]
-    },
-
-    # Make 192.168.1.37 behave like 192.168.1.35 (down x4 input sequence)
-    "192.168.1.37": {
-        "model": "tcl-special",
-        "video_path": "/sdcard/Movies/hot.mp4",
-        "hdmi_switch_commands": [
-            "input keyevent 178",  # Open TV Input source menu
-            "sleep 2",             # Wait for the menu to appear
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 23"    # DPAD_CENTER
-        ],
-        "play_video_commands": [
-            'am start -a android.intent.action.VIEW -d "file://{video_path}" -t "video/*" org.videolan.vlc'
-        ]
-    },
-
-    "192.168.1.38": {
-        "model": "tcl-special",
-        "video_path": "/sdcard/Movies/hot.mp4",
-        "hdmi_switch_commands": [
-            "input keyevent 178",  # Open TV Input source menu
-            "sleep 2",             # Wait for the menu to appear
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 20",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 23"    # DPAD_CENTER
-        ],
-        "play_video_commands": [
-            'am start -a android.intent.action.VIEW -d "file://{video_path}" -t "video/*" org.videolan.vlc'
-        ]
-    },
-
-    "192.168.1.39": {
-        "model": "tcl-special",
-        "video_path": "/sdcard/Movies/hot.mp4",
-        "hdmi_switch_commands": [
-            "input keyevent 178",  # Open TV Input source menu
-            "sleep 2",             # Wait for the menu to appear
-            "input keyevent 22",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 22",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 23"    # DPAD_CENTER
-        ],
-        "play_video_commands": [
-            'am start -a android.intent.action.VIEW -d "file://{video_path}" -t "video/*" org.videolan.vlc'
-        ]
-    },
-
-    "192.168.1.33": {
-        "model": "tcl-special",
-        "video_path": "/sdcard/Movies/hot.mp4",
-        "hdmi_switch_commands": [
-            "input keyevent 178",  # Open TV Input source menu
-            "sleep 2",             # Wait for the menu to appear
-            "input keyevent 22",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 22",   # DPAD_DOWN
-            "sleep 1",
-            "input keyevent 23"    # DPAD_CENTER
-        ],
-        "play_video_commands": [
-            'am start -a android.intent.action.VIEW -d "file://{video_path}" -t "video/*" org.videolan.vlc'
-        ]
-    },
+# TVs and their command sequences live in tv-profiles.json, next to this file:
+#   "profiles":        named profiles; "extends": "<name>" inherits every key the profile does not set
+#   "tvs":             TV IP -> profile name, or an object with "extends" plus per-TV overrides
+#   "default_profile": used for TVs that are not listed
+# The file is validated and compiled when it is loaded. Changes are picked up without a restart,
+# either by POST /reload-config or by checking the file every TV_PROFILES_WATCH_INTERVAL seconds
+# (0 turns the check off); a file that does not validate is reported and the old profiles stay.
+TV_PROFILES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tv-profiles.json")
+TV_PROFILES_WATCH_INTERVAL = 5
+
+# Every TV in the profile file, in file order. Filled (and refreshed on reload) by install_tv_registry.
+ALL_TV_IPS: List[str] = []
+
+# ==============================================================================
+# --- APPLICATION SETUP ---
+# ==============================================================================
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Starts and stops the long-lived background resources of the server."""
+    adb_traffic.open()
+    if Image is None:
+        print(f"⚠️ Pillow is not installed: thumbnails are full-size PNGs, cached for up to {THUMBNAIL_CACHE_ENTRIES} TVs (pip install pillow)")
+    shared_state.start(event_broker)
+    rental_timers.open()
+    job_runner.start()
+    leadership = asyncio.create_task(lead_background_work())
+    # Every worker keeps its own copy of the TV profiles, so every worker watches the file
+    profile_watcher = asyncio.create_task(watch_tv_profiles()) if TV_PROFILES_WATCH_INTERVAL > 0 else None
+    yield
+    for task in (leadership, profile_watcher):
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    await job_runner.stop()
+    await connection_supervisor.stop()
+    await rental_timers.stop()
+    await stop_all_device_actors()
+    await close_all_shell_sessions()
+    await shared_state.stop()
+    adb_traffic.close()
+
+app = FastAPI(
+    title="ADB Control Server",
+    description="A scalable FastAPI server for controlling Android TVs via ADB.",
+    version="2.4.0", # // Version updated
+    lifespan=lifespan
+)
+
+# Allow Cross-Origin Resource Sharing (CORS) for communication with the Laravel frontend
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"], # Allows all origins
+    allow_credentials=True,
+    allow_methods=["*"], # Allows all methods (GET, POST, etc.)
+    allow_headers=["*"], # Allows all headers
+)
+
+# ==============================================================================
+# --- Pydantic Models (for API Request and Response validation) ---
+# ==============================================================================
+
+class TVRequest(BaseModel):
+    tv_ip: str
+
+class PlayVideoRequest(TVRequest):
+    rental_id: int
+
+class RentalTimeoutRequest(TVRequest):
+    rental_id: int
+    timeout_seconds: int = 30
+
+class TVControlRequest(TVRequest):
+    action: str  # e.g., 'volume_up', 'volume_down', 'power_off'
     
-    # This is a default template for all your TCL TVs
-    "DEFAULT_TCL": {
-        "model": "tcl",
-        "video_path": "/sdcard/Movies/hot.mp4",
-        # Command sequence for TCL TVs
-        "hdmi_switch_commands": [
-            "input keyevent 178",  # Open TV Input source menu
-            "sleep 2",
-            "input keyevent 22",   # DPAD_RIGHT
-            "sleep 1",
-            "input keyevent 22",   # DPAD_RIGHT
-            "sleep 1",
-            "input keyevent 22",   # DPAD_RIGHT
-            "sleep 1",
-            "input keyevent 23"    # DPAD_CENTER (Selects the input)
-        ],
-        # // NEW: Direct command sequences for each HDMI input.
-        # This is exactly what you specified: Open Menu, Navigate, Select.
-        "hdmi_switch_sequences": {
-            "hdmi1": [
-                "input keyevent 178",  # Open TV Input source menu
-                "sleep 2",
-                "input keyevent 21",   # DPAD_LEFT
-                "sleep 1",
-                "input keyevent 23"    # DPAD_CENTER (Select)
-            ],
-            "hdmi2": [
-                "input keyevent 178",  # Open TV Input source menu
-                "sleep 2",
-                "input keyevent 22",   # DPAD_RIGHT
-                "sleep 1",
-                "input keyevent 23"    # DPAD_CENTER (Select)
-            ]
-        },
-        # // NEW: This is still needed for the status check feature.
-        "hdmi_status_map": {
-            "com.tcl.tvinput/tcl.hdmi.HDMIInputService/HW15": "hdmi1",
-            "com.tcl.tvinput/tcl.hdmi.HDMIInputService/HW16": "hdmi2"
-        },
-        # Command for playing video on TCL TVs
-        "play_video_commands": [
-            'am start -a android.intent.action.VIEW -d "file://{video_path}" -t "video/*" org.videolan.vlc'
-        ]
+class SendKeyRequest(TVRequest):
+    keycode: int
+
+class ExtendRentalRequest(BaseModel):
+    rental_id: int
+    extra_seconds: int
+
+class BaseResponse(BaseModel):
+    success: bool
+    message: Optional[str] = None
+    error: Optional[str] = None
+
+class DevicesResponse(BaseResponse):
+    devices: Optional[str] = None
+
+# // NEW: A request model for the new functions
+class SetHDMIRequest(TVRequest):
+    target_input: str  # This will be 'hdmi1' or 'hdmi2'
+
+# // NEW: A response model for the status checking function
+class HDMIStatusResponse(BaseResponse):
+    hdmi_status: Optional[str] = None
+
+class PlaybackResponse(BaseResponse):
+    fast_path: Optional[bool] = None
+    stages: Optional[Dict[str, int]] = None  # Milliseconds spent in each playback stage
+    video: Optional[str] = None  # The TV's timeout video as of the last sync check (current, stale, missing, ...)
+
+class VideoSyncRequest(BaseModel):
+    tv_ips: Optional[List[str]] = None  # Default: every TV in ALL_TV_IPS
+    force: bool = False                 # Push even to TVs whose copy already matches
+
+# Batch requests: one entry per TV, processed concurrently.
+# With stream=true the per-TV results are sent as NDJSON lines as soon as each TV finishes.
+class BatchOptions(BaseModel):
+    concurrency: Optional[int] = None  # Capped at BATCH_MAX_CONCURRENCY
+    stream: bool = False
+
+class BatchSetHDMIRequest(BatchOptions):
+    items: List[SetHDMIRequest]
+
+class BatchTVControlRequest(BatchOptions):
+    items: List[TVControlRequest]
+
+class BatchRentalMonitorRequest(BatchOptions):
+    items: List[RentalTimeoutRequest]
+
+class BatchPlayVideoRequest(BatchOptions):
+    items: List[PlayVideoRequest]
+
+# ==============================================================================
+# --- METRICS (Prometheus text exposition format) ---
+# ==============================================================================
+
+class Metric:
+    """Base class for a labelled metric. Label values are stored as tuples to keep the hot path cheap."""
+
+    metric_type = "untyped"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values: Dict[tuple, Any] = {}
+
+    def _label_string(self, label_values: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{value}"' for name, value in zip(self.label_names, label_values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{self._label_string(label_values)} {value}")
+        return lines
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    """A gauge that is either set directly, or computed at scrape time by a collect callback."""
+
+    metric_type = "gauge"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), collect: Optional[Callable[[], Dict[tuple, float]]] = None):
+        super().__init__(name, help_text, label_names)
+        self.collect = collect
+
+    def set(self, value: float, *label_values):
+        self.values[label_values] = value
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def render(self) -> List[str]:
+        if self.collect is not None:
+            self.values = self.collect()
+        return super().render()
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = ()):
+        super().__init__(name, help_text, label_names)
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * len(self.buckets), 0, 0.0]  # bucket counts, count, sum
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            entry[0][index] += 1
+        entry[1] += 1
+        entry[2] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        for label_values, (bucket_counts, count, total) in self.values.items():
+            cumulative = 0
+            labels = self._label_string(label_values)
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                bucket_labels = self._label_string(label_values, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            inf_labels = self._label_string(label_values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{inf_labels} {count}")
+            lines.append(f"{self.name}_count{labels} {count}")
+            lines.append(f"{self.name}_sum{labels} {round(total, 6)}")
+        return lines
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+metrics_registry: List[Metric] = []
+
+def register_metric(metric: Metric) -> Any:
+    metrics_registry.append(metric)
+    return metric
+
+adb_command_seconds = register_metric(Histogram(
+    "adb_command_duration_seconds", "Latency of single ADB commands.", ("tv", "operation"), LATENCY_BUCKETS))
+adb_command_failures = register_metric(Counter(
+    "adb_command_failures_total", "ADB commands that failed, by reason (timeout or error).", ("tv", "operation", "reason")))
+adb_commands_in_flight = register_metric(Gauge(
+    "adb_commands_in_flight", "ADB commands (processes, sockets or session commands) currently running."))
+adb_session_restarts = register_metric(Counter(
+    "adb_session_restarts_total", "Persistent ADB shell sessions that had to be restarted.", ("tv",)))
+adb_reconnects = register_metric(Counter(
+    "adb_reconnects_total", "adb connect attempts made for TVs that did not answer, by result.", ("tv", "result")))
+command_sequence_seconds = register_metric(Histogram(
+    "command_sequence_duration_seconds", "Latency of whole command sequences (HDMI switches).", ("tv", "kind"), LATENCY_BUCKETS))
+playback_stage_seconds = register_metric(Histogram(
+    "playback_stage_duration_seconds", "Latency of each timeout video playback stage.", ("tv", "stage"), LATENCY_BUCKETS))
+rental_timeout_drift_seconds = register_metric(Histogram(
+    "rental_timeout_drift_seconds", "Actual fire time minus scheduled deadline of rental timeouts.", (),
+    (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 60, 300)))
+rental_playback_drift_seconds = register_metric(Histogram(
+    "rental_playback_drift_seconds", "Time from a rental's deadline until its timeout video was confirmed on screen.", (),
+    (0.25, 0.5, 1, 2, 3, 5, 8, 12, 20, 60, 300)))
+rental_prewarms = register_metric(Counter(
+    "rental_prewarms_total", "TVs pre-warmed ahead of a rental deadline, by result.", ("result",)))
+
+def record_adb_command(tv: str, operation: str, started: float, result: Dict[str, Any]):
+    adb_command_seconds.observe(time.perf_counter() - started, tv, operation)
+    if not result.get("success"):
+        reason = "timeout" if "timed out" in (result.get("error") or "") else "error"
+        adb_command_failures.inc(tv, operation, reason)
+
+def command_operation(command: str) -> str:
+    """A low-cardinality label for a shell or adb command, e.g. "input", "dumpsys" or "script"."""
+    if command.startswith("sh -c "):
+        return "script"
+    return command.split(None, 1)[0] if command.strip() else "empty"
+
+# ==============================================================================
+# --- ADB RECORD / REPLAY ---
+# ==============================================================================
+
+class AdbTrafficLog:
+    """
+    Records ADB calls to a JSONL file, or answers them from one. Each line is one call:
+    {"ts": wall time, "tv": ip or "host", "kind": shell/until/host, "cmd": ..., "ms": duration, "result": {...}}
+    or one API request: {"ts", "kind": "api", "method", "path", "body", "status", "ms"}.
+
+    Replay runs on the recording's clock (idle gaps cut to ADB_REPLAY_MAX_GAP, scaled by the speed):
+    a call gets the answer last recorded for the same TV and command before that moment, so a TV
+    answers as it did at that point of the night however often it is asked. Failing that, the same
+    command on another TV is used, then the same operation (e.g. any `dumpsys`) on the same TV.
+    At speed 0 there is no clock, and each key's answers are given in recorded order instead.
+    """
+
+    MATCH_LEVELS = ("exact", "command", "operation")
+
+    def __init__(self, record_path: Optional[str], replay_path: Optional[str], speed: float, max_gap: float):
+        self.record_path = record_path
+        self.replay_path = replay_path
+        self.speed = speed
+        self.max_gap = max_gap
+        self.record_file = None
+        self.replies: Optional[Dict[tuple, list]] = None  # key -> [recorded offsets, entries, next index]
+        self.api_requests: List[tuple] = []                # (recorded offset, entry), for bench-adb-api.py
+        self.clock_started = 0.0
+
+    def open(self):
+        if self.replay_path:
+            self.load(self.replay_path)
+            print(f"📼 Replaying ADB traffic from {self.replay_path} at {self.speed}x timing")
+        elif self.record_path:
+            self.record_file = open(self.record_path, "a", encoding="utf-8", buffering=1)
+            print(f"📼 Recording ADB traffic to {self.record_path}")
+
+    def load(self, path: str):
+        with open(path, encoding="utf-8") as recording:
+            entries = sorted((json.loads(line) for line in recording if line.strip()), key=lambda entry: entry["ts"])
+        self.replies, self.api_requests = {}, []
+        offset, previous = 0.0, None
+        for entry in entries:
+            if previous is not None:
+                offset += min(entry["ts"] - previous, self.max_gap)
+            previous = entry["ts"]
+            if entry["kind"] == "api":
+                self.api_requests.append((offset, entry))
+                continue
+            for key in self._keys(entry["tv"], entry["kind"], entry["cmd"]):
+                answers = self.replies.setdefault(key, [[], [], 0])
+                answers[0].append(offset)
+                answers[1].append(entry)
+        self.restart_clock()
+
+    def restart_clock(self):
+        """Starts replaying from the beginning of the recording."""
+        self.clock_started = time.perf_counter()
+
+    def close(self):
+        if self.record_file is not None:
+            self.record_file.close()
+            self.record_file = None
+
+    @staticmethod
+    def _keys(tv: str, kind: str, command: str) -> tuple:
+        return (("exact", tv, kind, command), ("command", kind, command), ("operation", tv, kind, command_operation(command)))
+
+    def write(self, entry: Dict[str, Any]):
+        self.record_file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    async def call(self, tv: str, kind: str, command: str, run: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """Runs one ADB call, recording it; in replay mode, answers it from the recording instead."""
+        if self.replies is not None:
+            return await self._replay(tv, kind, command)
+        if self.record_file is None:
+            return await run()
+        ts, started = time.time(), time.perf_counter()
+        result = await run()
+        self.write({"ts": round(ts, 3), "tv": tv, "kind": kind, "cmd": command,
+                    "ms": round((time.perf_counter() - started) * 1000, 1), "result": result})
+        return result
+
+    async def _replay(self, tv: str, kind: str, command: str) -> Dict[str, Any]:
+        for level, key in zip(self.MATCH_LEVELS, self._keys(tv, kind, command)):
+            answers = self.replies.get(key)
+            if answers is None:
+                continue
+            offsets, entries, next_index = answers
+            if self.speed > 0:
+                now = (time.perf_counter() - self.clock_started) / self.speed
+                index = max(0, bisect.bisect_right(offsets, now) - 1)
+            else:
+                index = min(next_index, len(entries) - 1)
+                answers[2] = next_index + 1
+            entry = entries[index]
+            adb_replay_lookups.inc(level)
+            await asyncio.sleep(entry["ms"] / 1000 * self.speed)
+            return dict(entry["result"])
+        adb_replay_lookups.inc("miss")
+        return {"success": False, "error": f"No recorded response for `{command}` on {tv}"}
+
+adb_traffic = AdbTrafficLog(ADB_RECORD_FILE, ADB_REPLAY_FILE, ADB_REPLAY_SPEED, ADB_REPLAY_MAX_GAP)
+
+adb_replay_lookups = register_metric(Counter(
+    "adb_replay_lookups_total", "Replayed ADB calls, by how closely a recorded answer matched (exact, command, operation, miss).", ("match",)))
+
+class ApiRecordingMiddleware:
+    """ASGI middleware that appends every API request to the ADB recording, for bench-adb-api.py --replay."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or adb_traffic.record_file is None:
+            return await self.app(scope, receive, send)
+        ts, started = time.time(), time.perf_counter()
+        body, status = bytearray(), None
+
+        async def recording_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                body.extend(message.get("body", b""))
+            return message
+
+        async def recording_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, recording_receive, recording_send)
+        finally:
+            query = scope.get("query_string", b"").decode("latin-1")
+            if adb_traffic.record_file is not None:
+                adb_traffic.write({
+                    "ts": round(ts, 3), "kind": "api", "method": scope["method"],
+                    "path": scope["path"] + (f"?{query}" if query else ""),
+                    "body": body.decode("utf-8", errors="ignore") or None,
+                    "status": status, "ms": round((time.perf_counter() - started) * 1000, 1),
+                })
+
+app.add_middleware(ApiRecordingMiddleware)
+
+# ==============================================================================
+# --- CORE ADB & HELPER FUNCTIONS ---
+# ==============================================================================
+
+def get_tv_config(tv_ip: str) -> "TVProfile":
+    """Returns the compiled profile of a TV (one dict lookup), falling back to the default profile if it is not listed."""
+    profile = tv_registry.tvs.get(tv_ip)
+    if profile is None:
+        print(f"⚠️ Warning: No specific config for {tv_ip}. Using the {tv_registry.default.name} profile.")
+        return tv_registry.default
+    return profile
+
+# ==============================================================================
+# --- COMMAND SEQUENCE PLANS ---
+# ==============================================================================
+
+# Keys that open or replace a window; the wait after them is a checkpoint where the
+# closed-loop HDMI runner watches for the focus change on the host side.
+FOCUS_CHANGING_KEYS = {"3", "178", "KEYCODE_HOME", "KEYCODE_TV_INPUT"}
+
+class PlanStep:
+    """One parsed step of a command sequence: a shell command or a `sleep N`."""
+
+    def __init__(self, index: int, command: str, sleep: Optional[float] = None, changes_focus: bool = False):
+        self.index = index
+        self.command = command
+        self.sleep = sleep
+        self.changes_focus = changes_focus
+
+class CommandPlan:
+    """
+    A command sequence from a TV profile, parsed and validated once.
+    Steps are grouped into blocks: "script" blocks run on the TV in a single round-trip, and
+    "wait" blocks are the sleeps right after a focus-changing key, which the closed-loop HDMI
+    runner performs on the host while watching the screen.
+    """
+
+    def __init__(self, commands: List[str]):
+        self.commands = tuple(commands)
+        self.steps = [self._parse(index, command) for index, command in enumerate(commands)]
+        self.blocks: List[tuple] = []  # ("script", [PlanStep, ...]) or ("wait", PlanStep)
+        current: List[PlanStep] = []
+        for step in self.steps:
+            previous = self.steps[step.index - 1] if step.index > 0 else None
+            if step.sleep is not None and previous is not None and previous.changes_focus:
+                if current:
+                    self.blocks.append(("script", current))
+                    current = []
+                self.blocks.append(("wait", step))
+            else:
+                current.append(step)
+        if current:
+            self.blocks.append(("script", current))
+
+    @staticmethod
+    def _parse(index: int, command: str) -> PlanStep:
+        if not isinstance(command, str) or not command.strip():
+            raise ValueError(f"step {index} is empty")
+        try:
+            args = shlex.split(command)
+        except ValueError as e:
+            raise ValueError(f"step {index} ({command!r}) cannot be parsed: {e}")
+        if args[0] == "sleep":
+            try:
+                seconds = float(args[1]) if len(args) == 2 else -1
+            except ValueError:
+                seconds = -1
+            if seconds < 0:
+                raise ValueError(f"step {index} ({command!r}) must be 'sleep <seconds>'")
+            return PlanStep(index, command, sleep=seconds)
+        if args[:2] == ["input", "keyevent"]:
+            keys = args[2:]
+            if not keys or not all(key.isdigit() or key.startswith("KEYCODE_") for key in keys):
+                raise ValueError(f"step {index} ({command!r}) needs numeric or KEYCODE_* key codes")
+            return PlanStep(index, command, changes_focus=keys[-1] in FOCUS_CHANGING_KEYS)
+        return PlanStep(index, command, changes_focus=args[:2] == ["am", "start"])
+
+    @property
+    def total_sleep(self) -> float:
+        return sum(step.sleep for step in self.steps if step.sleep is not None)
+
+def render_plan_script(steps: List[PlanStep], sleep_overrides: Optional[Dict[int, float]] = None) -> str:
+    """
+    Turns plan steps into one `sh -c` script that stops at the first failing step and
+    reports the exit code of every command it ran as `__STEP_<index>__ <code>`.
+    """
+    lines = []
+    for step in steps:
+        if step.sleep is not None:
+            seconds = (sleep_overrides or {}).get(step.index, step.sleep)
+            lines.append(f"sleep {seconds:g}")
+        else:
+            lines.append(f'{step.command}; r=$?; echo "__STEP_{step.index}__ $r"; [ $r -eq 0 ] || exit $r')
+    return f"sh -c {shlex.quote(chr(10).join(lines))}"
+
+STEP_MARKER_PATTERN = re.compile(r"^__STEP_(\d+)__ (\d+)$", re.M)
+
+async def run_plan_script(tv_ip: str, steps: List[PlanStep], sleep_overrides: Optional[Dict[int, float]] = None) -> Dict[str, Any]:
+    """Runs a block of plan steps on the TV in a single round-trip."""
+    commands = [step for step in steps if step.sleep is None]
+    if len(steps) == 1 and commands:
+        return await execute_shell_command(tv_ip, commands[0].command)
+
+    total_sleep = sum((sleep_overrides or {}).get(step.index, step.sleep) for step in steps if step.sleep is not None)
+    result = await execute_shell_command(tv_ip, render_plan_script(steps, sleep_overrides), timeout=int(10 + total_sleep))
+    output = result.get("output", "") or result.get("error", "")
+    result["step_exit_codes"] = {int(index): int(code) for index, code in STEP_MARKER_PATTERN.findall(output)}
+    cleaned = STEP_MARKER_PATTERN.sub("", output).strip()
+    if result["success"]:
+        result["output"] = cleaned
+    else:
+        failed = [step for step in steps if result["step_exit_codes"].get(step.index, 0) != 0]
+        step_info = f"step {failed[0].index} ({failed[0].command}) " if failed else ""
+        result["error"] = f"{step_info}failed: {cleaned or result.get('error')}"
+    return result
+
+@lru_cache(maxsize=None)
+def compile_sequence(commands: tuple) -> CommandPlan:
+    return CommandPlan(list(commands))
+
+def get_command_plan(commands: List[str]) -> CommandPlan:
+    """Returns the compiled plan for a command sequence (compiled once and cached)."""
+    return compile_sequence(tuple(commands))
+
+@lru_cache(maxsize=None)
+def compile_status_matcher(status_items: tuple) -> Optional[re.Pattern]:
+    """One regex for a whole hdmi_status_map, matching any of its components and capturing which one."""
+    if not status_items:
+        return None
+    components = sorted((component for component, _ in status_items), key=len, reverse=True)
+    return re.compile("(" + "|".join(re.escape(component) for component in components) + r")(?![\w./])")
+
+def match_hdmi_status(status_map: Dict[str, str], focused_component: str) -> str:
+    """Maps a focused component to its HDMI input name (or "Unknown") with the cached matcher for the map."""
+    matcher = compile_status_matcher(tuple(status_map.items()))
+    match = matcher.search(focused_component) if matcher else None
+    return status_map[match.group(1)] if match else "Unknown"
+
+# ==============================================================================
+# --- TV PROFILES ---
+# ==============================================================================
+
+PROFILE_KEYS = {"extends", "description", "model", "video_path", "hdmi_switch_commands",
+                "hdmi_switch_sequences", "hdmi_status_map", "play_video_commands"}
+REQUIRED_PROFILE_KEYS = ("video_path", "hdmi_switch_commands", "play_video_commands")
+
+class TVProfile(NamedTuple):
+    """A TV's configuration with inheritance applied, validated and compiled. Never changed after loading."""
+    name: str
+    model: str
+    video_path: str
+    hdmi_switch_plan: CommandPlan                  # The rental start sequence (/switch-to-hdmi2)
+    hdmi_switch_sequences: Mapping[str, CommandPlan]  # Target input -> sequence (/set-hdmi-input)
+    hdmi_status_map: Mapping[str, str]             # Focused component -> input name
+    play_video_commands: Tuple[str, ...]           # With {video_path} filled in
+
+class TVRegistry(NamedTuple):
+    """One loaded profile file. Reloading builds a new registry and swaps it in as a whole."""
+    profiles: Mapping[str, TVProfile]
+    tvs: Mapping[str, TVProfile]  # TV IP -> profile, in file order
+    default: TVProfile
+    source: str
+    mtime_ns: int
+    loaded_at: float
+
+def read_tv_profiles(path: str) -> Dict[str, Any]:
+    """Reads a profile file. A key given twice (such as a TV listed twice) is an error, not silently merged."""
+    def reject_duplicates(pairs: List[tuple]) -> Dict[str, Any]:
+        keys = [key for key, _ in pairs]
+        duplicates = sorted({key for key in keys if keys.count(key) > 1})
+        if duplicates:
+            raise ValueError(f"{path}: listed more than once: {', '.join(duplicates)}")
+        return dict(pairs)
+
+    with open(path, encoding="utf-8") as f:
+        return json.load(f, object_pairs_hook=reject_duplicates)
+
+def resolve_profile(name: str, raw_profiles: Dict[str, Any], chain: tuple = ()) -> Dict[str, Any]:
+    """Merges a profile over the one it extends. A key set in the child replaces the parent's value as a whole."""
+    if name in chain:
+        raise ValueError(f"circular extends: {' -> '.join(chain + (name,))}")
+    raw = raw_profiles.get(name)
+    if not isinstance(raw, dict):
+        raise ValueError(f"unknown profile {name!r}" if raw is None else "must be an object")
+    parent = raw.get("extends")
+    merged = resolve_profile(parent, raw_profiles, chain + (name,)) if parent is not None else {}
+    merged.update((key, value) for key, value in raw.items() if key != "extends")
+    return merged
+
+def compile_profile(name: str, config: Dict[str, Any], problems: List[str]) -> Optional[TVProfile]:
+    """Validates a resolved profile and compiles its sequences. Problems are added to the list."""
+    found = len(problems)
+    unknown = sorted(set(config) - PROFILE_KEYS)
+    if unknown:
+        problems.append(f"{name}: unknown keys {', '.join(unknown)}")
+    missing = [key for key in REQUIRED_PROFILE_KEYS if key not in config]
+    if missing:
+        problems.append(f"{name}: missing {', '.join(missing)}")
+        return None
+    for key, kind, description in (("video_path", str, "a string"), ("hdmi_switch_sequences", dict, "an object"),
+                                   ("hdmi_status_map", dict, "an object"), ("play_video_commands", list, "a list")):
+        if not isinstance(config.get(key, kind()), kind):
+            problems.append(f"{name} {key}: must be {description}")
+    if len(problems) > found:
+        return None
+
+    sequences = {"hdmi_switch_commands": config["hdmi_switch_commands"]}
+    for target, commands in config.get("hdmi_switch_sequences", {}).items():
+        sequences[f"hdmi_switch_sequences.{target}"] = commands
+    plans = {}
+    for label, commands in sequences.items():
+        try:
+            if not isinstance(commands, list):
+                raise ValueError("must be a list of commands")
+            plans[label] = get_command_plan(commands)
+        except ValueError as e:
+            problems.append(f"{name} {label}: {e}")
+
+    status_map = config.get("hdmi_status_map", {})
+    try:
+        compile_status_matcher(tuple(status_map.items()))
+    except re.error as e:
+        problems.append(f"{name} hdmi_status_map: {e}")
+
+    play_commands = []
+    for index, template in enumerate(config["play_video_commands"]):
+        try:
+            command = template.format(video_path=config["video_path"])
+            shlex.split(command)
+            play_commands.append(command)
+        except (AttributeError, KeyError, IndexError, ValueError) as e:
+            problems.append(f"{name} play_video_commands[{index}]: {e!r}")
+
+    if len(problems) > found:
+        return None
+    return TVProfile(
+        name=name,
+        model=config.get("model", name),
+        video_path=config["video_path"],
+        hdmi_switch_plan=plans["hdmi_switch_commands"],
+        hdmi_switch_sequences=MappingProxyType({
+            target: plans[f"hdmi_switch_sequences.{target}"] for target in config.get("hdmi_switch_sequences", {})}),
+        hdmi_status_map=MappingProxyType(dict(status_map)),
+        play_video_commands=tuple(play_commands),
+    )
+
+def build_tv_registry(data: Dict[str, Any], source: str, mtime_ns: int = 0) -> TVRegistry:
+    """Resolves, validates and compiles a whole profile file. Raises ValueError listing every problem found."""
+    problems: List[str] = []
+    raw_profiles = data.get("profiles")
+    raw_tvs = data.get("tvs")
+    if not isinstance(raw_profiles, dict) or not isinstance(raw_tvs, dict):
+        raise ValueError(f"{source}: needs a \"profiles\" object and a \"tvs\" object")
+
+    profiles: Dict[str, TVProfile] = {}
+    for name in raw_profiles:
+        try:
+            profile = compile_profile(name, resolve_profile(name, raw_profiles), problems)
+        except ValueError as e:
+            problems.append(f"{name}: {e}")
+            continue
+        if profile is not None:
+            profiles[name] = profile
+
+    tvs: Dict[str, TVProfile] = {}
+    for tv_ip, entry in raw_tvs.items():
+        try:
+            ipaddress.ip_address(tv_ip)
+        except ValueError:
+            problems.append(f"tvs: {tv_ip!r} is not an IP address")
+            continue
+        if isinstance(entry, str):
+            if entry in profiles:
+                tvs[tv_ip] = profiles[entry]
+            elif entry not in raw_profiles:
+                problems.append(f"{tv_ip}: unknown profile {entry!r}")
+            continue
+        # A TV with its own overrides becomes a profile of its own, named after the TV
+        try:
+            profile = compile_profile(tv_ip, resolve_profile(tv_ip, {**raw_profiles, tv_ip: entry}), problems)
+        except ValueError as e:
+            problems.append(f"{tv_ip}: {e}")
+            continue
+        if profile is not None:
+            tvs[tv_ip] = profile
+
+    default_name = data.get("default_profile", "DEFAULT_TCL")
+    if default_name not in raw_profiles:
+        problems.append(f"default_profile: unknown profile {default_name!r}")
+    if problems:
+        raise ValueError(f"Invalid TV profiles in {source}:\n  " + "\n  ".join(problems))
+    return TVRegistry(MappingProxyType(profiles), MappingProxyType(tvs), profiles[default_name],
+                      source, mtime_ns, time.time())
+
+def load_tv_registry(path: str) -> TVRegistry:
+    mtime_ns = os.stat(path).st_mtime_ns
+    return build_tv_registry(read_tv_profiles(path), path, mtime_ns)
+
+def install_tv_registry(registry: TVRegistry):
+    """Makes a registry the current one. A single assignment, so no request ever sees half of a reload."""
+    global tv_registry
+    tv_registry = registry
+    ALL_TV_IPS[:] = registry.tvs
+
+async def reload_tv_profiles() -> Dict[str, Any]:
+    """
+    Loads the profile file again and swaps the new registry in. Pending rental timeouts, queued
+    commands and shell sessions are keyed by TV IP, so they carry on and use the new profile from
+    their next step. A file that does not load or validate leaves the current profiles in place.
+    """
+    previous = tv_registry
+    try:
+        registry = load_tv_registry(previous.source)
+    except (OSError, ValueError) as e:
+        print(f"❌ TV profiles not reloaded, keeping the current ones: {e}")
+        return {"success": False, "error": str(e)}
+    install_tv_registry(registry)
+
+    added = [tv_ip for tv_ip in registry.tvs if tv_ip not in previous.tvs]
+    removed = [tv_ip for tv_ip in previous.tvs if tv_ip not in registry.tvs]
+    changed = [tv_ip for tv_ip in registry.tvs if tv_ip in previous.tvs and registry.tvs[tv_ip] != previous.tvs[tv_ip]]
+    for tv_ip in removed + changed:
+        query_cache.invalidate(tv_ip)
+    if FOCUS_WATCHER_ENABLED and focus_watchers:  # This worker runs the watchers: follow the new TV list
+        await asyncio.gather(*(focus_watchers.pop(tv_ip).stop() for tv_ip in removed if tv_ip in focus_watchers))
+        if added:
+            start_focus_watchers(added)
+    print(f"📝 Reloaded {len(registry.tvs)} TV(s) from {registry.source}: "
+          f"{len(added)} added, {len(removed)} removed, {len(changed)} changed")
+    return {
+        "success": True,
+        "message": f"Loaded {len(registry.tvs)} TVs and {len(registry.profiles)} profiles.",
+        "added": added,
+        "removed": removed,
+        "changed": changed
     }
-}
-ALL_TV_IPS = [
-    "192.168.1.99", # <-- This is the new Test TV IP
-    "192.168.1.20", "192.168.1.37", "192.168.1.40", "192.168.1.31", "192.168.1.39", "192.168.1.33",
-    "192.168.1.34", "192.168.1.35", "192.168.1.36", "192.168.1.37", "192.168.1.38"
-]
-# --- 3. LIST OF TCL TV IPs ---
-# Add all your TCL TV IP addresses here. They will automatically use the "DEFAULT_TCL" configuration.
-TCL_TV_IPS = [
-    "192.168.1.99", # <-- This is the new Test TV IP
-    "192.168.1.37", "192.168.1.40", "192.168.1.31", "192.168.1.39", "192.168.1.33", 
-    "192.168.1.34", "192.168.1.35", "192.168.1.36", "192.168.1.37", "192.168.1.38"
-]
-
-# Automatically apply the default TCL config to all TCL IPs
-for ip in TCL_TV_IPS:
-    if ip not in TV_CONFIGS:
-        TV_CONFIGS[ip] = TV_CONFIGS["DEFAULT_TCL"]
+
+async def watch_tv_profiles():
+    """Background task: reloads the profiles whenever the file's modification time changes."""
+    seen = tv_registry.mtime_ns
+    while True:
+        await asyncio.sleep(TV_PROFILES_WATCH_INTERVAL)
+        try:
+            mtime_ns = os.stat(tv_registry.source).st_mtime_ns
+        except OSError:
+            continue
+        if mtime_ns != seen:
+            seen = mtime_ns
+            print(f"📝 {tv_registry.source} changed on disk")
+            await reload_tv_profiles()
+
+tv_registry: TVRegistry
+install_tv_registry(load_tv_registry(TV_PROFILES_FILE))
+
+# ==============================================================================
+# --- ADB COMMAND EXECUTION ---
+# ==============================================================================
+
+async def collect_process_output(process: asyncio.subprocess.Process, timeout: int) -> Dict[str, Any]:
+    """Waits for an ADB process to finish and converts its output into a result dict."""
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        return {"success": False, "error": f"Command timed out after {timeout} seconds"}
+
+    stdout_str = stdout.decode('utf-8', errors='ignore').strip()
+    stderr_str = stderr.decode('utf-8', errors='ignore').strip()
+
+    if process.returncode == 0:
+        return {"success": True, "output": stdout_str}
+    else:
+        error_message = stderr_str or f"Process failed with code {process.returncode}"
+        return {"success": False, "error": error_message, "output": stdout_str}
+
+async def stream_process_until(process: asyncio.subprocess.Process, stop_at: re.Pattern, max_bytes: int, timeout: int) -> Dict[str, Any]:
+    """
+    Reads an ADB process's stdout line by line and kills the process as soon as a line matches
+    stop_at (or max_bytes have been read), instead of buffering its whole output.
+    """
+    read_bytes = 0
+
+    async def read_lines() -> Dict[str, Any]:
+        nonlocal read_bytes
+        while read_bytes < max_bytes:
+            raw_line = await process.stdout.readline()
+            if not raw_line:
+                return None
+            read_bytes += len(raw_line)
+            line = raw_line.decode('utf-8', errors='ignore').strip()
+            if stop_at.search(line):
+                return {"success": True, "output": line, "stopped_early": True}
+        return {"success": False, "error": f"No match in the first {max_bytes} bytes of output", "truncated": True}
+
+    try:
+        result = await asyncio.wait_for(read_lines(), timeout=timeout)
+    except asyncio.TimeoutError:
+        result = {"success": False, "error": f"Command timed out after {timeout} seconds"}
+    if result is not None:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()  # Reap it, so no zombie is left for the transport to clean up later
+        return result
+    # The command finished without printing a matching line
+    stderr = await process.stderr.read()
+    await process.wait()
+    if process.returncode == 0:
+        return {"success": True, "output": ""}
+    error = stderr.decode('utf-8', errors='ignore').strip()
+    return {"success": False, "error": error or f"Process failed with code {process.returncode}", "output": ""}
+
+async def execute_adb_command(command: str, timeout: int = 10) -> Dict[str, Any]:
+    """Executes a full ADB command string asynchronously and returns the result."""
+    full_command = f'"{ADB_PATH}" {command}'
+    print(f"Executing: {full_command}")
+    
+    async def run_process() -> Dict[str, Any]:
+        try:
+            process = await asyncio.create_subprocess_shell(
+                full_command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            return await collect_process_output(process, timeout)
+        except Exception as e:
+            return {"success": False, "error": str(e)}
+
+    async with adb_in_flight:
+        adb_commands_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            result = await adb_traffic.call("host", "host", command, run_process)
+        finally:
+            adb_commands_in_flight.dec()
+        record_adb_command("host", command_operation(command), started, result)
+        return result
+
+# Priority classes for ADB work, lowest value first
+PRIORITY_RENTAL_CRITICAL = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = {PRIORITY_RENTAL_CRITICAL: "rental_critical", PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background"}
+
+# The class of the ADB work done by the current task; requests are interactive unless they say otherwise
+current_priority: ContextVar[int] = ContextVar("current_priority", default=PRIORITY_INTERACTIVE)
+
+@contextmanager
+def adb_priority(priority: int):
+    """Runs the ADB work inside the block (and in tasks started from it) at the given priority class."""
+    token = current_priority.set(priority)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+def priority_key(priority: int, enqueued_at: float) -> float:
+    """Queue order with aging: arrival time, pushed back PRIORITY_AGING_SECONDS per class."""
+    return enqueued_at + priority * PRIORITY_AGING_SECONDS
+
+class PriorityGate:
+    """
+    A semaphore that hands freed slots to the waiter with the lowest priority_key instead of the
+    longest waiting one. Used as `async with adb_in_flight:`; the class comes from current_priority.
+    A TV's job waiting here is promoted when more urgent work queues behind it on the same TV,
+    so a rental timeout is never stuck behind background work holding the TV's queue.
+    """
+
+    def __init__(self, slots: int, name: str = "adb"):
+        self.name = name
+        self.free = slots
+        self.waiters: List[tuple] = []  # heap of (key, sequence, future)
+        self.sequence = itertools.count()
+
+    async def __aenter__(self):
+        priority = current_priority.get()
+        started = time.monotonic()
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+        else:
+            actor = current_device_actor.get()
+            future = asyncio.get_running_loop().create_future()
+            self.promote(future, started, priority if actor is None else min(priority, actor.urgency))
+            if actor is not None:
+                actor.slot_request = (future, started)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self._release()  # The slot was handed over just as we were cancelled
+                raise
+            finally:
+                if actor is not None:
+                    actor.slot_request = None
+        priority_queue_wait_seconds.observe(time.monotonic() - started, self.name, PRIORITY_NAMES[priority])
+
+    def promote(self, future: asyncio.Future, started: float, priority: int):
+        """Queues a waiter (again) at a priority class; only its earliest entry counts."""
+        heapq.heappush(self.waiters, (priority_key(priority, started), next(self.sequence), future))
+
+    async def __aexit__(self, *exc_info):
+        self._release()
+
+    def _release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.free += 1
+
+    def waiting(self) -> int:
+        return len({id(future) for _, _, future in self.waiters if not future.done()})
+
+priority_queue_wait_seconds = register_metric(Histogram(
+    "priority_queue_wait_seconds", "Time ADB work waited for its TV's queue or a fleet-wide slot, by priority class.",
+    ("queue", "priority"), LATENCY_BUCKETS))
+
+# Fleet-wide cap on ADB work, so a fleet check cannot flood the host with adb processes
+adb_in_flight = PriorityGate(ADB_MAX_IN_FLIGHT)
+
+register_metric(Gauge(
+    "adb_slots_waiting", "ADB operations waiting for one of the ADB_MAX_IN_FLIGHT slots.",
+    collect=lambda: {(): adb_in_flight.waiting()}))
+
+class AdbShellSession:
+    """
+    A long-lived `adb -s <ip>:5555 shell` process for one TV.
+    Commands are written to its stdin, and every command is followed by a sentinel
+    line carrying its exit status, so the output of each command can be split out.
+    A dead process is restarted automatically on the next command.
+    """
+
+    def __init__(self, tv_ip: str):
+        self.tv_ip = tv_ip
+        self.serial = f"{tv_ip}:5555"
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.lock = asyncio.Lock()
+        self.restarts = 0
+        self._counter = itertools.count()
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def _start(self):
+        if self.process is not None:
+            self.restarts += 1
+            print(f"🔁 Restarting ADB shell session for {self.tv_ip} (restart #{self.restarts})")
+            adb_session_restarts.inc(self.tv_ip)
+        self.process = await asyncio.create_subprocess_exec(
+            ADB_PATH, "-s", self.serial, "shell",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT
+        )
+
+    async def _discard(self):
+        if self.alive:
+            self.process.kill()
+            await self.process.wait()
+
+    async def run(self, command: str, timeout: int = 10) -> Dict[str, Any]:
+        """Runs one shell command in the session and returns its result."""
+        async with self.lock:
+            try:
+                if not self.alive:
+                    await self._start()
+                marker = f"__ADB_DONE_{next(self._counter)}__"
+                # stdin is detached so commands like `am` cannot swallow the next command. The sentinel
+                # starts on a line of its own even if the output has no trailing newline (the extra
+                # blank line is stripped with the rest of the surrounding whitespace).
+                script = f'{{ {command}\n}} </dev/null 2>&1; printf \'\\n%s %s\\n\' {marker} $?\n'
+                self.process.stdin.write(script.encode('utf-8'))
+                await self.process.stdin.drain()
+                return await asyncio.wait_for(self._read_until(marker), timeout=timeout)
+            except asyncio.TimeoutError:
+                # The session is in an unknown state now, so throw it away.
+                await self._discard()
+                return {"success": False, "error": f"Command timed out after {timeout} seconds"}
+            except Exception as e:
+                await self._discard()
+                return {"success": False, "error": str(e)}
+
+    async def _read_until(self, marker: str) -> Dict[str, Any]:
+        lines = []
+        while True:
+            raw_line = await self.process.stdout.readline()
+            if not raw_line:
+                # adb exited (device offline, connection dropped, ...); its message is in the output.
+                await self.process.wait()
+                output = "\n".join(lines).strip()
+                return {"success": False, "error": output or f"ADB shell exited with code {self.process.returncode}", "output": output}
+            line = raw_line.decode('utf-8', errors='ignore').rstrip("\r\n")
+            if line.startswith(marker):
+                exit_code = int(line[len(marker):].strip() or 1)
+                output = "\n".join(lines).strip()
+                if exit_code == 0:
+                    return {"success": True, "output": output}
+                return {"success": False, "error": output or f"Command failed with code {exit_code}", "output": output}
+            lines.append(line)
+
+    async def close(self):
+        if self.alive:
+            self.process.stdin.close()
+            await self._discard()
+
+# One persistent shell session per TV, created on first use.
+shell_sessions: Dict[str, AdbShellSession] = {}
+
+def get_shell_session(tv_ip: str) -> AdbShellSession:
+    session = shell_sessions.get(tv_ip)
+    if session is None:
+        session = shell_sessions[tv_ip] = AdbShellSession(tv_ip)
+    return session
+
+async def close_all_shell_sessions():
+    await asyncio.gather(*(session.close() for session in shell_sessions.values()), return_exceptions=True)
+    shell_sessions.clear()
+
+class AdbWireError(Exception):
+    """Raised when the adb server answers a request with FAIL or an unexpected reply."""
+
+class AdbWireClient:
+    """
+    A pure-asyncio client for the ADB host protocol, talking to the adb server over TCP.
+    Every request is a 4-hex-digit length followed by the service name, answered by OKAY or FAIL.
+    The adb server dedicates a socket to a single service, so sockets are not reused between
+    commands; instead the number of sockets open at once is capped.
+    """
+
+    # Packet ids of the shell v2 protocol
+    SHELL_STDOUT = 1
+    SHELL_STDERR = 2
+    SHELL_EXIT = 3
+
+    def __init__(self, host: str, port: int, max_sockets: int):
+        self.host = host
+        self.port = port
+        self.sockets = asyncio.Semaphore(max_sockets)
+
+    @staticmethod
+    async def _send(writer: asyncio.StreamWriter, service: str):
+        payload = service.encode('utf-8')
+        writer.write(b"%04x" % len(payload) + payload)
+        await writer.drain()
+
+    @staticmethod
+    async def _read_string(reader: asyncio.StreamReader) -> str:
+        length = int(await reader.readexactly(4), 16)
+        return (await reader.readexactly(length)).decode('utf-8', errors='ignore')
+
+    async def _read_status(self, reader: asyncio.StreamReader):
+        status = await reader.readexactly(4)
+        if status == b"OKAY":
+            return
+        if status == b"FAIL":
+            raise AdbWireError(await self._read_string(reader))
+        raise AdbWireError(f"Unexpected reply from adb server: {status!r}")
+
+    async def _request(self, writer, reader, service: str):
+        await self._send(writer, service)
+        await self._read_status(reader)
+
+    async def host_query(self, service: str) -> str:
+        """Runs a host service such as `host:devices` or `host:connect:<ip>:5555` and returns its reply."""
+        async with self.sockets:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                await self._request(writer, reader, service)
+                return await self._read_string(reader)
+            finally:
+                writer.close()
+
+    @staticmethod
+    async def _read_packet(reader: asyncio.StreamReader) -> tuple:
+        """Reads one shell v2 packet and returns (packet id, data)."""
+        try:
+            packet_id, length = struct.unpack("<BI", await reader.readexactly(5))
+            return packet_id, await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise AdbWireError("Shell stream closed before the command exited")
+
+    async def shell(self, serial: str, command: str) -> Dict[str, Any]:
+        """Runs a command through the shell v2 protocol, which reports stdout, stderr and the exit code separately."""
+        async with self.sockets:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                await self._request(writer, reader, f"host:transport:{serial}")
+                await self._request(writer, reader, f"shell,v2,raw:{command}")
+                stdout, stderr, exit_code = bytearray(), bytearray(), None
+                while exit_code is None:
+                    packet_id, data = await self._read_packet(reader)
+                    if packet_id == self.SHELL_STDOUT:
+                        stdout += data
+                    elif packet_id == self.SHELL_STDERR:
+                        stderr += data
+                    elif packet_id == self.SHELL_EXIT:
+                        exit_code = data[0] if data else 0
+            finally:
+                writer.close()
+
+        stdout_str = stdout.decode('utf-8', errors='ignore').strip()
+        stderr_str = stderr.decode('utf-8', errors='ignore').strip()
+        if exit_code == 0:
+            return {"success": True, "output": stdout_str}
+        return {"success": False, "error": stderr_str or f"Command failed with code {exit_code}", "output": stdout_str}
+
+    async def shell_until(self, serial: str, command: str, stop_at: re.Pattern, max_bytes: int) -> Dict[str, Any]:
+        """
+        Runs a command and scans its stdout line by line as packets arrive. The socket is closed
+        (which stops the command on the TV) at the first line matching stop_at, or after max_bytes.
+        """
+        async with self.sockets:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                await self._request(writer, reader, f"host:transport:{serial}")
+                await self._request(writer, reader, f"shell,v2,raw:{command}")
+                pending, stderr, read_bytes = b"", bytearray(), 0
+                while True:
+                    packet_id, data = await self._read_packet(reader)
+                    if packet_id == self.SHELL_EXIT:
+                        exit_code = data[0] if data else 0
+                        break
+                    if packet_id == self.SHELL_STDERR:
+                        stderr += data
+                        continue
+                    read_bytes += len(data)
+                    *lines, pending = (pending + data).split(b"\n")
+                    for raw_line in lines:
+                        line = raw_line.decode('utf-8', errors='ignore').strip()
+                        if stop_at.search(line):
+                            return {"success": True, "output": line, "stopped_early": True}
+                    if read_bytes >= max_bytes:
+                        return {"success": False, "error": f"No match in the first {max_bytes} bytes of output", "truncated": True}
+            finally:
+                writer.close()
+
+        line = pending.decode('utf-8', errors='ignore').strip()
+        if stop_at.search(line):
+            return {"success": True, "output": line}
+        if exit_code == 0:
+            return {"success": True, "output": ""}
+        return {"success": False, "error": stderr.decode('utf-8', errors='ignore').strip() or f"Command failed with code {exit_code}", "output": ""}
+
+    async def stream_lines(self, serial: str, command: str):
+        """
+        Yields the stdout lines of a long-running command such as logcat. The socket stays open
+        for as long as the caller iterates, so it is not counted against the socket cap.
+        """
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            await self._request(writer, reader, f"host:transport:{serial}")
+            await self._request(writer, reader, f"shell,v2,raw:{command}")
+            pending = b""
+            while True:
+                packet_id, data = await self._read_packet(reader)
+                if packet_id == self.SHELL_EXIT:
+                    return
+                if packet_id == self.SHELL_STDOUT:
+                    *lines, pending = (pending + data).split(b"\n")
+                    for line in lines:
+                        yield line.decode('utf-8', errors='ignore').strip()
+        finally:
+            writer.close()
+
+    async def exec_out(self, serial: str, command: str, deadline: float, chunk_size: int):
+        """
+        Yields the raw stdout of a command run through the `exec:` service (binary-safe, no pty)
+        in chunks as they arrive, until the command ends or the monotonic deadline passes.
+        """
+        async with self.sockets:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                await self._request(writer, reader, f"host:transport:{serial}")
+                await self._request(writer, reader, f"exec:{command}")
+                while True:
+                    chunk = await asyncio.wait_for(reader.read(chunk_size), deadline - time.monotonic())
+                    if not chunk:
+                        return
+                    yield chunk
+            finally:
+                writer.close()
+
+    # Largest DATA packet of the sync protocol
+    SYNC_DATA_MAX = 64 * 1024
+
+    async def push(self, serial: str, remote_path: str, mode: int, mtime: int, chunks):
+        """
+        Writes a file on the device with the sync protocol: SEND "<path>,<mode>", one DATA packet
+        per chunk (at most SYNC_DATA_MAX bytes, from an async iterator), then DONE with the mtime.
+        """
+        async with self.sockets:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                await self._request(writer, reader, f"host:transport:{serial}")
+                await self._request(writer, reader, "sync:")
+                spec = f"{remote_path},{mode}".encode('utf-8')
+                writer.write(b"SEND" + struct.pack("<I", len(spec)) + spec)
+                async for chunk in chunks:
+                    writer.write(b"DATA" + struct.pack("<I", len(chunk)) + chunk)
+                    await writer.drain()
+                writer.write(b"DONE" + struct.pack("<I", mtime))
+                await writer.drain()
+                try:
+                    status, length = struct.unpack("<4sI", await reader.readexactly(8))
+                    message = (await reader.readexactly(length)).decode('utf-8', errors='ignore') if status == b"FAIL" else ""
+                except asyncio.IncompleteReadError:
+                    raise AdbWireError("Sync stream closed before the push was acknowledged")
+                if status != b"OKAY":
+                    raise AdbWireError(message or f"Unexpected sync reply: {status!r}")
+            finally:
+                writer.close()
+
+adb_wire_client = AdbWireClient(ADB_SERVER_HOST, ADB_SERVER_PORT, ADB_WIRE_MAX_SOCKETS)
+
+# Plain adb host commands that the "wire" transport can answer without spawning adb
+WIRE_HOST_SERVICES = {
+    "devices": "host:devices",
+    "version": "host:version",
+}
+
+async def execute_host_command(command: str, timeout: int = 10) -> Dict[str, Any]:
+    """Runs an adb host command (devices, version, connect <ip>:5555) using the configured ADB transport."""
+    if ADB_TRANSPORT != "wire":
+        return await execute_adb_command(command, timeout)
+
+    if command.startswith("connect "):
+        service = f"host:connect:{command.split(' ', 1)[1]}"
+    else:
+        service = WIRE_HOST_SERVICES.get(command)
+    if service is None:
+        return await execute_adb_command(command, timeout)
+
+    async def query() -> Dict[str, Any]:
+        try:
+            output = await asyncio.wait_for(adb_wire_client.host_query(service), timeout=timeout)
+        except asyncio.TimeoutError:
+            return {"success": False, "error": f"Command timed out after {timeout} seconds"}
+        except (AdbWireError, OSError) as e:
+            return {"success": False, "error": str(e)}
+        if service == "host:version":
+            output = f"Android Debug Bridge version 1.0.{int(output, 16)}"
+        return {"success": True, "output": output.strip()}
+
+    print(f"Executing over adb wire protocol: {service}")
+    async with adb_in_flight:
+        adb_commands_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            # Recorded under the adb command, so a recording replays the same on every transport
+            result = await adb_traffic.call("host", "host", command, query)
+        finally:
+            adb_commands_in_flight.dec()
+        record_adb_command("host", command_operation(command), started, result)
+        return result
+
+async def run_shell_on_transport(tv_ip: str, command: str, timeout: int = 10, stop_at: Optional[re.Pattern] = None) -> Dict[str, Any]:
+    """
+    Runs a shell command on a TV using the configured ADB transport, within the fleet-wide cap.
+    With stop_at, the output is streamed and only the first matching line is returned.
+    """
+    print(f"Executing on {tv_ip}: {command}")
+    async with adb_in_flight:
+        adb_commands_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            if stop_at is None:
+                result = await adb_traffic.call(tv_ip, "shell", command, lambda: dispatch_shell_command(tv_ip, command, timeout))
+            else:
+                result = await adb_traffic.call(tv_ip, "until", command, lambda: dispatch_shell_until(tv_ip, command, stop_at, timeout))
+        finally:
+            adb_commands_in_flight.dec()
+        record_adb_command(tv_ip, command_operation(command), started, result)
+        return result
+
+async def dispatch_shell_command(tv_ip: str, command: str, timeout: int) -> Dict[str, Any]:
+    if ADB_TRANSPORT == "session":
+        return await get_shell_session(tv_ip).run(command, timeout)
+    if ADB_TRANSPORT == "wire":
+        try:
+            return await asyncio.wait_for(adb_wire_client.shell(f"{tv_ip}:5555", command), timeout=timeout)
+        except asyncio.TimeoutError:
+            return {"success": False, "error": f"Command timed out after {timeout} seconds"}
+        except (AdbWireError, OSError) as e:
+            return {"success": False, "error": str(e)}
+
+    try:
+        # Passing the command as a single argument avoids host-shell quoting problems.
+        process = await asyncio.create_subprocess_exec(
+            ADB_PATH, "-s", f"{tv_ip}:5555", "shell", command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        return await collect_process_output(process, timeout)
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+async def dispatch_shell_until(tv_ip: str, command: str, stop_at: re.Pattern, timeout: int) -> Dict[str, Any]:
+    if ADB_TRANSPORT == "session":
+        # The session has to read up to its marker to stay in sync, so the command itself must
+        # end early (e.g. `grep -m 1`); the first matching line is picked from its output.
+        result = await get_shell_session(tv_ip).run(command, timeout)
+        if result["success"]:
+            lines = [line.strip() for line in result.get("output", "").splitlines()]
+            result["output"] = next((line for line in lines if stop_at.search(line)), "")
+        return result
+    if ADB_TRANSPORT == "wire":
+        try:
+            return await asyncio.wait_for(
+                adb_wire_client.shell_until(f"{tv_ip}:5555", command, stop_at, DUMPSYS_MAX_BYTES), timeout=timeout)
+        except asyncio.TimeoutError:
+            return {"success": False, "error": f"Command timed out after {timeout} seconds"}
+        except (AdbWireError, OSError) as e:
+            return {"success": False, "error": str(e)}
+
+    try:
+        process = await asyncio.create_subprocess_exec(
+            ADB_PATH, "-s", f"{tv_ip}:5555", "shell", command,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        return await stream_process_until(process, stop_at, DUMPSYS_MAX_BYTES, timeout)
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+async def stream_shell_lines(tv_ip: str, command: str):
+    """Yields the output lines of a long-running shell command on a TV (outside the per-TV queue and the fleet-wide cap)."""
+    if ADB_TRANSPORT == "wire":
+        async for line in adb_wire_client.stream_lines(f"{tv_ip}:5555", command):
+            yield line
+        return
+
+    # The session transport runs one command at a time, so a stream gets its own adb process.
+    process = await asyncio.create_subprocess_exec(
+        ADB_PATH, "-s", f"{tv_ip}:5555", "shell", command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        while True:
+            raw_line = await process.stdout.readline()
+            if not raw_line:
+                return
+            yield raw_line.decode('utf-8', errors='ignore').strip()
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+# The actor whose worker is running the current task, so nested submissions run inline
+current_device_actor: ContextVar[Optional["DeviceActor"]] = ContextVar("current_device_actor", default=None)
+
+class DeviceActor:
+    """
+    A single-consumer command queue for one TV.
+    Jobs (a single command or a whole command sequence) run one at a time, so two requests can
+    never interleave their key events on the same TV. Waiting jobs are taken by priority class
+    (with aging, see priority_key), and in submission order within a class.
+    """
+
+    def __init__(self, tv_ip: str):
+        self.tv_ip = tv_ip
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.sequence = itertools.count()
+        self.worker: Optional[asyncio.Task] = None
+        self.queued_by_priority = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.urgency = PRIORITY_BACKGROUND  # Most urgent class among the running job and the queued ones
+        self.slot_request: Optional[tuple] = None  # (future, started) while the running job waits for an ADB slot
+
+    async def submit(self, job: Callable[[], Awaitable[Any]], priority: Optional[int] = None) -> Any:
+        """Queues a job at the given priority class (default: the caller's) and waits for its result."""
+        if priority is None:
+            priority = current_priority.get()
+        if current_device_actor.get() is self:
+            # Already running on this TV's actor (e.g. a command inside a sequence).
+            with adb_priority(min(priority, current_priority.get())):
+                return await job()
+        future = asyncio.get_running_loop().create_future()
+        enqueued_at = time.monotonic()
+        if priority < self.urgency:
+            self.urgency = priority
+            if self.slot_request is not None:
+                adb_in_flight.promote(*self.slot_request, priority)
+        self.queued_by_priority[priority] += 1
+        await self.queue.put((priority_key(priority, enqueued_at), next(self.sequence), priority, enqueued_at, job, future))
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+        return await future
+
+    async def _run(self):
+        current_device_actor.set(self)
+        while True:
+            _, _, priority, enqueued_at, job, future = await self.queue.get()
+            if job is None:  # Stop sentinel
+                return
+            self.queued_by_priority[priority] -= 1
+            if future.done():  # The caller gave up before the job started
+                continue
+            priority_queue_wait_seconds.observe(time.monotonic() - enqueued_at, "device", PRIORITY_NAMES[priority])
+            self.urgency = min([priority] + [queued for queued, count in self.queued_by_priority.items() if count])
+            try:
+                with adb_priority(priority):
+                    async with shared_state.device_lock(self.tv_ip):
+                        result = await job()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    async def stop(self):
+        if self.worker is not None:
+            # The sentinel stops the worker even if the cancellation is swallowed by a finishing command.
+            self.queue.put_nowait((float("-inf"), -1, PRIORITY_RENTAL_CRITICAL, 0.0, None, None))
+            self.worker.cancel()
+            await asyncio.gather(self.worker, return_exceptions=True)
+
+device_actors: Dict[str, DeviceActor] = {}
+
+device_queue_depth = register_metric(Gauge(
+    "device_queue_depth", "Jobs waiting in each TV's command queue.", ("tv",),
+    collect=lambda: {(tv_ip,): actor.queue.qsize() for tv_ip, actor in device_actors.items()}))
+
+def get_device_actor(tv_ip: str) -> DeviceActor:
+    actor = device_actors.get(tv_ip)
+    if actor is None:
+        actor = device_actors[tv_ip] = DeviceActor(tv_ip)
+    return actor
+
+async def stop_all_device_actors():
+    await asyncio.gather(*(actor.stop() for actor in device_actors.values()), return_exceptions=True)
+    device_actors.clear()
+
+async def execute_shell_command(tv_ip: str, command: str, timeout: int = 10) -> Dict[str, Any]:
+    """Runs a shell command on a TV through that TV's command queue."""
+    if command_operation(command) not in READ_ONLY_OPERATIONS:
+        query_cache.invalidate(tv_ip)
+    return await get_device_actor(tv_ip).submit(lambda: run_shell_on_transport(tv_ip, command, timeout))
+
+async def execute_shell_until(tv_ip: str, command: str, stop_at: re.Pattern, timeout: int = 10) -> Dict[str, Any]:
+    """Like execute_shell_command, but returns only the first output line matching stop_at and stops reading there."""
+    return await get_device_actor(tv_ip).submit(lambda: run_shell_on_transport(tv_ip, command, timeout, stop_at))
+
+# Matches the component inside `mCurrentFocus=Window{1a2b3c u0 com.package/.Activity}`
+FOCUS_COMPONENT_PATTERN = re.compile(r'\{[^{}]+\s([^\s/]+/[^}\s]+)\}')
+FOCUS_LINE_PATTERN = re.compile(r'mCurrentFocus|mFocusedActivity')
+# `grep -m 1` makes the TV stop dumpsys after the first focus line as well
+FOCUS_DUMPSYS_COMMAND = "dumpsys window windows | grep -m 1 mCurrentFocus"
+
+async def read_focused_component(tv_ip: str) -> Dict[str, Any]:
+    """Returns the component of the window that currently has focus on the TV (None on the home screen)."""
+    result = await execute_shell_until(tv_ip, FOCUS_DUMPSYS_COMMAND, FOCUS_LINE_PATTERN)
+    if not result["success"]:
+        return {"success": False, "error": result.get("error")}
+    match = FOCUS_COMPONENT_PATTERN.search(result.get("output", ""))
+    return {"success": True, "focused_app": match.group(1) if match else None}
+
+# // NEW: This is the internal logic for the /get-hdmi-status endpoint
+async def get_hdmi_status_internal(tv_ip: str) -> Dict[str, Any]:
+    status_map = get_tv_config(tv_ip).hdmi_status_map
+
+    focus = await read_focused_component(tv_ip)
+    if not focus["success"]:
+        return {"success": False, "error": focus.get("error")}
+
+    return record_focus(tv_ip, focus["focused_app"], status_map)
+
+def record_focus(tv_ip: str, focused_component: Optional[str], status_map: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Stores a TV's focused window and HDMI status in the fleet state and publishes app_changed /
+    input_changed events when they differ from what was known before. If the TV leaves its HDMI
+    input while a rental is running on it, an input_left event goes to that rental's stream.
+    """
+    if focused_component:
+        status = match_hdmi_status(status_map, focused_component)
+    else:
+        status = "home_or_other"
+    result = {"success": True, "hdmi_status": status, "focused_app": focused_component}
+
+    state = get_device_state(tv_ip)
+    previous_app, previous_status = state.peek("focused_app"), state.peek("hdmi_status")
+    known = previous_status is not None
+    state.set("hdmi_status", status)
+    state.set("focused_app", focused_component)
+
+    if known and focused_component != previous_app:
+        query_cache.invalidate(tv_ip)
+        event_broker.publish(EventBroker.FLEET_TOPIC, "app_changed", {
+            "type": "app_changed", "tv_ip": tv_ip, "focused_app": focused_component, "previous": previous_app})
+    if known and status != previous_status:
+        event_broker.publish(EventBroker.FLEET_TOPIC, "input_changed", {
+            "type": "input_changed", "tv_ip": tv_ip, "hdmi_status": status, "previous": previous_status})
+        if previous_status in status_map.values() and status not in status_map.values():
+            for rental_id in rental_timers.rentals_on(tv_ip):
+                print(f"⚠️ TV {tv_ip} left {previous_status} during rental {rental_id} (now: {status})")
+                publish_rental_event(rental_id, "input_left", {
+                    "tv_ip": tv_ip, "hdmi_status": status, "previous": previous_status, "focused_app": focused_component})
+    return result
+
+# ==============================================================================
+# --- CONNECTION SUPERVISOR ---
+# ==============================================================================
+
+class TVLink:
+    """The ADB link state of one TV, as owned by the connection supervisor."""
+
+    def __init__(self, tv_ip: str):
+        self.tv_ip = tv_ip
+        self.online: Optional[bool] = None
+        self.failures = 0                          # Consecutive failed connect attempts
+        self.next_attempt = 0.0                    # Monotonic time of the next background attempt
+        self.attempt: Optional[asyncio.Task] = None  # The connect in progress, shared by all callers
+        self.retry: Optional[asyncio.Task] = None    # The scheduled background attempt
+        self.last_error: Optional[str] = None
+
+    def retry_in(self) -> int:
+        return max(0, math.ceil(self.next_attempt - time.monotonic()))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "online": self.online,
+            "connecting": self.attempt is not None and not self.attempt.done(),
+            "failures": self.failures,
+            "retry_in": self.retry_in() if self.online is False else None,
+            "last_error": self.last_error,
+        }
+
+class ConnectionSupervisor:
+    """
+    Owns the link state of every TV and is the only place that runs `adb connect`.
+    Concurrent reconnect requests for a TV share a single attempt. A TV that stays offline is
+    retried in the background with exponential backoff and jitter, and callers are told
+    "offline, retrying in Ns" right away instead of each running their own slow connect.
+    """
+
+    def __init__(self):
+        self.links: Dict[str, TVLink] = {}
+
+    def link(self, tv_ip: str) -> TVLink:
+        link = self.links.get(tv_ip)
+        if link is None:
+            link = self.links[tv_ip] = TVLink(tv_ip)
+        return link
+
+    def mark_online(self, tv_ip: str):
+        """Records that the TV answered a command, which ends any backoff."""
+        link = self.link(tv_ip)
+        link.online, link.failures, link.last_error = True, 0, None
+        if link.retry is not None:
+            link.retry.cancel()
+            link.retry = None
+
+    async def reconnect(self, tv_ip: str, force: bool = False) -> Dict[str, Any]:
+        """
+        Gets the TV connected again. Joins the attempt in progress if there is one; while the TV
+        is backing off, fails fast unless force is set. Waits at most CONNECT_WAIT seconds.
+        """
+        link = self.link(tv_ip)
+        if link.attempt is None or link.attempt.done():
+            if link.online is False and not force and link.retry_in() > 0:
+                return {"success": False, "error": f"offline, retrying in {link.retry_in()}s"}
+            link.attempt = asyncio.create_task(self._connect(link))
+        try:
+            return await asyncio.wait_for(asyncio.shield(link.attempt), timeout=CONNECT_WAIT)
+        except asyncio.TimeoutError:
+            return {"success": False, "error": "offline, reconnect in progress"}
+
+    async def _connect(self, link: TVLink) -> Dict[str, Any]:
+        result = await execute_host_command(f"connect {link.tv_ip}:5555", timeout=CONNECT_TIMEOUT)
+        output = result.get("output", "")
+        connected = "connected" in output or "already connected" in output
+        adb_reconnects.inc(link.tv_ip, "success" if connected else "failure")
+        get_device_state(link.tv_ip).set("online", connected)
+        if connected:
+            self.mark_online(link.tv_ip)
+            print(f"🔌 Reconnected to {link.tv_ip}")
+            return {"success": True, "message": "Reconnected"}
+
+        link.online = False
+        link.failures += 1
+        link.last_error = result.get("error") or output or "Connection failed"
+        delay = min(CONNECT_BACKOFF_MAX, CONNECT_BACKOFF_BASE * 2 ** (link.failures - 1)) * random.uniform(0.5, 1.0)
+        link.next_attempt = time.monotonic() + delay
+        if link.retry is None or link.retry.done():
+            link.retry = asyncio.create_task(self._retry_later(link))
+        print(f"🔌 {link.tv_ip} is offline ({link.last_error}); retrying in {delay:.0f}s")
+        return {"success": False, "error": f"offline, retrying in {link.retry_in()}s"}
+
+    async def _retry_later(self, link: TVLink):
+        current_priority.set(PRIORITY_BACKGROUND)
+        while link.online is False:
+            await asyncio.sleep(max(0, link.next_attempt - time.monotonic()))
+            if link.attempt is None or link.attempt.done():
+                link.attempt = asyncio.create_task(self._connect(link))
+            await asyncio.shield(link.attempt)
+
+    async def stop(self):
+        tasks = [task for link in self.links.values() for task in (link.attempt, link.retry) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+connection_supervisor = ConnectionSupervisor()
+
+register_metric(Gauge(
+    "tvs_offline", "TVs the connection supervisor is currently backing off on.",
+    collect=lambda: {(): sum(1 for link in connection_supervisor.links.values() if link.online is False)}))
+
+async def check_tv_online(ip: str) -> Dict[str, Any]:
+    """Checks that a TV answers over ADB, asking the connection supervisor to reconnect it if not, and records the result."""
+    result = await execute_shell_command(ip, "echo online", timeout=5)
+    if result.get("success") and "online" in result.get("output", ""):
+        connection_supervisor.mark_online(ip)
+        status = {"success": True, "message": "Online"}
+    else:
+        connect_result = await connection_supervisor.reconnect(ip)
+        if connect_result["success"]:
+            status = {"success": True, "message": "Reconnected"}
+        else:
+            status = {"success": False, "error": f"Offline ({connect_result['error']})"}
+
+    get_device_state(ip).set("online", status["success"])
+    return status
+
+# ==============================================================================
+# --- FLEET STATE CACHE & BACKGROUND POLLER ---
+# ==============================================================================
+
+class DeviceState:
+    """
+    The last known state of one TV. Every field is stored with the time it was observed,
+    and is only handed out while it is younger than its TTL in FLEET_STATE_TTL.
+    """
+
+    def __init__(self, tv_ip: str):
+        self.tv_ip = tv_ip
+        self.last_seen: Optional[datetime] = None
+        self.watched = False  # True while a focus watcher is streaming this TV's changes
+        self._fields: Dict[str, tuple] = {}  # name -> (value, monotonic timestamp)
+
+    def set(self, name: str, value: Any):
+        self._fields[name] = (value, time.monotonic())
+        if name == "online" and value:
+            self.last_seen = datetime.now()
+        shared_state.save_device_field(self.tv_ip, name, value)
+
+    def load(self, name: str, value: Any, observed_at: float):
+        """Applies a field observed by another worker at wall-clock time observed_at, unless ours is newer."""
+        age = max(0.0, time.time() - observed_at)
+        entry = self._fields.get(name)
+        if entry is not None and time.monotonic() - entry[1] <= age:
+            return
+        self._fields[name] = (value, time.monotonic() - age)
+        if name == "online" and value:
+            self.last_seen = datetime.fromtimestamp(observed_at)
+
+    def is_fresh(self, name: str) -> bool:
+        entry = self._fields.get(name)
+        if entry is not None and self.watched and name in WATCHED_FIELDS:
+            return True  # Pushed by the watcher, so current for as long as it is connected
+        return entry is not None and time.monotonic() - entry[1] < FLEET_STATE_TTL.get(name, 0)
+
+    def peek(self, name: str, default: Any = None) -> Any:
+        """Returns the last observed value of a field, however old it is."""
+        entry = self._fields.get(name)
+        return entry[0] if entry is not None else default
+
+    def get(self, name: str, default: Any = None) -> Any:
+        """Returns the cached value of a field, or the default if it is missing or expired."""
+        return self._fields[name][0] if self.is_fresh(name) else default
+
+    def snapshot(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        snapshot = {"tv_ip": self.tv_ip, "last_seen": self.last_seen.isoformat() if self.last_seen else None, "watched": self.watched}
+        for name, (value, observed_at) in self._fields.items():
+            snapshot[name] = value
+            snapshot[f"{name}_age"] = round(now - observed_at, 1)
+            snapshot[f"{name}_stale"] = not self.is_fresh(name)
+        return snapshot
+
+# Fields that a connected focus watcher keeps current
+WATCHED_FIELDS = {"hdmi_status", "focused_app"}
+
+device_states: Dict[str, DeviceState] = {}
+
+def get_device_state(tv_ip: str) -> DeviceState:
+    shared_state.load_device_states()
+    state = device_states.get(tv_ip)
+    if state is None:
+        state = device_states[tv_ip] = DeviceState(tv_ip)
+    return state
+
+async def poll_tv(ip: str):
+    """Refreshes the cached state of one TV."""
+    status = await query_cache.get("online", ip, lambda: check_tv_online(ip))
+    if status["success"] and not get_device_state(ip).watched:
+        await get_hdmi_status_internal(ip)
+
+async def poll_fleet_forever():
+    """Background task: keeps the cached state of every TV in ALL_TV_IPS up to date."""
+    print(f"📡 Fleet poller started (every {FLEET_POLL_INTERVAL}s)")
+    current_priority.set(PRIORITY_BACKGROUND)
+    while True:
+        started = time.monotonic()
+        try:
+            await asyncio.gather(*(poll_tv(ip) for ip in dict.fromkeys(ALL_TV_IPS)))
+        except Exception as e:
+            print(f"❌ Error while polling the fleet: {e}")
+        await asyncio.sleep(max(0, FLEET_POLL_INTERVAL - (time.monotonic() - started)))
+
+# ==============================================================================
+# --- READ QUERY COALESCING ---
+# ==============================================================================
+
+# Shell commands that do not change what a TV shows, so they leave cached queries in place
+READ_ONLY_OPERATIONS = {"dumpsys", "echo", "logcat", "getprop", "stat", "md5sum"}
+
+class QueryCache:
+    """
+    Single-flight, short-TTL cache for read-only queries, keyed by (query, tv_ip).
+    Callers that arrive while a query is running wait for that same run; its result is then
+    reused until its TTL (QUERY_CACHE_TTL) runs out. Entries are kept in LRU order and indexed
+    per TV, so a write to a TV can drop its entries without scanning the whole cache.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()  # key -> [task, expires_at]
+        self.by_tv: Dict[Optional[str], set] = {}
+
+    async def get(self, query: str, tv_ip: Optional[str], compute: Callable[[], Awaitable[Any]]) -> Any:
+        key = (query, tv_ip)
+        entry = self.entries.get(key)
+        if entry is not None and (not entry[0].done() or entry[1] > time.monotonic()):
+            self.entries.move_to_end(key)
+            query_cache_requests.inc(query, "hit")
+            return await asyncio.shield(entry[0])
+
+        query_cache_requests.inc(query, "miss")
+        entry = [asyncio.create_task(compute()), float("inf")]
+        entry[0].add_done_callback(lambda task: self._settle(key, entry, task))
+        self._store(key, entry)
+        return await asyncio.shield(entry[0])
+
+    def _settle(self, key: tuple, entry: list, task: asyncio.Task):
+        """Starts an entry's TTL when its run finishes; failed runs are not kept."""
+        if task.cancelled() or task.exception() is not None:
+            self._drop(key, entry)
+        else:
+            entry[1] = time.monotonic() + QUERY_CACHE_TTL.get(key[0], 0)
+
+    def _store(self, key: tuple, entry: list):
+        self._drop(key)
+        self.entries[key] = entry
+        self.by_tv.setdefault(key[1], set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, key: tuple, entry: Optional[list] = None):
+        """Removes a key (only if it still holds the given entry, when one is given)."""
+        if key not in self.entries or (entry is not None and self.entries[key] is not entry):
+            return
+        del self.entries[key]
+        keys = self.by_tv.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_tv[key[1]]
+
+    def invalidate(self, tv_ip: str):
+        """Drops every cached query of a TV. Callers already waiting on a running query still get its result."""
+        for key in list(self.by_tv.get(tv_ip, ())):
+            self._drop(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.by_tv.clear()
+
+query_cache = QueryCache(QUERY_CACHE_SIZE)
+
+query_cache_requests = register_metric(Counter(
+    "query_cache_requests_total", "Read-only queries answered from a shared or cached run (hit) or by a new ADB call (miss).", ("query", "result")))
+
+# ==============================================================================
+# --- PUSH-BASED FOCUS WATCHERS ---
+# ==============================================================================
+
+class FocusWatcher:
+    """
+    Follows one TV's window focus through a long-lived logcat stream (FOCUS_WATCHER_COMMAND).
+    Every burst of focus events leads to a single focus read, whose result goes through
+    record_focus into the fleet state and the SSE streams. While the stream is connected the
+    poller skips this TV's HDMI check; when it drops, it is reopened after FOCUS_WATCHER_RETRY
+    seconds and the TV is polled like any other in the meantime.
+    """
+
+    def __init__(self, tv_ip: str):
+        self.tv_ip = tv_ip
+        self.changed = asyncio.Event()
+        self.tasks: List[asyncio.Task] = []
+        self.events_seen = 0
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._follow_stream()), asyncio.create_task(self._refresh_on_change())]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        get_device_state(self.tv_ip).watched = False
+
+    async def _follow_stream(self):
+        state = get_device_state(self.tv_ip)
+        while True:
+            try:
+                async for line in stream_shell_lines(self.tv_ip, FOCUS_WATCHER_COMMAND):
+                    if not state.watched:
+                        print(f"👀 Focus watcher connected to {self.tv_ip}")
+                        state.watched = True
+                        self.changed.set()  # Read the current focus once the stream is up
+                    if line and not line.startswith("---------"):
+                        self.events_seen += 1
+                        self.changed.set()
+            except Exception as e:
+                print(f"👀 Focus watcher for {self.tv_ip} failed: {e}")
+            state.watched = False
+            await asyncio.sleep(FOCUS_WATCHER_RETRY)
+
+    async def _refresh_on_change(self):
+        current_priority.set(PRIORITY_BACKGROUND)
+        while True:
+            await self.changed.wait()
+            await asyncio.sleep(FOCUS_WATCHER_DEBOUNCE)
+            self.changed.clear()
+            focus = await read_focused_component(self.tv_ip)
+            if focus["success"]:
+                record_focus(self.tv_ip, focus["focused_app"], get_tv_config(self.tv_ip).hdmi_status_map)
+
+focus_watchers: Dict[str, FocusWatcher] = {}
+
+register_metric(Gauge(
+    "focus_watchers_connected", "TVs whose focus changes are being streamed.",
+    collect=lambda: {(): sum(1 for tv_ip in focus_watchers if get_device_state(tv_ip).watched)}))
+
+def start_focus_watchers(tv_ips: List[str]):
+    for tv_ip in dict.fromkeys(tv_ips):
+        if tv_ip not in focus_watchers:
+            watcher = focus_watchers[tv_ip] = FocusWatcher(tv_ip)
+            watcher.start()
+    print(f"👀 Focus watchers started for {len(focus_watchers)} TV(s)")
+
+async def stop_all_focus_watchers():
+    await asyncio.gather(*(watcher.stop() for watcher in focus_watchers.values()), return_exceptions=True)
+    focus_watchers.clear()
+
+# ==============================================================================
+# --- SCREEN CAPTURE ---
+# ==============================================================================
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+class ScreenCaptureError(Exception):
+    """Raised when a TV sends no image for a screen capture."""
+
+async def stream_exec_out(tv_ip: str, command: str, timeout: float):
+    """Yields the raw stdout bytes of `adb exec-out <command>` on a TV as they arrive (outside the per-TV queue)."""
+    deadline = time.monotonic() + timeout
+    if ADB_TRANSPORT == "wire":
+        try:
+            async for chunk in adb_wire_client.exec_out(f"{tv_ip}:5555", command, deadline, SCREENSHOT_CHUNK_SIZE):
+                yield chunk
+        except asyncio.TimeoutError:
+            raise ScreenCaptureError(f"Capture timed out after {timeout} seconds")
+        except (AdbWireError, OSError) as e:
+            raise ScreenCaptureError(str(e))
+        return
+
+    # The session transport runs text commands, so binary output gets its own adb process.
+    process = await asyncio.create_subprocess_exec(
+        ADB_PATH, "-s", f"{tv_ip}:5555", "exec-out", command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        while True:
+            chunk = await asyncio.wait_for(process.stdout.read(SCREENSHOT_CHUNK_SIZE), deadline - time.monotonic())
+            if not chunk:
+                break
+            yield chunk
+        stderr = await process.stderr.read()
+        await process.wait()
+        if process.returncode != 0:
+            raise ScreenCaptureError(stderr.decode('utf-8', errors='ignore').strip() or f"adb exited with code {process.returncode}")
+    except asyncio.TimeoutError:
+        raise ScreenCaptureError(f"Capture timed out after {timeout} seconds")
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+async def screen_capture_chunks(tv_ip: str):
+    """
+    Captures a TV's screen as a PNG and yields its bytes as they arrive, holding one of the
+    SCREENSHOT_MAX_IN_FLIGHT capture slots until the stream ends. Raises ScreenCaptureError
+    before the first chunk if the TV does not answer with an image.
+    """
+    async with screen_capture_slots:
+        print(f"📸 Capturing the screen of {tv_ip}")
+        started = time.perf_counter()
+        result = {"success": False, "error": "Capture stopped before it finished"}
+        size = 0
+        chunks = stream_exec_out(tv_ip, SCREENSHOT_COMMAND, SCREENSHOT_TIMEOUT)
+        try:
+            # A pipe or socket read can be shorter than the signature, so collect at least that much
+            first = b""
+            while len(first) < len(PNG_SIGNATURE):
+                chunk = await anext(chunks, b"")
+                if not chunk:
+                    break
+                first += chunk
+            if not first.startswith(PNG_SIGNATURE):
+                # Without an image, whatever the TV printed is the error message
+                message = first[:200].decode('utf-8', errors='ignore').strip()
+                async for chunk in chunks:
+                    pass
+                raise ScreenCaptureError(message or "The TV sent an empty capture")
+            size = len(first)
+            yield first
+            async for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+            result = {"success": True}
+        except ScreenCaptureError as e:
+            result = {"success": False, "error": str(e)}
+            raise
+        finally:
+            await chunks.aclose()
+            record_adb_command(tv_ip, "screencap", started, result)
+            if size:
+                screen_capture_bytes.inc(amount=size)
+
+async def capture_screen(tv_ip: str) -> bytes:
+    """Captures a TV's screen and returns the whole PNG."""
+    return b"".join([chunk async for chunk in screen_capture_chunks(tv_ip)])
+
+def downscale_capture(png: bytes) -> Tuple[bytes, str]:
+    """Shrinks a PNG capture to a JPEG thumbnail (longest side THUMBNAIL_SIZE); without Pillow the PNG is kept."""
+    if Image is None:
+        return png, "image/png"
+    with Image.open(io.BytesIO(png)) as image:
+        thumbnail = image.convert("RGB")
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+    output = io.BytesIO()
+    thumbnail.save(output, "JPEG", quality=THUMBNAIL_QUALITY)
+    return output.getvalue(), "image/jpeg"
+
+class Thumbnail(NamedTuple):
+    data: bytes
+    media_type: str
+    captured_at: float  # time.time() of the capture
+    taken: float        # time.monotonic() of the capture
+
+    def age(self) -> float:
+        return time.monotonic() - self.taken
+
+class ThumbnailCache:
+    """
+    LRU of downscaled screen captures for the thumbnail wall, bounded by total size (or, with
+    max_bytes None, by the number of entries only).
+    A stale thumbnail is still served while a single refresh runs in the background, and a TV is
+    captured at most once per THUMBNAIL_MIN_INTERVAL, so a dashboard polling every TV does not keep
+    the whole fleet busy with full-resolution captures. The capture times are kept apart from the
+    entries, so a TV whose thumbnail was evicted is still rate-limited.
+    """
+
+    def __init__(self, max_bytes: Optional[int], max_entries: int):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Thumbnail]" = OrderedDict()
+        self.size = 0
+        self.last_capture: Dict[str, float] = {}
+        self.refreshing: Dict[str, asyncio.Task] = {}
+
+    def lookup(self, tv_ip: str) -> Optional[Thumbnail]:
+        thumbnail = self.entries.get(tv_ip)
+        if thumbnail is not None:
+            self.entries.move_to_end(tv_ip)
+        return thumbnail
+
+    def retry_after(self, tv_ip: str) -> float:
+        """Seconds until the TV may be captured again for a thumbnail."""
+        return max(0.0, self.last_capture.get(tv_ip, float("-inf")) + THUMBNAIL_MIN_INTERVAL - time.monotonic())
+
+    def refresh(self, tv_ip: str, priority: int = PRIORITY_INTERACTIVE) -> Optional[asyncio.Task]:
+        """Returns the TV's running refresh, starts one if the rate limit allows, or returns None."""
+        task = self.refreshing.get(tv_ip)
+        if task is not None:
+            return task
+        if self.retry_after(tv_ip) > 0:
+            return None
+        self.last_capture[tv_ip] = time.monotonic()
+        with adb_priority(priority):
+            task = asyncio.create_task(self._capture(tv_ip))
+        self.refreshing[tv_ip] = task
+        task.add_done_callback(lambda _: self._settle(tv_ip, task))
+        return task
+
+    def _settle(self, tv_ip: str, task: asyncio.Task):
+        self.refreshing.pop(tv_ip, None)
+        if not task.cancelled():
+            task.exception()  # Background refreshes have no caller; their failure was already logged
+
+    async def _capture(self, tv_ip: str) -> Thumbnail:
+        try:
+            png = await capture_screen(tv_ip)
+            try:
+                data, media_type = await asyncio.to_thread(downscale_capture, png)
+            except (OSError, ValueError) as e:  # A truncated or corrupt PNG (UnidentifiedImageError is an OSError)
+                raise ScreenCaptureError(f"The capture could not be decoded: {e}")
+        except ScreenCaptureError as e:
+            print(f"⚠️ Thumbnail capture of {tv_ip} failed: {e}")
+            raise
+        thumbnail = Thumbnail(data, media_type, time.time(), time.monotonic())
+        self._store(tv_ip, thumbnail)
+        return thumbnail
+
+    def _store(self, tv_ip: str, thumbnail: Thumbnail):
+        self.discard(tv_ip)
+        if self.max_bytes is not None and len(thumbnail.data) > self.max_bytes:
+            return
+        self.entries[tv_ip] = thumbnail
+        self.size += len(thumbnail.data)
+        while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, tv_ip: str):
+        thumbnail = self.entries.pop(tv_ip, None)
+        if thumbnail is not None:
+            self.size -= len(thumbnail.data)
+
+# Separate from adb_in_flight: captures wait for each other, never for (or in front of) commands
+screen_capture_slots = PriorityGate(SCREENSHOT_MAX_IN_FLIGHT, "screencap")
+# Full-size PNGs (no Pillow) would fill the byte budget with a handful of TVs
+thumbnail_cache = ThumbnailCache(THUMBNAIL_CACHE_BYTES if Image is not None else None, THUMBNAIL_CACHE_ENTRIES)
+
+screen_capture_bytes = register_metric(Counter(
+    "screen_capture_bytes_total", "PNG bytes received from TV screen captures."))
+thumbnail_requests = register_metric(Counter(
+    "thumbnail_requests_total", "Thumbnail requests, by how they were answered (fresh, stale, captured, rate_limited, failed).", ("result",)))
+register_metric(Gauge(
+    "thumbnail_cache_bytes", "Bytes of thumbnails held in the cache.",
+    collect=lambda: {(): thumbnail_cache.size}))
+
+def thumbnail_headers(thumbnail: Thumbnail) -> Dict[str, str]:
+    return {
+        "Cache-Control": f"max-age={max(0, int(THUMBNAIL_TTL - thumbnail.age()))}",
+        "X-Captured-At": datetime.fromtimestamp(thumbnail.captured_at).isoformat(),
+    }
+
+@app.get("/screenshot/{tv_ip}")
+async def get_screenshot(tv_ip: str):
+    """Streams a full-resolution PNG of the TV's screen straight from the TV, without buffering it."""
+    chunks = screen_capture_chunks(tv_ip)
+    try:
+        first = await anext(chunks)
+    except ScreenCaptureError as e:
+        return JSONResponse(status_code=502, content={"success": False, "error": f"Screen capture failed: {e}"})
+
+    async def body():
+        try:
+            yield first
+            async for chunk in chunks:
+                yield chunk
+        except ScreenCaptureError as e:
+            print(f"⚠️ Screen capture of {tv_ip} broke off: {e}")
+        finally:
+            await chunks.aclose()
+
+    return StreamingResponse(body(), media_type="image/png", headers={"Cache-Control": "no-store"})
+
+@app.get("/screenshot/{tv_ip}/thumbnail")
+async def get_screenshot_thumbnail(tv_ip: str):
+    """A downscaled capture from the thumbnail cache; a stale one is served while it is refreshed."""
+    thumbnail = thumbnail_cache.lookup(tv_ip)
+    if thumbnail is not None and thumbnail.age() < THUMBNAIL_TTL:
+        thumbnail_requests.inc("fresh")
+    elif thumbnail is not None:
+        thumbnail_cache.refresh(tv_ip, PRIORITY_BACKGROUND)
+        thumbnail_requests.inc("stale")
+    else:
+        task = thumbnail_cache.refresh(tv_ip)
+        if task is None:
+            thumbnail_requests.inc("rate_limited")
+            retry_after = math.ceil(thumbnail_cache.retry_after(tv_ip))
+            return JSONResponse(status_code=429, headers={"Retry-After": str(retry_after)}, content={
+                "success": False, "error": f"{tv_ip} was captured moments ago; try again in {retry_after}s."})
+        try:
+            thumbnail = await asyncio.shield(task)
+        except ScreenCaptureError as e:
+            thumbnail_requests.inc("failed")
+            return JSONResponse(status_code=502, content={"success": False, "error": f"Screen capture failed: {e}"})
+        thumbnail_requests.inc("captured")
+    return Response(content=thumbnail.data, media_type=thumbnail.media_type, headers=thumbnail_headers(thumbnail))
+
+@app.get("/screenshots")
+async def get_thumbnail_wall():
+    """
+    The thumbnail wall: per TV, where its thumbnail is and how old it is. Missing and stale
+    thumbnails of TVs not known to be offline are refreshed in the background, within the rate limit.
+    """
+    tvs = []
+    for tv_ip in ALL_TV_IPS:
+        thumbnail = thumbnail_cache.lookup(tv_ip)
+        link = connection_supervisor.links.get(tv_ip)
+        if (thumbnail is None or thumbnail.age() >= THUMBNAIL_TTL) and not (link is not None and link.online is False):
+            thumbnail_cache.refresh(tv_ip, PRIORITY_BACKGROUND)
+        tvs.append({
+            "tv_ip": tv_ip,
+            "thumbnail_url": f"/screenshot/{tv_ip}/thumbnail" if thumbnail is not None else None,
+            "captured_at": datetime.fromtimestamp(thumbnail.captured_at).isoformat() if thumbnail is not None else None,
+            "age": round(thumbnail.age(), 1) if thumbnail is not None else None,
+            "stale": thumbnail is None or thumbnail.age() >= THUMBNAIL_TTL,
+            "refreshing": tv_ip in thumbnail_cache.refreshing,
+        })
+    return {"success": True, "ttl": THUMBNAIL_TTL, "tvs": tvs}
+
+# ==============================================================================
+# --- WEBSOCKET REMOTE ---
+# ==============================================================================
+
+# Names a web remote may send instead of keycodes
+REMOTE_KEYS = {
+    "up": "19", "down": "20", "left": "21", "right": "22", "ok": "23",
+    "back": "4", "home": "3", "menu": "82", "input": "178",
+    "volume_up": "24", "volume_down": "25", "mute": "164", "power": "26",
+    "play_pause": "85", "stop": "86", "next": "87", "previous": "88",
+}
+REMOTE_KEYCODE_PATTERN = re.compile(r"^(\d{1,3}|KEYCODE_[A-Z0-9_]+)$")
+
+class RemotePress(NamedTuple):
+    press_id: Any
+    keycode: str
+    received: float
+
+def parse_remote_key(key: Any) -> Optional[str]:
+    """A keycode for `input keyevent` from a key name, number or KEYCODE_ name, or None if it is not one."""
+    keycode = REMOTE_KEYS.get(key, str(key)) if isinstance(key, (str, int)) and not isinstance(key, bool) else None
+    return keycode if keycode is not None and REMOTE_KEYCODE_PATTERN.match(keycode) else None
+
+class RemoteSession:
+    """
+    One WebSocket remote-control connection to a TV. Messages are `{"key": "down", "id": 1}`;
+    each press is answered with an ack carrying its latency. Presses are sent by a single task,
+    so they reach the TV in the order they arrived, and presses that arrive while others are
+    waiting share one `input keyevent` call on the TV's queue.
+    """
+
+    def __init__(self, websocket: WebSocket, tv_ip: str):
+        self.websocket = websocket
+        self.tv_ip = tv_ip
+        self.presses: asyncio.Queue = asyncio.Queue(maxsize=REMOTE_QUEUE_SIZE)
+        self.sequence = itertools.count(1)
+
+    async def run(self):
+        await self.websocket.send_json({"type": "connected", "tv_ip": self.tv_ip, "batch_window_ms": REMOTE_BATCH_WINDOW * 1000})
+        sender = asyncio.create_task(self._send_presses())
+        try:
+            await self._receive_presses()
+        finally:
+            sender.cancel()
+            await asyncio.gather(sender, return_exceptions=True)
+
+    async def _receive_presses(self):
+        while True:
+            try:
+                message = await self.websocket.receive_json()
+            except WebSocketDisconnect:
+                return
+            except (KeyError, ValueError):
+                # A binary frame has no "text" (KeyError) and malformed JSON fails to decode (ValueError)
+                await self.websocket.send_json({"type": "error", "error": "Messages must be JSON text like {\"key\": \"down\"}."})
+                continue
+            press_id = message.get("id", next(self.sequence)) if isinstance(message, dict) else None
+            keycode = parse_remote_key(message.get("key")) if isinstance(message, dict) else None
+            if keycode is None:
+                await self.websocket.send_json({"type": "ack", "id": press_id, "success": False, "error": "Unknown key."})
+            elif self.presses.full():
+                await self.websocket.send_json({"type": "ack", "id": press_id, "key": keycode, "success": False,
+                                                "error": f"More than {REMOTE_QUEUE_SIZE} presses are waiting; press dropped."})
+            else:
+                self.presses.put_nowait(RemotePress(press_id, keycode, time.monotonic()))
+
+    async def _next_batch(self) -> List[RemotePress]:
+        """Waits for a press, then takes the presses that follow within REMOTE_BATCH_WINDOW of each other."""
+        batch = [await self.presses.get()]
+        while len(batch) < REMOTE_BATCH_MAX_KEYS and batch[-1].keycode not in FOCUS_CHANGING_KEYS:
+            try:
+                batch.append(self.presses.get_nowait() if not self.presses.empty()
+                             else await asyncio.wait_for(self.presses.get(), REMOTE_BATCH_WINDOW))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _send_presses(self):
+        while True:
+            batch = await self._next_batch()
+            keycodes = " ".join(press.keycode for press in batch)
+            result = await execute_shell_command(self.tv_ip, f"input keyevent {keycodes}", timeout=REMOTE_KEY_TIMEOUT)
+            finished = time.monotonic()
+            remote_batch_size.observe(len(batch))
+            for press in batch:
+                remote_key_latency.observe(finished - press.received)
+                await self.websocket.send_json({
+                    "type": "ack",
+                    "id": press.press_id,
+                    "key": press.keycode,
+                    "success": result["success"],
+                    "error": None if result["success"] else result.get("error"),
+                    "latency_ms": round((finished - press.received) * 1000, 1),
+                    "batch_size": len(batch),
+                })
+            if batch[-1].keycode in FOCUS_CHANGING_KEYS and not self.presses.empty():
+                await asyncio.sleep(REMOTE_FOCUS_SETTLE)  # Let the new window come up before the next keys
+
+remote_sessions: set = set()
+
+remote_key_latency = register_metric(Histogram(
+    "remote_key_latency_seconds", "Time from a WebSocket remote key press arriving to its acknowledgement.", (), LATENCY_BUCKETS))
+remote_batch_size = register_metric(Histogram(
+    "remote_batch_size", "Key presses sent per `input keyevent` call by the WebSocket remote.", (), (1, 2, 4, 8, 16)))
+register_metric(Gauge(
+    "remote_sessions", "Connected WebSocket remotes.", collect=lambda: {(): len(remote_sessions)}))
+
+@app.websocket("/ws/remote/{tv_ip}")
+async def remote_control(websocket: WebSocket, tv_ip: str):
+    """Interactive remote control for one TV: send `{"key": "down", "id": 1}`, get an ack with the latency per press."""
+    await websocket.accept()
+    session = RemoteSession(websocket, tv_ip)
+    remote_sessions.add(session)
+    print(f"🎮 Remote connected to {tv_ip}")
+    try:
+        await session.run()
+    finally:
+        remote_sessions.discard(session)
+        print(f"🎮 Remote for {tv_ip} disconnected")
+
+# ==============================================================================
+# --- CLOSED-LOOP HDMI SWITCHING ---
+# ==============================================================================
+
+# Learned upper bound (seconds) for each wait of each switch sequence, per TV:
+# (tv_ip, sequence) -> {step index -> limit}
+hdmi_wait_limits: Dict[tuple, Dict[int, float]] = {}
+# Timing of the last switch on each TV, for /hdmi-timings
+hdmi_switch_timings: Dict[str, Dict[str, Any]] = {}
+
+async def wait_for_focus(tv_ip: str, predicate: Callable[[Optional[str]], bool], limit: float, settle: float = 0) -> tuple:
+    """
+    Polls the focused window with backoff until predicate(focus) is true or the limit passes.
+    Returns (focus, matched, waited seconds).
+    """
+    started = time.monotonic()
+    interval = HDMI_POLL_INTERVAL
+    focus = None
+    while True:
+        remaining = limit - (time.monotonic() - started)
+        if remaining <= 0:
+            return focus, False, time.monotonic() - started
+        await asyncio.sleep(min(interval, remaining))
+        interval *= HDMI_POLL_BACKOFF
+        result = await read_focused_component(tv_ip)
+        if result["success"]:
+            focus = result["focused_app"]
+            if predicate(focus):
+                await asyncio.sleep(settle)
+                return focus, True, time.monotonic() - started
+
+async def wait_for_focus_change(tv_ip: str, previous_focus: Optional[str], limit: float) -> tuple:
+    """Waits until the focused window differs from previous_focus. Returns (focus, changed, waited seconds)."""
+    focus, changed, waited = await wait_for_focus(tv_ip, lambda focus: focus != previous_focus, limit, HDMI_SETTLE_DELAY)
+    return (focus if changed else previous_focus), changed, waited
+
+async def confirm_hdmi_input(tv_ip: str, target_input: Optional[str]) -> Dict[str, Any]:
+    """
+    Polls until the TV shows the target input (or, with no target, any input in hdmi_status_map).
+    Only a missed target is a failure: with no target, or no status map to observe, the result
+    is successful with "confirmed" telling whether the input was actually seen.
+    """
+    status_map = get_tv_config(tv_ip).hdmi_status_map
+    if not status_map:
+        return {"success": True, "hdmi_status": None, "confirmed": False}
+
+    deadline = time.monotonic() + HDMI_CONFIRM_TIMEOUT
+    interval = HDMI_POLL_INTERVAL
+    status = None
+    while True:
+        result = await get_hdmi_status_internal(tv_ip)
+        status = result.get("hdmi_status")
+        if result["success"] and (status == target_input or (target_input is None and status in status_map.values())):
+            return {"success": True, "hdmi_status": status, "confirmed": True}
+        if time.monotonic() >= deadline:
+            if target_input is None:
+                return {"success": True, "hdmi_status": status, "confirmed": False}
+            return {"success": False, "hdmi_status": status, "confirmed": False, "error": f"TV shows '{status}' instead of {target_input}"}
+        await asyncio.sleep(min(interval, max(0, deadline - time.monotonic())))
+        interval *= HDMI_POLL_BACKOFF
+
+async def run_hdmi_switch(tv_ip: str, plan: CommandPlan, target_input: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Runs an HDMI switch sequence from its compiled plan. The `sleep N` after a focus-changing key
+    is an upper bound: the wait ends as soon as the focused window changes, and a learned shorter
+    limit that is missed keeps polling up to the configured sleep. The remaining steps run on the
+    TV as single scripts, with the in-menu sleeps cut to a per-TV learned length that only shrinks
+    after confirmed switches: a concrete target input seen on screen, or, with no target, an
+    input other than the one shown before the switch (a TV already on that input would confirm
+    before the menu had done anything). A switch that fails to confirm with shortened sleeps is
+    retried once at the configured timing before it is reported as failed. If the focused window
+    cannot be read at all, the sequence is sent open-loop with its configured sleeps.
+    """
+    status_map = get_tv_config(tv_ip).hdmi_status_map
+
+    async def run_steps(limits: Dict[int, float], steps: List[Dict[str, Any]]) -> tuple:
+        """
+        One pass over the plan. Returns (result, whether any in-menu sleep was shortened, the input
+        shown before the pass or None if the focus could not be read).
+        """
+        focus_result = await read_focused_component(tv_ip)
+        if not focus_result["success"]:
+            print(f"⚠️ Cannot read the focus on {tv_ip} ({focus_result.get('error')}), switching open-loop")
+            block_started = time.monotonic()
+            result = await run_plan_script(tv_ip, plan.steps)
+            steps.append({
+                "steps": [step.index for step in plan.steps],
+                "commands": list(plan.commands),
+                "waited_ms": round((time.monotonic() - block_started) * 1000),
+                "open_loop": True
+            })
+            return result, False, None
+        focus = focus_result["focused_app"]
+        status_before = match_hdmi_status(status_map, focus) if focus else "home_or_other"
+
+        result = {"success": True}
+        shortened = False
+        for kind, block in plan.blocks:
+            if kind == "wait":
+                # Checkpoint after a focus-changing key: wait on the host until the change is seen.
+                limit = limits.get(block.index, block.sleep)
+                focus, changed, waited = await wait_for_focus_change(tv_ip, focus, limit)
+                if not changed and limit < block.sleep:
+                    # Slower than learned: keep watching up to the configured sleep before sending more keys.
+                    focus, changed, extra = await wait_for_focus_change(tv_ip, focus, block.sleep - waited)
+                    waited += extra
+                steps.append({"step": block.index, "command": block.command, "waited_ms": round(waited * 1000), "focus_changed": changed})
+                if changed:
+                    # Next time allow twice what it took, within the configured bound.
+                    limits[block.index] = min(block.sleep, max(HDMI_MIN_STEP_DELAY, waited * 2))
+                else:
+                    limits[block.index] = block.sleep
+            else:
+                # Everything else (including in-menu sleeps, at their learned length) runs on the TV in one go.
+                shortened = shortened or any(
+                    step.sleep is not None and limits.get(step.index, step.sleep) < step.sleep for step in block
+                )
+                block_started = time.monotonic()
+                result = await run_plan_script(tv_ip, block, limits)
+                steps.append({
+                    "steps": [step.index for step in block],
+                    "commands": [step.command for step in block],
+                    "waited_ms": round((time.monotonic() - block_started) * 1000)
+                })
+                if not result["success"]:
+                    break  # Stop on the first error
+        return result, shortened, status_before
+
+    def reset_sleep_limits(limits: Dict[int, float]):
+        for step in plan.steps:
+            if step.sleep is not None:
+                limits[step.index] = step.sleep
+
+    async def run_switch():
+        started = time.monotonic()
+        limits = hdmi_wait_limits.setdefault((tv_ip, plan.commands), {})
+        steps = []
+
+        result, shortened, status_before = await run_steps(limits, steps)
+        if not result["success"]:
+            return result
+        confirmation = await confirm_hdmi_input(tv_ip, target_input)
+        if not confirmation["success"] and shortened:
+            print(f"🔁 HDMI switch on {tv_ip} not confirmed with learned sleeps, retrying at the configured timing")
+            reset_sleep_limits(limits)
+            result, _, status_before = await run_steps(limits, steps)
+            if not result["success"]:
+                return result
+            confirmation = await confirm_hdmi_input(tv_ip, target_input)
+
+        if not confirmation["success"]:
+            reset_sleep_limits(limits)
+        elif confirmation.get("confirmed") and (
+                target_input is not None or confirmation.get("hdmi_status") != status_before):
+            # Only a switch seen to land on the right input may shorten the (unobservable) in-menu sleeps.
+            for kind, block in plan.blocks:
+                if kind == "script":
+                    for step in block:
+                        if step.sleep is not None:
+                            limits[step.index] = max(HDMI_MIN_STEP_DELAY, limits.get(step.index, step.sleep) * 0.8)
+
+        timing = {
+            "target_input": target_input,
+            "total_ms": round((time.monotonic() - started) * 1000),
+            "confirmed": confirmation.get("confirmed", False),
+            "steps": steps,
+            "finished_at": datetime.now().isoformat()
+        }
+        hdmi_switch_timings[tv_ip] = timing
+        command_sequence_seconds.observe(timing["total_ms"] / 1000, tv_ip, "hdmi_switch")
+        print(f"📺 HDMI switch on {tv_ip} took {timing['total_ms']}ms (confirmed: {timing['confirmed']})")
+        if not confirmation["success"]:
+            return {"success": False, "error": f"Switch could not be confirmed: {confirmation['error']}", "timing": timing}
+        return {"success": True, "hdmi_status": confirmation.get("hdmi_status"), "timing": timing}
+
+    return await get_device_actor(tv_ip).submit(run_switch)
+
+@app.get("/hdmi-timings")
+async def get_hdmi_timings():
+    """Shows the timing of the last HDMI switch on each TV and the learned wait limits."""
+    return {
+        "last_switch": hdmi_switch_timings,
+        "learned_wait_limits": {
+            tv_ip: {f"{index}:{sequence[index]}": round(limit, 2) for index, limit in limits.items()}
+            for (tv_ip, sequence), limits in hdmi_wait_limits.items()
+        }
+    }
+
+# ==============================================================================
+# --- SHARED STATE (MULTI-WORKER) ---
+# ==============================================================================
+
+WORKER_ID = f"{os.getpid()}-{os.urandom(3).hex()}"
+
+class LocalStateBackend:
+    """Shared state for a single worker: every lease is ours and events are delivered in-process."""
+
+    name = "local"
+    sync_interval: Optional[float] = None
+
+    def __init__(self):
+        # Seeded from the clock (microseconds), so ids keep growing across restarts and a client
+        # resuming with the Last-Event-ID of the previous run does not skip the new events
+        self.event_ids = itertools.count(time.time_ns() // 1000)
+        self.broker: Optional["EventBroker"] = None
+
+    def start(self, broker: "EventBroker"):
+        self.broker = broker
+
+    async def stop(self):
+        pass
+
+    def try_lease(self, name: str, ttl: float) -> bool:
+        return True
+
+    def release_lease(self, name: str):
+        pass
+
+    @asynccontextmanager
+    async def device_lock(self, tv_ip: str):
+        yield  # The TV's DeviceActor already runs one job at a time
+
+    def publish_event(self, topic: str, event_type: str, data: Dict[str, Any]) -> int:
+        event_id = next(self.event_ids)
+        self.broker.deliver(event_id, topic, event_type, data)
+        return event_id
+
+    def save_device_field(self, tv_ip: str, name: str, value: Any):
+        pass
+
+    def load_device_states(self):
+        pass
+
+class SqliteStateBackend:
+    """
+    Shared state for several worker processes, kept in one SQLite database in WAL mode:
+    - leases (name -> owner, expiry) elect the worker that runs the background work, and
+      serialize the commands sent to a TV across workers;
+    - events get their id from the database and every worker tails the table into its own
+      broker, so an SSE client sees every event whichever worker it is connected to;
+    - fleet cache fields are written through and loaded by the other workers when the
+      database has changed (PRAGMA data_version).
+    """
+
+    name = "sqlite"
+    sync_interval: Optional[float] = SHARED_SYNC_INTERVAL
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.db: Optional[sqlite3.Connection] = None
+        self.broker: Optional["EventBroker"] = None
+        self.last_event_id = 0
+        self.data_version: Optional[int] = None
+        self.states_loaded_until = 0.0
+        self.new_events = asyncio.Event()
+        self.tailer: Optional[asyncio.Task] = None
+
+    def start(self, broker: "EventBroker"):
+        self.broker = broker
+        self.db = sqlite3.connect(self.db_path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT NOT NULL, event_type TEXT NOT NULL, data TEXT NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS device_state ("
+            "tv_ip TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, observed_at REAL NOT NULL, "
+            "PRIMARY KEY (tv_ip, name))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS device_state_observed ON device_state (observed_at)")
+        self.last_event_id = self.db.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+        self.tailer = asyncio.create_task(self._tail_events())
+        print(f"🗄️ Worker {WORKER_ID} using shared state in {self.db_path}")
+
+    async def stop(self):
+        if self.tailer is not None:
+            self.tailer.cancel()
+            await asyncio.gather(self.tailer, return_exceptions=True)
+        if self.db is not None:
+            self.db.execute("DELETE FROM leases WHERE owner = ?", (WORKER_ID,))
+            self.db.close()
+
+    def try_lease(self, name: str, ttl: float) -> bool:
+        """Takes or renews a lease. Succeeds if it is free, expired or already ours."""
+        now = time.time()
+        cursor = self.db.execute(
+            "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires "
+            "WHERE leases.owner = excluded.owner OR leases.expires < ?",
+            (name, WORKER_ID, now + ttl, now))
+        return cursor.rowcount == 1
+
+    def release_lease(self, name: str):
+        self.db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, WORKER_ID))
+
+    @asynccontextmanager
+    async def device_lock(self, tv_ip: str):
+        """Holds the TV's lease while a job runs, so two workers never interleave commands on it."""
+        name, delay = f"device:{tv_ip}", 0.01
+        while not self.try_lease(name, DEVICE_LEASE_TTL):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        try:
+            yield
+        finally:
+            self.release_lease(name)
+
+    def publish_event(self, topic: str, event_type: str, data: Dict[str, Any]) -> int:
+        cursor = self.db.execute(
+            "INSERT INTO events (topic, event_type, data) VALUES (?, ?, ?)", (topic, event_type, json.dumps(data)))
+        self.new_events.set()
+        return cursor.lastrowid
+
+    async def _tail_events(self):
+        rounds = 0
+        while True:
+            try:
+                await asyncio.wait_for(self.new_events.wait(), timeout=SHARED_SYNC_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.new_events.clear()
+            try:
+                rows = self.db.execute(
+                    "SELECT id, topic, event_type, data FROM events WHERE id > ? ORDER BY id", (self.last_event_id,)).fetchall()
+                for event_id, topic, event_type, data in rows:
+                    self.broker.deliver(event_id, topic, event_type, json.loads(data))
+                    self.last_event_id = event_id
+                rounds += 1
+                if rounds % 100 == 0:
+                    self.db.execute("DELETE FROM events WHERE id <= ?", (self.last_event_id - SHARED_EVENT_RETENTION,))
+            except sqlite3.Error as e:
+                print(f"❌ Error reading shared events: {e}")
+
+    def save_device_field(self, tv_ip: str, name: str, value: Any):
+        self.db.execute(
+            "INSERT OR REPLACE INTO device_state (tv_ip, name, value, observed_at) VALUES (?, ?, ?, ?)",
+            (tv_ip, name, json.dumps(value), time.time()))
+
+    def load_device_states(self):
+        """Picks up fleet cache fields written by other workers since the last call."""
+        if self.db is None:
+            return
+        data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self.data_version:
+            return
+        self.data_version = data_version
+        rows = self.db.execute(
+            "SELECT tv_ip, name, value, observed_at FROM device_state WHERE observed_at > ?", (self.states_loaded_until,)).fetchall()
+        for tv_ip, name, value, observed_at in rows:
+            state = device_states.get(tv_ip)
+            if state is None:
+                state = device_states[tv_ip] = DeviceState(tv_ip)
+            state.load(name, json.loads(value), observed_at)
+            self.states_loaded_until = max(self.states_loaded_until, observed_at)
+
+shared_state = SqliteStateBackend(SHARED_STATE_DB) if SHARED_STATE_BACKEND == "sqlite" else LocalStateBackend()
+
+async def lead_background_work():
+    """
+    Runs the rental timer loop, the fleet poller and the focus watchers on exactly one worker:
+    the one holding the "leader" lease. Another worker takes over when the lease runs out.
+    """
+    leading = False
+    poller: Optional[asyncio.Task] = None
+    try:
+        while True:
+            if shared_state.try_lease("leader", LEADER_LEASE_TTL):
+                if not leading:
+                    leading = True
+                    if shared_state.name != "local":
+                        print(f"👑 Worker {WORKER_ID} is now the leader")
+                    rental_timers.start()
+                    poller = asyncio.create_task(poll_fleet_forever())
+                    if FOCUS_WATCHER_ENABLED:
+                        start_focus_watchers(ALL_TV_IPS)
+            elif leading:
+                print(f"👑 Worker {WORKER_ID} lost the leader lease")
+                leading = False
+                poller.cancel()
+                await asyncio.gather(poller, return_exceptions=True)
+                await rental_timers.stop_runner()
+                await stop_all_focus_watchers()
+            await asyncio.sleep(LEADER_LEASE_TTL / 3)
+    finally:
+        if poller is not None:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+        await stop_all_focus_watchers()
+        if leading:
+            shared_state.release_lease("leader")
 
 # ==============================================================================
-# --- APPLICATION SETUP ---
+# --- RENTAL MONITORING & SSE (Server-Sent Events) ---
 # ==============================================================================
 
-app = FastAPI(
-    title="ADB Control Server",
-    description="A scalable FastAPI server for controlling Android TVs via ADB.",
-    version="2.4.0" # // Version updated
-)
+async def send_sse_message(event_type: str, data: dict, event_id: Optional[int] = None):
+    """Formats data into a Server-Sent Event message string."""
+    id_line = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{id_line}event: {event_type}\ndata: {json.dumps(data)}\n\n"
 
-# Allow Cross-Origin Resource Sharing (CORS) for communication with the Laravel frontend
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"], # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"], # Allows all methods (GET, POST, etc.)
-    allow_headers=["*"], # Allows all headers
-)
+class EventSubscription:
+    """One SSE client's queue. It is bounded and drops the oldest events when the client falls behind."""
 
-# Global state for managing real-time rental monitoring
-active_rental_monitors: Dict[int, asyncio.Queue] = {}
-timeout_tasks: Dict[int, asyncio.Task] = {}
+    def __init__(self, topic: str):
+        self.topic = topic
+        self.events: deque = deque(maxlen=SSE_CLIENT_QUEUE_SIZE)
+        self.ready = asyncio.Event()
+        self.dropped = 0
 
-# ==============================================================================
-# --- Pydantic Models (for API Request and Response validation) ---
-# ==============================================================================
+    def push(self, event: tuple):
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(event)
+        self.ready.set()
 
-class TVRequest(BaseModel):
-    tv_ip: str
+    async def next_events(self) -> List[tuple]:
+        """Waits for at least one event and returns everything queued."""
+        await self.ready.wait()
+        self.ready.clear()
+        events = list(self.events)
+        self.events.clear()
+        return events
 
-class PlayVideoRequest(TVRequest):
-    rental_id: int
+class EventBroker:
+    """
+    Publish/subscribe hub for SSE. Topics are "fleet" (TV and rental events, for the cashier
+    dashboard), "rental:<id>", "job:<id>" and "video-sync". Any number of clients may subscribe
+    to a topic, and each topic keeps a small ring buffer so a reconnecting client can resume from
+    its Last-Event-ID. A rental's buffer is dropped a while after its last event (RENTAL_FINISHED_EVENTS).
+    """
 
-class RentalTimeoutRequest(TVRequest):
-    rental_id: int
-    timeout_seconds: int = 30
+    FLEET_TOPIC = "fleet"
+    RENTAL_FINISHED_EVENTS = ("timeout_triggered", "monitor_stopped")
 
-class TVControlRequest(TVRequest):
-    action: str  # e.g., 'volume_up', 'volume_down', 'power_off'
-    
-class SendKeyRequest(TVRequest):
-    keycode: int
+    def __init__(self):
+        self.subscribers: Dict[str, set] = {}
+        self.history: Dict[str, deque] = {}
+        self.listeners: List[Callable[[str, str, Dict[str, Any]], None]] = []
+        self.finished_rentals: "OrderedDict[str, float]" = OrderedDict()  # topic -> time.monotonic() it finished
 
-class BaseResponse(BaseModel):
-    success: bool
-    message: Optional[str] = None
-    error: Optional[str] = None
+    def publish(self, topic: str, event_type: str, data: Dict[str, Any]) -> int:
+        """Publishes an event to a topic (and, for rental events, to the fleet topic) on every worker and returns its id."""
+        return shared_state.publish_event(topic, event_type, data)
 
-class DevicesResponse(BaseResponse):
-    devices: Optional[str] = None
+    def deliver(self, event_id: int, topic: str, event_type: str, data: Dict[str, Any]):
+        """Hands an event to this worker's subscribers and replay buffers."""
+        event = (event_id, event_type, data)
+        # Job progress and video-sync events stay on their own topics, so they neither flood the
+        # dashboard nor push rental events out of the fleet replay buffer.
+        rental = topic.startswith("rental:")
+        for target in ({topic, self.FLEET_TOPIC} if rental else {topic}):
+            self.history.setdefault(target, deque(maxlen=SSE_REPLAY_BUFFER_SIZE)).append(event)
+            for subscription in self.subscribers.get(target, ()):
+                subscription.push(event)
+        if rental:
+            self.finished_rentals.pop(topic, None)
+            if event_type in self.RENTAL_FINISHED_EVENTS:
+                self.finished_rentals[topic] = time.monotonic()
+            self._expire_finished_rentals()
+        for listener in self.listeners:
+            listener(topic, event_type, data)
 
-# // NEW: A request model for the new functions
-class SetHDMIRequest(TVRequest):
-    target_input: str  # This will be 'hdmi1' or 'hdmi2'
+    def _expire_finished_rentals(self):
+        cutoff = time.monotonic() - SSE_FINISHED_RENTAL_TTL
+        while self.finished_rentals:
+            topic, finished_at = next(iter(self.finished_rentals.items()))
+            if finished_at > cutoff:
+                break
+            del self.finished_rentals[topic]
+            self.forget(topic)
 
-# // NEW: A response model for the status checking function
-class HDMIStatusResponse(BaseResponse):
-    hdmi_status: Optional[str] = None
+    def subscribe(self, topic: str, last_event_id: Optional[int] = None) -> EventSubscription:
+        subscription = EventSubscription(topic)
+        if last_event_id is not None:
+            for event in self.history.get(topic, ()):
+                if event[0] > last_event_id:
+                    subscription.push(event)
+        self.subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
 
-# ==============================================================================
-# --- CORE ADB & HELPER FUNCTIONS ---
-# ==============================================================================
+    def forget(self, topic: str):
+        """Drops a short-lived topic's replay buffer."""
+        self.history.pop(topic, None)
 
-def get_tv_config(tv_ip: str) -> Dict[str, Any]:
-    """Retrieves the configuration for a given TV IP, falling back to the default if not found."""
-    config = TV_CONFIGS.get(tv_ip)
-    if not config:
-        print(f"⚠️ Warning: No specific config for {tv_ip}. Using default TCL config.")
-        return TV_CONFIGS["DEFAULT_TCL"]
-    return config
+    def unsubscribe(self, subscription: EventSubscription):
+        subscribers = self.subscribers.get(subscription.topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.subscribers[subscription.topic]
 
-async def execute_adb_command(command: str, timeout: int = 10) -> Dict[str, Any]:
-    """Executes a full ADB command string asynchronously and returns the result."""
-    full_command = f'"{ADB_PATH}" {command}'
-    print(f"Executing: {full_command}")
-    
+event_broker = EventBroker()
+
+def count_sse_subscribers() -> Dict[tuple, float]:
+    counts: Dict[tuple, float] = {}
+    for topic, subscriptions in event_broker.subscribers.items():
+        kind = (topic.split(":")[0],)
+        counts[kind] = counts.get(kind, 0) + len(subscriptions)
+    return counts
+
+register_metric(Gauge("sse_subscribers", "Connected SSE clients per topic kind.", ("topic",), collect=count_sse_subscribers))
+
+def publish_rental_event(rental_id: int, event_type: str, data: Dict[str, Any]) -> int:
+    return event_broker.publish(f"rental:{rental_id}", event_type, {"type": event_type, "rental_id": rental_id, **data})
+
+def parse_last_event_id(request: Request) -> Optional[int]:
+    value = request.headers.get("last-event-id") or request.query_params.get("last_event_id")
     try:
-        process = await asyncio.create_subprocess_shell(
-            full_command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+def event_stream_response(topic: str, last_event_id: Optional[int], hello: Dict[str, Any],
+                          last_event_types: tuple = ()) -> StreamingResponse:
+    """Streams a broker topic as SSE, with periodic keep-alive comments, until an event in last_event_types."""
+    async def event_generator():
+        subscription = event_broker.subscribe(topic, last_event_id)
+        try:
+            yield await send_sse_message("connected", hello)
+            if hello.get("type") in last_event_types:
+                return
+            while True:
+                try:
+                    events = await asyncio.wait_for(subscription.next_events(), timeout=SSE_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                for event_id, event_type, data in events:
+                    yield await send_sse_message(event_type, data, event_id)
+                    if event_type in last_event_types:
+                        return
+        except asyncio.CancelledError:
+            print(f"SSE client for {topic} disconnected.")
+        finally:
+            # Only this client's subscription goes away; rental timeouts keep running.
+            event_broker.unsubscribe(subscription)
+
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def prewarm_rental(rental_id: int, tv_ip: str, deadline: float):
+    """
+    Called by the timer scheduler RENTAL_PREWARM_SECONDS before a rental's deadline. One shell
+    round-trip checks the link, wakes the TV's shell session and looks up the timeout video;
+    a TV that does not answer is reconnected right away, even if it is backing off.
+    """
+    started = time.monotonic()
+    video_path = get_tv_config(tv_ip).video_path
+    command = f"echo online; ls {shlex.quote(video_path)}"
+    result = await execute_shell_command(tv_ip, command, timeout=5)
+    reconnected = False
+    if "online" not in result.get("output", ""):
+        connect_result = await connection_supervisor.reconnect(tv_ip, force=True)
+        reconnected = connect_result["success"]
+        if reconnected:
+            result = await execute_shell_command(tv_ip, command, timeout=5)
+
+    online = "online" in result.get("output", "")
+    video_present = online and video_path in result["output"].splitlines()
+    if online:
+        connection_supervisor.mark_online(tv_ip)
+        get_device_state(tv_ip).set("online", True)
+    outcome = "ready" if video_present else "video_missing" if online else "offline"
+    rental_prewarms.inc(outcome)
+    print(f"🔥 Pre-warmed {tv_ip} for rental {rental_id}: {outcome} ({deadline - time.time():.0f}s before the deadline)")
+    if outcome == "video_missing":
+        # There may still be time to push it before the deadline
+        video_sync.sync_tv_in_background(tv_ip)
+    publish_rental_event(rental_id, "prewarm", {
+        "tv_ip": tv_ip,
+        "result": outcome,
+        "online": online,
+        "reconnected": reconnected,
+        "video_present": video_present,
+        "video_sync_started": outcome == "video_missing",
+        "error": None if video_present else result.get("error") or f"{video_path} not found on the TV",
+        "duration_ms": round((time.monotonic() - started) * 1000),
+        "seconds_before_deadline": round(deadline - time.time(), 1)
+    })
+
+async def fire_rental_timeout(rental_id: int, tv_ip: str, deadline: float):
+    """
+    Called by the timer scheduler when a rental's time is up: plays the timeout video.
+    The rental's SSE stream gets the scheduled time and how far behind it the timer fired
+    and the video was confirmed on screen.
+    """
+    fired_at = time.time()
+    lateness = fired_at - deadline
+    rental_timeout_drift_seconds.observe(max(0.0, lateness))
+    if lateness > 1:
+        print(f"⚠️ Timeout for rental {rental_id} fired {lateness:.1f}s late.")
+    print(f"🎬 Timeout reached for rental {rental_id}. Playing video.")
+    result = await play_timeout_video_internal(tv_ip, rental_id)
+    playback_drift = time.time() - deadline
+    rental_playback_drift_seconds.observe(max(0.0, playback_drift))
+    publish_rental_event(rental_id, "timeout_triggered", {
+        "success": result["success"],
+        "errors": result.get("errors"),
+        "stages": result.get("stages"),
+        "scheduled_at": deadline,
+        "fired_at": fired_at,
+        "fire_drift_ms": round(lateness * 1000),
+        "playback_drift_ms": round(playback_drift * 1000)
+    })
+
+class RentalTimerScheduler:
+    """
+    A single scheduler for all rental timeouts, replacing one sleeping task per rental.
+    Deadlines (wall-clock epoch seconds) live in a min-heap and are journalled to SQLite,
+    so pending timeouts are reloaded at startup; those that passed while the server was
+    down fire immediately and are logged as late.
+    Scheduling and extending push a new heap entry (O(log n)); cancelled or superseded
+    entries are skipped lazily when they reach the top of the heap. Each deadline also gets
+    a pre-warm entry RENTAL_PREWARM_SECONDS earlier, which readies the TV without firing.
+    With several workers, all of them journal to the same database but only the leader runs
+    the loop. The heap is reloaded whenever another worker has changed the journal, and a row
+    is claimed before its timeout fires, so it fires once even across a change of leader;
+    a claim left behind by a crashed worker runs out after TIMER_CLAIM_TTL seconds.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.db: Optional[sqlite3.Connection] = None
+        self.heap: List[tuple] = []  # (due time, version, rental_id, "prewarm" or "timeout")
+        self.pending: Dict[int, Dict[str, Any]] = {}  # rental_id -> {"tv_ip", "deadline", "version"}
+        self.versions = itertools.count()
+        self.data_version: Optional[int] = None
+        self.wakeup = asyncio.Event()
+        self.runner: Optional[asyncio.Task] = None
+        self.firing: set = set()
+
+    def _open(self):
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS rental_timers ("
+            "rental_id INTEGER PRIMARY KEY, tv_ip TEXT NOT NULL, deadline REAL NOT NULL)"
         )
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
-        
-        stdout_str = stdout.decode('utf-8', errors='ignore').strip()
-        stderr_str = stderr.decode('utf-8', errors='ignore').strip()
-        
-        if process.returncode == 0:
-            return {"success": True, "output": stdout_str}
-        else:
-            error_message = stderr_str or f"Process failed with code {process.returncode}"
-            return {"success": False, "error": error_message, "output": stdout_str}
-            
-    except asyncio.TimeoutError:
-        return {"success": False, "error": f"Command timed out after {timeout} seconds"}
-    except Exception as e:
-        return {"success": False, "error": str(e)}
+        try:
+            self.db.execute("ALTER TABLE rental_timers ADD COLUMN claimed_until REAL NOT NULL DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass  # Already there
+        self.db.commit()
+
+    def open(self):
+        """Opens the journal and loads the pending deadlines. Every worker does this."""
+        self._open()
+        self._reload()
+        if self.pending:
+            print(f"⏰ Restored {len(self.pending)} pending rental timeout(s) from {self.db_path}")
+
+    def start(self):
+        """Starts the scheduler loop (on the leader only)."""
+        if self.runner is None or self.runner.done():
+            self._reload()
+            self.runner = asyncio.create_task(self._run())
+
+    async def stop_runner(self):
+        if self.runner is not None:
+            self.runner.cancel()
+            await asyncio.gather(self.runner, return_exceptions=True)
+            self.runner = None
+
+    async def stop(self):
+        if self.runner is not None:
+            self.runner.cancel()
+            await asyncio.gather(self.runner, *self.firing, return_exceptions=True)
+        if self.db is not None:
+            self.db.close()
+
+    def _reload(self):
+        self.pending.clear()
+        self.heap.clear()
+        rows = self.db.execute("SELECT rental_id, tv_ip, deadline, claimed_until FROM rental_timers").fetchall()
+        for rental_id, tv_ip, deadline, claimed_until in rows:
+            self._push(rental_id, tv_ip, deadline, claimed_until)
+        self.data_version = self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _sync(self):
+        """Reloads the journal if another worker has changed it since it was last read."""
+        if self.db.execute("PRAGMA data_version").fetchone()[0] != self.data_version:
+            self._reload()
+
+    def _push(self, rental_id: int, tv_ip: str, deadline: float, claimed_until: float = 0):
+        version = next(self.versions)
+        self.pending[rental_id] = {"tv_ip": tv_ip, "deadline": deadline, "version": version}
+        # A row claimed by another worker is only due again once that claim has run out.
+        heapq.heappush(self.heap, (max(deadline, claimed_until), version, rental_id, "timeout"))
+        prewarm_at = deadline - RENTAL_PREWARM_SECONDS
+        if RENTAL_PREWARM_SECONDS > 0 and not claimed_until and prewarm_at > time.time():
+            heapq.heappush(self.heap, (prewarm_at, version, rental_id, "prewarm"))
+        self.wakeup.set()
 
-async def execute_command_sequence(tv_ip: str, commands: List[str]):
-    if tv_ip == '192.168.1.99':
-        return {"success": True, "message": "Test TV command sequence simulated."}
-    """Executes a sequence of ADB shell commands (e.g., for HDMI switching)."""
-    for command in commands:
-        if command.startswith("sleep"):
-            await asyncio.sleep(int(command.split(" ")[1]))
+    def _journal(self, rental_id: int, tv_ip: str, deadline: float):
+        self.db.execute(
+            "INSERT OR REPLACE INTO rental_timers (rental_id, tv_ip, deadline, claimed_until) VALUES (?, ?, ?, 0)",
+            (rental_id, tv_ip, deadline))
+        self.db.commit()
+
+    def _forget(self, rental_id: int, deadline: Optional[float] = None):
+        if deadline is None:
+            self.db.execute("DELETE FROM rental_timers WHERE rental_id = ?", (rental_id,))
         else:
-            result = await execute_adb_command(f'-s {tv_ip}:5555 shell {command}')
-            if not result["success"]:
-                return result  # Stop and return on the first error
-    return {"success": True}
+            self.db.execute("DELETE FROM rental_timers WHERE rental_id = ? AND deadline = ?", (rental_id, deadline))
+        self.db.commit()
 
-# // NEW: This is the internal logic for the /get-hdmi-status endpoint
-async def get_hdmi_status_internal(tv_ip: str) -> Dict[str, Any]:
-    config = get_tv_config(tv_ip)
-    status_map = config.get("hdmi_status_map", {})
+    def _claim(self, rental_id: int, deadline: float) -> bool:
+        """Marks a due timeout as being fired by this worker. False if it changed or is claimed elsewhere."""
+        now = time.time()
+        cursor = self.db.execute(
+            "UPDATE rental_timers SET claimed_until = ? WHERE rental_id = ? AND deadline = ? AND claimed_until < ?",
+            (now + TIMER_CLAIM_TTL, rental_id, deadline, now))
+        self.db.commit()
+        return cursor.rowcount == 1
 
-    command = f'-s {tv_ip}:5555 shell "dumpsys window windows | grep mCurrentFocus"'
-    result = await execute_adb_command(command)
+    def schedule(self, rental_id: int, tv_ip: str, timeout_seconds: float) -> float:
+        """Schedules (or reschedules) a rental's timeout and returns its deadline."""
+        deadline = time.time() + timeout_seconds
+        self._journal(rental_id, tv_ip, deadline)
+        self._push(rental_id, tv_ip, deadline)
+        return deadline
 
-    if not result["success"]:
-        return {"success": False, "error": result.get("error")}
+    def extend(self, rental_id: int, extra_seconds: float) -> Optional[float]:
+        """Moves a pending timeout by extra_seconds and returns the new deadline, or None if not pending."""
+        self._sync()
+        entry = self.pending.get(rental_id)
+        if entry is None:
+            return None
+        deadline = entry["deadline"] + extra_seconds
+        self._journal(rental_id, entry["tv_ip"], deadline)
+        self._push(rental_id, entry["tv_ip"], deadline)
+        return deadline
 
-    raw_output = result.get("output", "")
-    match = re.search(r'\{[^{}]+\s([^\s/]+/[^}\s]+)\}', raw_output)
+    def cancel(self, rental_id: int) -> bool:
+        """Cancels a pending timeout. Returns False if there was none."""
+        self._sync()
+        if self.pending.pop(rental_id, None) is None:
+            return False
+        self._forget(rental_id)
+        return True
 
-    if match:
-        focused_component = match.group(1)
-        status = status_map.get(focused_component, "Unknown")
-        return {"success": True, "hdmi_status": status}
-    else:
-        return {"success": True, "hdmi_status": "home_or_other"}
+    def get(self, rental_id: int) -> Optional[Dict[str, Any]]:
+        self._sync()
+        return self.pending.get(rental_id)
+
+    def entries(self) -> Dict[int, Dict[str, Any]]:
+        """All pending timeouts, as journalled by every worker."""
+        self._sync()
+        return self.pending
+
+    def rentals_on(self, tv_ip: str) -> List[int]:
+        """The rentals with a pending timeout on a TV."""
+        return [rental_id for rental_id, entry in self.entries().items() if entry["tv_ip"] == tv_ip]
+
+    async def _run(self):
+        while True:
+            self._sync()
+            # Drop cancelled or superseded entries from the top of the heap.
+            while self.heap:
+                due, version, rental_id, _ = self.heap[0]
+                entry = self.pending.get(rental_id)
+                if entry is not None and entry["version"] == version:
+                    break
+                heapq.heappop(self.heap)
+
+            # With other workers writing to the journal, wake up regularly to pick up their changes.
+            self.wakeup.clear()
+            delay = self.heap[0][0] - time.time() if self.heap else None
+            if delay is None or delay > 0:
+                if shared_state.sync_interval is not None:
+                    delay = shared_state.sync_interval if delay is None else min(delay, shared_state.sync_interval)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            due, version, rental_id, kind = heapq.heappop(self.heap)
+            if kind == "prewarm":
+                entry = self.pending[rental_id]
+                task = asyncio.create_task(self._prewarm(rental_id, entry["tv_ip"], entry["deadline"]))
+            else:
+                entry = self.pending.pop(rental_id)
+                if not self._claim(rental_id, entry["deadline"]):
+                    continue
+                task = asyncio.create_task(self._fire(rental_id, entry["tv_ip"], entry["deadline"]))
+            self.firing.add(task)
+            task.add_done_callback(self.firing.discard)
+
+    async def _prewarm(self, rental_id: int, tv_ip: str, deadline: float):
+        try:
+            await prewarm_rental(rental_id, tv_ip, deadline)
+        except Exception as e:
+            print(f"❌ Error while pre-warming {tv_ip} for rental {rental_id}: {e}")
+
+    async def _fire(self, rental_id: int, tv_ip: str, deadline: float):
+        try:
+            await fire_rental_timeout(rental_id, tv_ip, deadline)
+        except Exception as e:
+            print(f"❌ Error in timeout monitor for rental {rental_id}: {e}")
+        finally:
+            # Only forget the journal entry once the timeout has been handled (and not rescheduled meanwhile).
+            self._forget(rental_id, deadline)
+
+rental_timers = RentalTimerScheduler(RENTAL_TIMER_DB)
+
+register_metric(Gauge(
+    "rental_timers_pending", "Rental timeouts waiting to fire.",
+    collect=lambda: {(): len(rental_timers.entries())}))
+
+@app.get("/events")
+async def fleet_events_stream(request: Request):
+    """SSE endpoint streaming the events of every rental and TV, for the cashier dashboard."""
+    return event_stream_response(EventBroker.FLEET_TOPIC, parse_last_event_id(request), {"topic": "fleet"})
+
+@app.get("/events/{rental_id}")
+async def rental_events_stream(rental_id: int, request: Request):
+    """SSE endpoint to stream real-time events for a specific rental. Any number of clients may connect."""
+    return event_stream_response(f"rental:{rental_id}", parse_last_event_id(request), {"rental_id": rental_id})
 
 # ==============================================================================
-# --- RENTAL MONITORING & SSE (Server-Sent Events) ---
+# --- ASYNCHRONOUS JOBS ---
 # ==============================================================================
 
-async def send_sse_message(event_type: str, data: dict):
-    """Formats data into a Server-Sent Event message string."""
-    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+# `?async=true` on a slow endpoint: answer with a job id instead of waiting for the TV
+AsyncMode = Annotated[bool, Query(alias="async", description="Run in the background and return a job id right away.")]
 
-async def monitor_rental_timeout(rental_id: int, tv_ip: str, timeout_seconds: int):
-    """A background task that waits for the rental duration and then plays the timeout video."""
-    try:
-        print(f"⏰ Starting timeout monitor for rental {rental_id} ({tv_ip}) for {timeout_seconds}s")
-        await asyncio.sleep(timeout_seconds)
-        
-        if rental_id in timeout_tasks:  # Check if the task wasn't cancelled
-            print(f"🎬 Timeout reached for rental {rental_id}. Playing video.")
-            result = await play_timeout_video_internal(tv_ip, rental_id)
-            if rental_id in active_rental_monitors:
-                await active_rental_monitors[rental_id].put({
-                    "type": "timeout_triggered",
-                    "success": result["success"],
-                    "errors": result.get("errors")
-                })
+JOB_FINISHED_EVENTS = ("job_succeeded", "job_failed")
 
-    except asyncio.CancelledError:
-        print(f"✅ Timeout monitor for rental {rental_id} was successfully cancelled.")
-    except Exception as e:
-        print(f"❌ Error in timeout monitor for rental {rental_id}: {e}")
+class JobTable:
+    """
+    Status of recent jobs by id, kept up to date from the jobs' own events so that any worker
+    can answer /jobs/{id}. Running jobs are always kept; finished jobs expire after JOB_RESULT_TTL
+    and the oldest finished ones are dropped first when the table is full.
+    """
 
-@app.get("/events/{rental_id}")
-async def rental_events_stream(rental_id: int):
-    """SSE endpoint to stream real-time events for a specific rental."""
-    async def event_generator():
-        queue = asyncio.Queue()
-        active_rental_monitors[rental_id] = queue
-        try:
-            yield await send_sse_message("connected", {"rental_id": rental_id})
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        self.finished: OrderedDict = OrderedDict()  # job_id -> monotonic time it finished
+
+    def apply(self, topic: str, event_type: str, data: Dict[str, Any]):
+        if not topic.startswith("job:"):
+            return
+        job = self.jobs.get(data["job_id"])
+        if job is not None and job["revision"] >= data["revision"]:
+            return  # An older update arriving late from the shared event table
+        self.jobs[data["job_id"]] = data
+        if event_type in JOB_FINISHED_EVENTS:
+            self.finished[data["job_id"]] = time.monotonic()
+        self.expire()
+
+    def expire(self):
+        cutoff = time.monotonic() - JOB_RESULT_TTL
+        while self.finished:
+            job_id, finished_at = next(iter(self.finished.items()))
+            if finished_at > cutoff and len(self.jobs) <= self.max_entries:
+                break
+            del self.finished[job_id]
+            self.jobs.pop(job_id, None)
+            event_broker.forget(f"job:{job_id}")
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        self.expire()
+        return self.jobs.get(job_id)
+
+    def count_by_status(self) -> Dict[tuple, float]:
+        counts: Dict[tuple, float] = {}
+        for job in self.jobs.values():
+            counts[(job["status"],)] = counts.get((job["status"],), 0) + 1
+        return counts
+
+class JobRunner:
+    """Runs submitted operations on a bounded pool of workers and publishes each status change."""
+
+    def __init__(self, workers: int, queue_size: int):
+        self.worker_count = workers
+        self.queue_size = queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.workers: List[asyncio.Task] = []
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.workers = [asyncio.create_task(self._work()) for _ in range(self.worker_count)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, operation: str, tv_ip: Optional[str], run: Callable[[], Awaitable[Any]]) -> JSONResponse:
+        """Queues an operation and returns the 202 response with its job id."""
+        if self.queue is None or self.queue.full():
+            raise HTTPException(status_code=503, detail="Too many jobs are waiting, try again later.")
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "operation": operation,
+            "tv_ip": tv_ip,
+            "status": "queued",
+            "queued_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+            "revision": 0,
+        }
+        self._update(job)
+        self.queue.put_nowait((job, run))
+        print(f"🧾 Job {job['job_id']} queued: {operation} {tv_ip or ''}".rstrip())
+        return JSONResponse(status_code=202, content={
+            "success": True,
+            "message": f"{operation} is running in the background.",
+            "job_id": job["job_id"],
+            "status_url": f"/jobs/{job['job_id']}",
+            "events_url": f"/jobs/{job['job_id']}/events",
+        })
+
+    def _update(self, job: Dict[str, Any], **changes):
+        job = {**job, **changes, "revision": job["revision"] + 1}
+        job["type"] = f"job_{job['status']}"
+        # Record it here first, so this worker answers /jobs/{id} even before the event comes back
+        job_table.apply(f"job:{job['job_id']}", job["type"], job)
+        event_broker.publish(f"job:{job['job_id']}", job["type"], job)
+        return job
+
+    async def _work(self):
+        while True:
+            job, run = await self.queue.get()
+            job = self._update(job, status="running", started_at=time.time())
+            try:
+                result = await run()
+                if isinstance(result, BaseModel):
+                    result = result.model_dump()
+                ok = not isinstance(result, dict) or result.get("success", True) is not False
+                job = self._update(job, status="succeeded" if ok else "failed", finished_at=time.time(), result=result,
+                                   error=None if ok else result.get("error"))
+            except Exception as e:
+                job = self._update(job, status="failed", finished_at=time.time(), error=str(e))
+            jobs_finished.inc(job["operation"], job["status"])
+            job_seconds.observe(job["finished_at"] - job["queued_at"], job["operation"])
+            print(f"🧾 Job {job['job_id']} {job['status']}: {job['operation']} {job['tv_ip'] or ''}".rstrip())
+
+job_table = JobTable(JOB_TABLE_SIZE)
+job_runner = JobRunner(JOB_WORKERS, JOB_QUEUE_SIZE)
+event_broker.listeners.append(job_table.apply)
+
+jobs_finished = register_metric(Counter(
+    "jobs_finished_total", "Background jobs that finished, by operation and status.", ("operation", "status")))
+job_seconds = register_metric(Histogram(
+    "job_duration_seconds", "Time from queueing a background job to its end.", ("operation",), LATENCY_BUCKETS))
+register_metric(Gauge(
+    "jobs", "Jobs in the job table, by status.", ("status",), collect=job_table.count_by_status))
+register_metric(Gauge(
+    "jobs_waiting", "Jobs queued for a free job worker.",
+    collect=lambda: {(): job_runner.queue.qsize() if job_runner.queue is not None else 0}))
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Returns the status of a background job, and its result once it has finished."""
+    job = job_table.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found or expired.")
+    return job
+
+@app.get("/jobs/{job_id}/events")
+async def job_events_stream(job_id: str, request: Request):
+    """SSE stream of one job's status changes; it ends when the job has finished."""
+    job = job_table.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found or expired.")
+    # Without a Last-Event-ID the job's few events are replayed, so none is missed after the lookup
+    last_event_id = parse_last_event_id(request)
+    return event_stream_response(f"job:{job_id}", last_event_id or 0, job, JOB_FINISHED_EVENTS)
+
+# ==============================================================================
+# --- TIMEOUT VIDEO SYNC ---
+# ==============================================================================
+
+class VideoFingerprint(NamedTuple):
+    size: int
+    mtime: int  # Whole seconds, as `stat -c %Y` reports them on the TV
+    md5: str
+
+class VideoCheck(NamedTuple):
+    state: str                 # current, stale, missing, syncing, failed or offline
+    path: str
+    master_md5: Optional[str]  # The master copy the TV's copy was compared with
+    checked_at: float
+    detail: Optional[str]
+
+def fingerprint_file(path: str) -> VideoFingerprint:
+    digest = hashlib.md5()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1024 * 1024), b""):
+            digest.update(block)
+    stat = os.stat(path)
+    return VideoFingerprint(stat.st_size, int(stat.st_mtime), digest.hexdigest())
+
+class TokenBucket:
+    """A shared bytes-per-second budget; take(n) waits until n more bytes may be sent. Waiters are served in order."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def take(self, amount: int):
+        if self.rate <= 0:
+            return
+        async with self.lock:
             while True:
-                event_data = await queue.get()
-                yield await send_sse_message(event_data.get('type', 'message'), event_data)
-        except asyncio.CancelledError:
-            print(f"Client for rental {rental_id} disconnected.")
-        finally:
-            # Cleanup when the client disconnects
-            if rental_id in active_rental_monitors:
-                del active_rental_monitors[rental_id]
-            if rental_id in timeout_tasks:
-                timeout_tasks[rental_id].cancel()
-                del timeout_tasks[rental_id]
+                now = time.monotonic()
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+class VideoSync:
+    """
+    Keeps every TV's timeout video equal to TIMEOUT_VIDEO_SOURCE.
+    `checks` is the verification cache: the outcome of the last check or push per TV, which the
+    playback path looks up in O(1). A TV has at most one check-and-push running at a time, and
+    a push goes to "<video_path>.part" first and is then moved into place on the TV's queue,
+    so a timeout video never plays a half-written file.
+    """
+
+    TOPIC = "video-sync"
+
+    def __init__(self, concurrency: int, bandwidth: float):
+        self.pushes = asyncio.Semaphore(concurrency)
+        self.bandwidth = TokenBucket(bandwidth)
+        self.checks: Dict[str, VideoCheck] = {}
+        self.running: Dict[str, asyncio.Task] = {}
+        self.master: Optional[VideoFingerprint] = None
+        self.master_stat: Optional[tuple] = None
+
+    async def read_master(self) -> VideoFingerprint:
+        """Fingerprints the master copy; its md5 is only recomputed when the file changes. Raises OSError."""
+        stat = os.stat(TIMEOUT_VIDEO_SOURCE)
+        if (stat.st_size, stat.st_mtime_ns) != self.master_stat:
+            self.master = await asyncio.to_thread(fingerprint_file, TIMEOUT_VIDEO_SOURCE)
+            self.master_stat = (stat.st_size, stat.st_mtime_ns)
+        return self.master
+
+    def status(self, tv_ip: str) -> Optional[str]:
+        """The TV's video state from the verification cache, or None if it was never checked."""
+        check = self.checks.get(tv_ip)
+        if check is None:
+            return None
+        if check.state == "current" and self.master is not None and check.master_md5 != self.master.md5:
+            return "stale"  # The master copy has changed since
+        return check.state
+
+    def _record(self, tv_ip: str, state: str, path: str, detail: Optional[str] = None):
+        self.checks[tv_ip] = VideoCheck(state, path, self.master.md5 if self.master else None, time.time(), detail)
+
+    def _publish(self, event_type: str, data: Dict[str, Any]):
+        event_broker.publish(self.TOPIC, event_type, {"type": event_type, **data})
+
+    async def sync_fleet(self, tv_ips: List[str], force: bool = False) -> Dict[str, Any]:
+        """Checks (and where needed pushes to) every given TV and returns the per-TV outcomes."""
+        try:
+            master = await self.read_master()
+        except OSError as e:
+            return {"success": False, "error": f"Cannot read the master video {TIMEOUT_VIDEO_SOURCE}: {e}"}
+        started = time.monotonic()
+        print(f"📼 Syncing the timeout video ({master.size} bytes, md5 {master.md5}) to {len(tv_ips)} TVs")
+        self._publish("sync_started", {"tvs": len(tv_ips), "size": master.size, "md5": master.md5, "force": force})
+        results = await asyncio.gather(*(self.sync_tv(tv_ip, force) for tv_ip in tv_ips))
+        summary: Dict[str, int] = {}
+        for result in results:
+            summary[result["result"]] = summary.get(result["result"], 0) + 1
+        failed = summary.get("failed", 0) + summary.get("offline", 0)
+        self._publish("sync_finished", {"summary": summary, "duration_ms": round((time.monotonic() - started) * 1000)})
+        print(f"📼 Timeout video sync finished: {summary}")
+        return {
+            "success": failed == 0,
+            "message": f"{summary.get('pushed', 0)} pushed, {summary.get('current', 0)} already current, {failed} failed.",
+            "error": f"{failed} TVs could not be synced." if failed else None,
+            "md5": master.md5,
+            "summary": summary,
+            "results": results,
+        }
+
+    def sync_tv(self, tv_ip: str, force: bool = False) -> Awaitable[Dict[str, Any]]:
+        """Starts the TV's check-and-push at background priority, or joins the one already running."""
+        return asyncio.shield(self._start(tv_ip, force))
+
+    def sync_tv_in_background(self, tv_ip: str):
+        """Like sync_tv, for callers that do not wait: the outcome is only recorded and published."""
+        self._start(tv_ip, False)
+
+    def _start(self, tv_ip: str, force: bool) -> asyncio.Task:
+        task = self.running.get(tv_ip)
+        if task is None:
+            with adb_priority(PRIORITY_BACKGROUND):
+                context = copy_context()
+            # Started from a job on the TV's actor (playback), the task would inherit that actor and run
+            # its commands inline beside the queue; outside any actor they are queued like everything else.
+            context.run(current_device_actor.set, None)
+            task = context.run(asyncio.create_task, self._sync_tv(tv_ip, force))
+            self.running[tv_ip] = task
+            task.add_done_callback(lambda _: self._settle(tv_ip, task))
+        return task
+
+    def _settle(self, tv_ip: str, task: asyncio.Task):
+        self.running.pop(tv_ip, None)
+        if not task.cancelled() and task.exception() is not None:
+            # Waiting callers get the error through their shield; background syncs have nobody else to report it
+            print(f"❌ Timeout video sync on {tv_ip} failed: {task.exception()}")
+
+    async def _sync_tv(self, tv_ip: str, force: bool) -> Dict[str, Any]:
+        path = get_tv_config(tv_ip).video_path
+        try:
+            master = await self.read_master()
+        except OSError as e:
+            return {"tv_ip": tv_ip, "result": "failed", "error": f"Cannot read the master video: {e}"}
+        state, detail = ("stale", "forced") if force else await self.check(tv_ip, path, master)
+        self._record(tv_ip, state, path, detail)
+        self._publish("video_checked", {"tv_ip": tv_ip, "state": state, "detail": detail})
+        if state in ("current", "offline"):
+            result = {"tv_ip": tv_ip, "result": state, "detail": detail}
+        else:
+            result = await self.push(tv_ip, path, master)
+        video_syncs.inc(result["result"])
+        return result
+
+    async def check(self, tv_ip: str, path: str, master: VideoFingerprint) -> Tuple[str, str]:
+        """Compares the TV's copy with the master copy and returns (state, how that was decided)."""
+        quoted = shlex.quote(path)
+        result = await execute_shell_command(tv_ip, f"stat -c '%s %Y' {quoted}", timeout=VIDEO_SYNC_CHECK_TIMEOUT)
+        if not result["success"]:
+            error = result.get("error") or ""
+            return ("missing", "not on the TV") if "No such file" in error else ("offline", error)
+        try:
+            size, mtime = (int(value) for value in result["output"].split()[:2])
+        except ValueError:
+            size, mtime = -1, -1
+        if size != master.size:
+            return "stale", f"{size} bytes instead of {master.size}"
+        if mtime == master.mtime:
+            return "current", "size and mtime match"
+        result = await execute_shell_command(tv_ip, f"md5sum {quoted}", timeout=VIDEO_SYNC_CHECK_TIMEOUT)
+        md5 = result.get("output", "").split()[0] if result["success"] and result.get("output") else None
+        if md5 == master.md5:
+            return "current", "md5 matches"
+        return "stale", "md5 differs" if md5 else f"md5sum failed: {result.get('error')}"
+
+    async def push(self, tv_ip: str, path: str, master: VideoFingerprint) -> Dict[str, Any]:
+        partial = f"{path}.part"
+        self._record(tv_ip, "syncing", path)
+        async with self.pushes:
+            started = time.monotonic()
+            print(f"📼 Pushing the timeout video to {tv_ip}:{path}")
+            self._publish("push_started", {"tv_ip": tv_ip, "path": path, "size": master.size})
+            error = await self._send(tv_ip, partial, master)
+        if error is None:
+            result = await execute_shell_command(tv_ip, f"mv -f {shlex.quote(partial)} {shlex.quote(path)}", timeout=VIDEO_SYNC_CHECK_TIMEOUT)
+            error = None if result["success"] else f"Could not move the pushed video into place: {result.get('error')}"
+        if error is None:
+            state, detail = await self.check(tv_ip, path, master)
+            error = None if state == "current" else f"Pushed, but the TV's copy is still {state} ({detail})"
+        seconds = time.monotonic() - started
+        self._record(tv_ip, "current" if error is None else "failed", path, error or "pushed")
+        outcome = {
+            "tv_ip": tv_ip,
+            "result": "pushed" if error is None else "failed",
+            "error": error,
+            "duration_ms": round(seconds * 1000),
+            "bytes_per_second": round(master.size / seconds) if error is None and seconds > 0 else None,
+        }
+        self._publish("push_finished", outcome)
+        print(f"{'✅' if error is None else '❌'} Timeout video push to {tv_ip}: {error or 'done'} in {seconds:.1f}s")
+        return outcome
+
+    async def _send(self, tv_ip: str, remote_path: str, master: VideoFingerprint) -> Optional[str]:
+        """Copies the master file to the TV and returns an error message, or None on success."""
+        if ADB_TRANSPORT == "wire":
+            try:
+                await asyncio.wait_for(adb_wire_client.push(
+                    f"{tv_ip}:5555", remote_path, 0o100644, master.mtime, self._read_chunks(tv_ip, master)), timeout=VIDEO_SYNC_TIMEOUT)
+                return None
+            except asyncio.TimeoutError:
+                return f"Push timed out after {VIDEO_SYNC_TIMEOUT} seconds"
+            except (AdbWireError, OSError) as e:
+                return str(e)
+
+        try:
+            # adb push keeps the local mtime, so the next check can tell by stat that the copy is current
+            process = await asyncio.create_subprocess_exec(
+                ADB_PATH, "-s", f"{tv_ip}:5555", "push", TIMEOUT_VIDEO_SOURCE, remote_path,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            result = await collect_process_output(process, VIDEO_SYNC_TIMEOUT)
+        except Exception as e:
+            return str(e)
+        if result["success"]:
+            video_sync_bytes.inc(amount=master.size)
+        return None if result["success"] else result.get("error")
+
+    async def _read_chunks(self, tv_ip: str, master: VideoFingerprint):
+        """Reads the master file in sync-protocol chunks within the bandwidth budget, reporting progress about once a second."""
+        sent, reported = 0, time.monotonic()
+        with open(TIMEOUT_VIDEO_SOURCE, "rb") as source:
+            while chunk := source.read(AdbWireClient.SYNC_DATA_MAX):
+                await self.bandwidth.take(len(chunk))
+                yield chunk
+                sent += len(chunk)
+                video_sync_bytes.inc(amount=len(chunk))
+                if time.monotonic() - reported >= 1:
+                    reported = time.monotonic()
+                    self._publish("push_progress", {"tv_ip": tv_ip, "sent": sent, "size": master.size,
+                                                    "percent": round(100 * sent / master.size, 1) if master.size else 100.0})
+
+    def count_by_state(self) -> Dict[tuple, float]:
+        counts: Dict[tuple, float] = {}
+        for tv_ip in self.checks:
+            state = (self.status(tv_ip),)
+            counts[state] = counts.get(state, 0) + 1
+        return counts
+
+video_sync = VideoSync(VIDEO_SYNC_CONCURRENCY, VIDEO_SYNC_BANDWIDTH)
+
+video_sync_bytes = register_metric(Counter(
+    "video_sync_bytes_total", "Bytes of the timeout video pushed to TVs."))
+video_syncs = register_metric(Counter(
+    "video_syncs_total", "Per-TV timeout video syncs, by outcome (current, pushed, failed, offline).", ("result",)))
+register_metric(Gauge(
+    "timeout_videos", "TVs by the state of their timeout video at the last check.", ("state",), collect=video_sync.count_by_state))
+
+@app.post("/sync-timeout-video")
+async def sync_timeout_video(request: VideoSyncRequest):
+    """
+    Checks each TV's timeout video against TIMEOUT_VIDEO_SOURCE and pushes it where it differs.
+    Always runs as a background job (a push can take minutes); progress is streamed on /timeout-video/events.
+    """
+    tv_ips = request.tv_ips or list(ALL_TV_IPS)
+    return job_runner.submit("sync-timeout-video", None, lambda: video_sync.sync_fleet(tv_ips, request.force))
+
+@app.get("/timeout-video")
+async def get_timeout_video_status():
+    """The master copy's fingerprint and the verification cache: each TV's video state at its last check."""
+    master = video_sync.master
+    return {
+        "success": True,
+        "source": TIMEOUT_VIDEO_SOURCE,
+        "master": master._asdict() if master is not None else None,
+        "tvs": {
+            tv_ip: {**check._asdict(), "state": video_sync.status(tv_ip), "syncing": tv_ip in video_sync.running}
+            for tv_ip, check in video_sync.checks.items()
+        },
+    }
 
-    return StreamingResponse(event_generator(), media_type="text/event-stream")
+@app.get("/timeout-video/events")
+async def video_sync_events_stream(request: Request):
+    """SSE stream of timeout video checks and push progress."""
+    return event_stream_response(VideoSync.TOPIC, parse_last_event_id(request), {"topic": VideoSync.TOPIC})
 
 # ==============================================================================
 # --- API ENDPOINTS ---
@@ -416,14 +3753,38 @@ async def health_check():
         "status": "ADB Server is running",
         "timestamp": datetime.now().isoformat(),
         "adb_path": ADB_PATH,
-        "configured_tvs": list(TV_CONFIGS.keys())
+        "configured_tvs": list(tv_registry.tvs)
+    }
+
+@app.get("/tv-profiles")
+async def get_tv_profiles():
+    """Shows which profile every TV uses, and when the profile file was loaded."""
+    return {
+        "source": tv_registry.source,
+        "loaded_at": datetime.fromtimestamp(tv_registry.loaded_at).isoformat(),
+        "default_profile": tv_registry.default.name,
+        "profiles": list(tv_registry.profiles),
+        "tvs": {tv_ip: profile.name for tv_ip, profile in tv_registry.tvs.items()}
     }
 
+@app.post("/reload-config")
+async def reload_config():
+    """Reloads tv-profiles.json without a restart. Running rental monitors, command queues and sessions carry on."""
+    return await reload_tv_profiles()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Exposes ADB latency histograms, failure counters and queue gauges in Prometheus text format."""
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
 @app.get("/test-adb")
 async def test_adb_installation():
     """Tests the ADB installation and lists currently connected devices."""
-    version_result = await execute_adb_command('version')
-    devices_result = await execute_adb_command('devices')
+    version_result = await execute_host_command('version')
+    devices_result = await execute_host_command('devices')
     return {
         "success": version_result["success"] and devices_result["success"],
         "adb_version": version_result.get("output"),
@@ -434,7 +3795,7 @@ async def test_adb_installation():
 @app.get("/devices", response_model=DevicesResponse)
 async def get_devices():
     """Gets a list of currently connected ADB devices."""
-    result = await execute_adb_command('devices')
+    result = await query_cache.get("devices", None, lambda: execute_host_command('devices'))
     return DevicesResponse(
         success=result["success"],
         devices=result.get("output"),
@@ -443,9 +3804,9 @@ async def get_devices():
 
 @app.post("/connect-tv", response_model=BaseResponse)
 async def connect_to_tv(request: TVRequest):
-    """Establishes an ADB connection to a TV."""
-    result = await execute_adb_command(f"connect {request.tv_ip}:5555", timeout=15)
-    if "connected" in result.get("output", "") or "already connected" in result.get("output", ""):
+    """Establishes an ADB connection to a TV, right away even if the TV is backing off."""
+    result = await connection_supervisor.reconnect(request.tv_ip, force=True)
+    if result["success"]:
         return BaseResponse(success=True, message=f"Successfully connected to {request.tv_ip}")
     else:
         return BaseResponse(success=False, error=result.get("error", "Connection failed"))
@@ -457,7 +3818,8 @@ async def restart_adb_server():
     await asyncio.sleep(2)
     await execute_adb_command('start-server')
     await asyncio.sleep(2)
-    result = await execute_adb_command('devices')
+    query_cache.clear()
+    result = await execute_host_command('devices')
     return DevicesResponse(
         success=result["success"],
         devices=result.get("output"),
@@ -465,12 +3827,11 @@ async def restart_adb_server():
     )
 
 @app.post("/switch-to-hdmi2", response_model=BaseResponse)
-async def switch_tv_to_hdmi2(request: TVRequest):
+async def switch_tv_to_hdmi2(request: TVRequest, run_async: AsyncMode = False):
     """Switches the TV to the configured HDMI input at the start of a rental."""
-    if request.tv_ip == '192.168.1.99':
-        return BaseResponse(success=True, message="Test TV switched to HDMI input (simulated).")
-    config = get_tv_config(request.tv_ip)
-    result = await execute_command_sequence(request.tv_ip, config["hdmi_switch_commands"])
+    if run_async:
+        return job_runner.submit("switch-to-hdmi2", request.tv_ip, lambda: switch_tv_to_hdmi2(request))
+    result = await run_hdmi_switch(request.tv_ip, get_tv_config(request.tv_ip).hdmi_switch_plan)
     if not result["success"]:
         return BaseResponse(success=False, error=f"Failed to switch HDMI: {result.get('error')}")
     return BaseResponse(success=True, message=f"TV {request.tv_ip} switched to HDMI input.")
@@ -478,54 +3839,99 @@ async def switch_tv_to_hdmi2(request: TVRequest):
 async def play_timeout_video_internal(tv_ip: str, rental_id: int):
     """
     Internal logic for playing the timeout video, used by monitor and manual trigger.
-    This version is more robust to prevent common playback failures.
-    """
-     # // EDIT: Add bypass for the Test TV
-    if tv_ip == '192.168.1.99':
-        print(f"🎬 Simulated timeout video for rental {rental_id} on Test TV.")
-        return {"success": True, "errors": []}
-    config = get_tv_config(tv_ip)
-    video_path = config["video_path"]
-    vlc_package = "org.videolan.vlc"
-
-    # 1. (NEW) Force stop the media player to clear any bad state.
-    print(f"🎬 Resetting state for {tv_ip}: Forcing stop on {vlc_package}")
-    await execute_adb_command(f"-s {tv_ip}:5555 shell am force-stop {vlc_package}")
-    await asyncio.sleep(1)
-
-    # 2. Go to the Home screen to ensure a clean start (this was already here).
-    print(f"🎬 Resetting state for {tv_ip}: Sending HOME keyevent")
-    await execute_adb_command(f"-s {tv_ip}:5555 shell input keyevent 3")
-    await asyncio.sleep(2)
+    Stages: probe (what is on screen), reset (only if VLC is already in the foreground),
+    launch, and confirm (poll the focused window until VLC shows up). Every stage respects
+    the PLAYBACK_DEADLINE, and the per-stage timings are returned and published on the
+    rental's SSE stream.
+    """
+    profile = get_tv_config(tv_ip)
 
-    # 3. Attempt to play the video using the configured commands.
-    success = False
-    errors = []
-    for command_template in config["play_video_commands"]:
-        command = f'-s {tv_ip}:5555 shell {command_template.format(video_path=video_path)}'
-        result = await execute_adb_command(command, timeout=15)
-        if result["success"]:
-            # 4. (NEW) Optional but recommended: Check if VLC is now the focused app.
-            await asyncio.sleep(2) # Give time for the app to launch
-            check_result = await execute_adb_command(f"-s {tv_ip}:5555 shell dumpsys activity | findstr mFocusedActivity")
-            if vlc_package in check_result.get("output", ""):
+    def is_vlc(focus: Optional[str]) -> bool:
+        return bool(focus) and focus.startswith(VLC_PACKAGE + "/")
+
+    # Run the whole playback on the TV's queue so no other command can interleave with it.
+    async def run_playback():
+        started = time.monotonic()
+        deadline = started + PLAYBACK_DEADLINE
+        stages: Dict[str, int] = {}
+        errors = []
+
+        def remaining() -> float:
+            return deadline - time.monotonic()
+
+        def finish_stage(name: str, stage_started: float):
+            stages[f"{name}_ms"] = round((time.monotonic() - stage_started) * 1000)
+
+        # 0. The verification cache says (without a round-trip) whether the video is there and current.
+        video = video_sync.status(tv_ip)
+        if video in ("missing", "stale", "failed"):
+            print(f"⚠️ The timeout video on {tv_ip} was {video} at its last sync check.")
+
+        # 1. Probe: a stale or stuck VLC needs a reset, anything else can be launched over directly.
+        stage_started = time.monotonic()
+        probe = await read_focused_component(tv_ip)
+        finish_stage("probe", stage_started)
+        fast_path = not (probe["success"] and is_vlc(probe["focused_app"]))
+
+        # 2. Reset (slow path only): stop VLC and go HOME in one round-trip, then wait until VLC is gone.
+        if not fast_path:
+            stage_started = time.monotonic()
+            print(f"🎬 Resetting state for {tv_ip}: stopping {VLC_PACKAGE} and going HOME")
+            await execute_shell_command(tv_ip, f"am force-stop {VLC_PACKAGE}; input keyevent 3", timeout=max(1, int(remaining())))
+            await wait_for_focus(tv_ip, lambda focus: not is_vlc(focus), min(2, max(0, remaining())))
+            finish_stage("reset", stage_started)
+
+        # 3 + 4. Launch with each configured command until VLC is confirmed in the foreground.
+        success = False
+        for command in profile.play_video_commands:
+            if remaining() <= 0:
+                errors.append(f"Playback deadline of {PLAYBACK_DEADLINE}s exceeded.")
+                break
+            stage_started = time.monotonic()
+            result = await execute_shell_command(tv_ip, command, timeout=max(1, min(15, int(remaining()))))
+            finish_stage("launch", stage_started)
+            if not result["success"]:
+                errors.append(result.get("error", "Unknown error"))
+                continue
+
+            stage_started = time.monotonic()
+            _, confirmed, _ = await wait_for_focus(tv_ip, is_vlc, min(PLAYBACK_CONFIRM_TIMEOUT, max(0, remaining())))
+            finish_stage("confirm", stage_started)
+            if confirmed:
                 print(f"✅ Playback confirmed on {tv_ip}.")
                 success = True
-                break # Exit the loop on first success
-            else:
-                errors.append("Command sent, but playback could not be confirmed.")
-        else:
-            errors.append(result.get("error", "Unknown error"))
-    
-    return {"success": success, "errors": errors}
+                break
+            errors.append("Command sent, but playback could not be confirmed.")
+
+        stages["total_ms"] = round((time.monotonic() - started) * 1000)
+        for stage, milliseconds in stages.items():
+            playback_stage_seconds.observe(milliseconds / 1000, tv_ip, stage[:-len("_ms")])
+        print(f"🎬 Timeout video on {tv_ip}: {'ok' if success else 'failed'} in {stages['total_ms']}ms ({'fast' if fast_path else 'reset'} path)")
+        publish_rental_event(rental_id, "timeout_video", {
+            "tv_ip": tv_ip,
+            "success": success,
+            "fast_path": fast_path,
+            "stages": stages,
+            "errors": errors,
+            "video": video
+        })
+        if video in ("missing", "stale", "failed"):
+            video_sync.sync_tv_in_background(tv_ip)  # Repair it for the next rental
+        return {"success": success, "errors": errors, "fast_path": fast_path, "stages": stages, "video": video}
+
+    # A timeout video ends a rental, so it goes ahead of everything else queued for the TV and the fleet.
+    return await get_device_actor(tv_ip).submit(run_playback, PRIORITY_RENTAL_CRITICAL)
 
-@app.post("/play-timeout-video", response_model=BaseResponse)
-async def play_timeout_video_endpoint(request: PlayVideoRequest):
+@app.post("/play-timeout-video", response_model=PlaybackResponse)
+async def play_timeout_video_endpoint(request: PlayVideoRequest, run_async: AsyncMode = False):
     """API endpoint to manually trigger the timeout video for a rental."""
+    if run_async:
+        return job_runner.submit("play-timeout-video", request.tv_ip, lambda: play_timeout_video_endpoint(request))
     result = await play_timeout_video_internal(request.tv_ip, request.rental_id)
+    timing = {"fast_path": result.get("fast_path"), "stages": result.get("stages"), "video": result.get("video")}
     if not result["success"]:
-        return BaseResponse(success=False, error=f"Failed to play video: {'; '.join(result['errors'])}")
-    return BaseResponse(success=True, message=f"Timeout video started on {request.tv_ip}.")
+        return PlaybackResponse(success=False, error=f"Failed to play video: {'; '.join(result['errors'])}", **timing)
+    return PlaybackResponse(success=True, message=f"Timeout video started on {request.tv_ip}.", **timing)
 
 @app.post("/rental-timeout", response_model=BaseResponse)
 async def manual_rental_timeout(request: PlayVideoRequest):
@@ -539,9 +3945,6 @@ async def manual_rental_timeout(request: PlayVideoRequest):
 @app.post("/tv-control", response_model=BaseResponse)
 async def control_tv(request: TVControlRequest):
     """Controls basic TV functions like volume and power."""
-    # // EDIT: Add bypass for the Test TV
-    if request.tv_ip == '192.168.1.99':
-        return BaseResponse(success=True, message=f"Action '{request.action}' sent to Test TV (simulated).")
     key_map = {
         'volume_up': 'KEYCODE_VOLUME_UP',
         'volume_down': 'KEYCODE_VOLUME_DOWN',
@@ -551,7 +3954,7 @@ async def control_tv(request: TVControlRequest):
         return BaseResponse(success=False, error="Invalid action specified.")
 
     keycode = key_map[request.action]
-    result = await execute_adb_command(f"-s {request.tv_ip}:5555 shell input keyevent {keycode}")
+    result = await execute_shell_command(request.tv_ip, f"input keyevent {keycode}")
     
     if not result["success"]:
         return BaseResponse(success=False, error=f"Failed to execute '{request.action}': {result.get('error')}")
@@ -560,82 +3963,117 @@ async def control_tv(request: TVControlRequest):
 @app.post("/send-key", response_model=BaseResponse)
 async def send_key_event(request: SendKeyRequest):
     """Sends a raw keycode event to a TV."""
-    result = await execute_adb_command(f"-s {request.tv_ip}:5555 shell input keyevent {request.keycode}")
+    result = await execute_shell_command(request.tv_ip, f"input keyevent {request.keycode}")
     if not result["success"]:
         return BaseResponse(success=False, error=f"Failed to send keycode {request.keycode}: {result.get('error')}")
     return BaseResponse(success=True, message=f"Keycode {request.keycode} sent to {request.tv_ip}.")
 
 @app.post("/test-connection", response_model=BaseResponse)
-async def test_tv_connection(request: TVRequest):
-    # // EDIT: Add a special case to always show the test TV as online.
-    if request.tv_ip == '192.168.1.99':
-        return BaseResponse(success=True, message="Online (Test)")
-    """Checks if a TV is online and responsive via ADB."""
-    # A simple 'echo' command is a lightweight way to check for a response.
-    result = await execute_adb_command(f"-s {request.tv_ip}:5555 shell echo online", timeout=5)
-    if result.get("success") and "online" in result.get("output", ""):
-        return BaseResponse(success=True, message="TV is online and responsive.")
-    else:
-        # If the lightweight check fails, try a full reconnect.
-        connect_result = await connect_to_tv(request)
-        if connect_result.success:
-            return BaseResponse(success=True, message="TV was offline but reconnected successfully.")
+async def test_tv_connection(request: TVRequest, fresh: bool = False, run_async: AsyncMode = False):
+    """Checks if a TV is online and responsive via ADB. Answers from the fleet cache unless fresh=true."""
+    if run_async:
+        return job_runner.submit("test-connection", request.tv_ip, lambda: test_tv_connection(request, fresh))
+    state = get_device_state(request.tv_ip)
+    if not fresh and state.is_fresh("online"):
+        if state.get("online"):
+            return BaseResponse(success=True, message="TV is online and responsive.")
+        return BaseResponse(success=False, error="TV is offline.")
+
+    async def probe() -> BaseResponse:
+        # A simple 'echo' command is a lightweight way to check for a response.
+        result = await execute_shell_command(request.tv_ip, "echo online", timeout=5)
+        if result.get("success") and "online" in result.get("output", ""):
+            connection_supervisor.mark_online(request.tv_ip)
+            state.set("online", True)
+            return BaseResponse(success=True, message="TV is online and responsive.")
         else:
-            return BaseResponse(success=False, error=f"TV is offline. Connection attempt failed: {connect_result.error}")
+            # If the lightweight check fails, let the supervisor reconnect (or report its backoff).
+            connect_result = await connection_supervisor.reconnect(request.tv_ip)
+            state.set("online", connect_result["success"])
+            if connect_result["success"]:
+                return BaseResponse(success=True, message="TV was offline but reconnected successfully.")
+            else:
+                return BaseResponse(success=False, error=f"TV is {connect_result['error']}.")
+
+    return await query_cache.get("test_connection", request.tv_ip, probe)
 
 @app.post("/start-rental-monitor", response_model=BaseResponse)
 async def start_rental_monitor(request: RentalTimeoutRequest):
     """Starts the background timeout monitor for a new rental."""
-    # // EDIT: Add bypass for the Test TV
-    if request.tv_ip == '192.168.1.99':
-        print(f"⏰ Simulated monitor started for rental {request.rental_id} on Test TV.")
-        return BaseResponse(success=True, message=f"Monitor started for rental {request.rental_id} (simulated).")
-
     rental_id = request.rental_id
-    if rental_id in timeout_tasks:
-        timeout_tasks[rental_id].cancel()
-    
-    task = asyncio.create_task(
-        monitor_rental_timeout(rental_id, request.tv_ip, request.timeout_seconds)
-    )
-    timeout_tasks[rental_id] = task
+    rental_timers.schedule(rental_id, request.tv_ip, request.timeout_seconds)
+    print(f"⏰ Starting timeout monitor for rental {rental_id} ({request.tv_ip}) for {request.timeout_seconds}s")
     return BaseResponse(success=True, message=f"Monitor started for rental {rental_id}.")
 
+@app.post("/extend-rental-monitor", response_model=BaseResponse)
+async def extend_rental_monitor(request: ExtendRentalRequest):
+    """Adds time to a running rental by moving its timeout deadline."""
+    deadline = rental_timers.extend(request.rental_id, request.extra_seconds)
+    if deadline is None:
+        return BaseResponse(success=False, error=f"No active monitor found for rental {request.rental_id}.")
+    remaining = max(0, int(deadline - time.time()))
+    return BaseResponse(success=True, message=f"Rental {request.rental_id} extended, {remaining}s remaining.")
+
 @app.post("/stop-rental-monitor/{rental_id}", response_model=BaseResponse)
 async def stop_rental_monitor(rental_id: int):
     """Stops the background timeout monitor for a completed or cancelled rental."""
-    if rental_id in timeout_tasks:
-        timeout_tasks[rental_id].cancel()
-        del timeout_tasks[rental_id]
+    if rental_timers.cancel(rental_id):
+        print(f"✅ Timeout monitor for rental {rental_id} was successfully cancelled.")
+        publish_rental_event(rental_id, "monitor_stopped", {})
         return BaseResponse(success=True, message=f"Monitor stopped for rental {rental_id}.")
     return BaseResponse(success=False, error=f"No active monitor found for rental {rental_id}.")
 
+@app.get("/rental-monitors")
+async def list_rental_monitors():
+    """Lists the pending rental timeouts and the seconds left on each."""
+    now = time.time()
+    return {
+        rental_id: {"tv_ip": entry["tv_ip"], "remaining_seconds": round(max(0, entry["deadline"] - now), 1)}
+        for rental_id, entry in rental_timers.entries().items()
+    }
+
 @app.post("/test-all-connections")
-async def test_all_tv_connections():
-    """NEW: Checks all configured TVs concurrently and returns their statuses."""
+async def test_all_tv_connections(fresh: bool = False, run_async: AsyncMode = False):
+    """Returns the status of all configured TVs, from the fleet cache unless fresh=true."""
+    if run_async:
+        return job_runner.submit("test-all-connections", None, lambda: test_all_tv_connections(fresh))
     async def check_one_tv(ip: str):
-         # // EDIT: Add a special case to always show the test TV as online.
-        if ip == '192.168.1.99':
-            return ip, {"success": True, "message": "Online (Test)"}
-        
-        result = await execute_adb_command(f"-s {ip}:5555 shell echo online", timeout=5)
-        if result.get("success") and "online" in result.get("output", ""):
-            return ip, {"success": True, "message": "Online"}
-        else:
-            connect_result = await execute_adb_command(f"connect {ip}:5555", timeout=10)
-            if "connected" in connect_result.get("output", "") or "already connected" in connect_result.get("output", ""):
-                 return ip, {"success": True, "message": "Reconnected"}
-            else:
-                 return ip, {"success": False, "error": "Offline"}
-    tasks = [check_one_tv(ip) for ip in ALL_TV_IPS]
-    results = await asyncio.gather(*tasks)
+        state = get_device_state(ip)
+        if not fresh and state.is_fresh("online"):
+            if state.get("online"):
+                return ip, {"success": True, "message": "Online"}
+            return ip, {"success": False, "error": "Offline"}
+        return ip, await query_cache.get("online", ip, lambda: check_tv_online(ip))
+
+    # A fleet-wide check is housekeeping: it must not hold up rental timeouts or single-TV requests.
+    with adb_priority(PRIORITY_BACKGROUND):
+        tasks = [check_one_tv(ip) for ip in ALL_TV_IPS]
+        results = await asyncio.gather(*tasks)
     return dict(results)
 
+@app.get("/connections")
+async def get_connections():
+    """Returns the link state of every TV the connection supervisor knows about."""
+    return {tv_ip: link.snapshot() for tv_ip, link in connection_supervisor.links.items()}
+
+@app.get("/fleet-state")
+async def get_fleet_state():
+    """Returns the cached state of every TV, as kept up to date by the background poller."""
+    return {ip: get_device_state(ip).snapshot() for ip in dict.fromkeys(ALL_TV_IPS)}
+
 # // NEW: This is the /get-hdmi-status endpoint your frontend will call.
 @app.post("/get-hdmi-status", response_model=HDMIStatusResponse)
-async def get_hdmi_status_endpoint(request: TVRequest):
-    """Gets the current active HDMI input for a specific TV."""
-    status_result = await get_hdmi_status_internal(request.tv_ip)
+async def get_hdmi_status_endpoint(request: TVRequest, fresh: bool = False):
+    """Gets the current active HDMI input for a specific TV, from the fleet cache unless fresh=true."""
+    state = get_device_state(request.tv_ip)
+    if not fresh and state.is_fresh("hdmi_status"):
+        return HDMIStatusResponse(
+            success=True,
+            message="HDMI status from the fleet cache.",
+            hdmi_status=state.get("hdmi_status"),
+        )
+
+    status_result = await query_cache.get("hdmi_status", request.tv_ip, lambda: get_hdmi_status_internal(request.tv_ip))
     if not status_result["success"]:
         return HDMIStatusResponse(success=False, error=status_result.get("error"))
 
@@ -647,19 +4085,20 @@ async def get_hdmi_status_endpoint(request: TVRequest):
 
 # // NEW: This is the /set-hdmi-input endpoint that your Laravel app will call.
 @app.post("/set-hdmi-input", response_model=BaseResponse)
-async def set_hdmi_input(request: SetHDMIRequest):
+async def set_hdmi_input(request: SetHDMIRequest, run_async: AsyncMode = False):
     """Switches the TV to a target HDMI input by executing a predefined command sequence."""
-    config = get_tv_config(request.tv_ip)
+    if run_async:
+        return job_runner.submit("set-hdmi-input", request.tv_ip, lambda: set_hdmi_input(request))
     target_input = request.target_input
 
-    # 1. Get the correct command sequence from the config
-    command_sequence = config.get("hdmi_switch_sequences", {}).get(target_input)
+    # 1. Get the compiled command sequence from the TV's profile
+    plan = get_tv_config(request.tv_ip).hdmi_switch_sequences.get(target_input)
 
-    if not command_sequence:
+    if plan is None or not plan.steps:
         return BaseResponse(success=False, error=f"No HDMI switch sequence found for '{target_input}'.")
 
-    # 2. Execute the sequence
-    result = await execute_command_sequence(request.tv_ip, command_sequence)
+    # 2. Execute the sequence, moving on as soon as each step is seen to take effect
+    result = await run_hdmi_switch(request.tv_ip, plan, target_input)
 
     if not result["success"]:
         return BaseResponse(success=False, error=f"Failed to switch to {target_input}: {result.get('error')}")
@@ -667,6 +4106,66 @@ async def set_hdmi_input(request: SetHDMIRequest):
     return BaseResponse(success=True, message=f"TV {request.tv_ip} switched to {target_input}.")
 
 
+# ==============================================================================
+# --- BATCH FLEET OPERATIONS ---
+# ==============================================================================
+
+async def run_batch(batch: BatchOptions, items: List[TVRequest], handler: Callable[[Any], Awaitable[BaseResponse]]):
+    """Runs an endpoint handler for every item with bounded parallelism and collects per-TV results."""
+    concurrency = max(1, min(batch.concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    limit = asyncio.Semaphore(concurrency)
+
+    async def run_one(item) -> Dict[str, Any]:
+        async with limit:
+            started = time.monotonic()
+            try:
+                response = await handler(item)
+                result = response.model_dump()
+            except Exception as e:
+                result = {"success": False, "message": None, "error": str(e)}
+            return {"tv_ip": item.tv_ip, **result, "duration_ms": round((time.monotonic() - started) * 1000)}
+
+    tasks = [asyncio.create_task(run_one(item)) for item in items]
+
+    if batch.stream:
+        async def result_stream():
+            try:
+                for next_result in asyncio.as_completed(tasks):
+                    yield json.dumps(await next_result) + "\n"
+            finally:
+                for task in tasks:
+                    task.cancel()
+        return StreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+    results = await asyncio.gather(*tasks)
+    return {
+        "success": all(result["success"] for result in results),
+        "succeeded": sum(1 for result in results if result["success"]),
+        "failed": sum(1 for result in results if not result["success"]),
+        "results": results
+    }
+
+@app.post("/batch/set-hdmi-input")
+async def batch_set_hdmi_input(batch: BatchSetHDMIRequest):
+    """Switches many TVs to their target HDMI inputs concurrently."""
+    return await run_batch(batch, batch.items, set_hdmi_input)
+
+@app.post("/batch/tv-control")
+async def batch_control_tv(batch: BatchTVControlRequest):
+    """Sends a control action (volume, power) to many TVs concurrently."""
+    return await run_batch(batch, batch.items, control_tv)
+
+@app.post("/batch/start-rental-monitor")
+async def batch_start_rental_monitor(batch: BatchRentalMonitorRequest):
+    """Starts the timeout monitors for many rentals at once."""
+    return await run_batch(batch, batch.items, start_rental_monitor)
+
+@app.post("/batch/play-timeout-video")
+async def batch_play_timeout_video(batch: BatchPlayVideoRequest):
+    """Plays the timeout video on many TVs concurrently."""
+    return await run_batch(batch, batch.items, play_timeout_video_endpoint)
+
+
 if __name__ == "__main__":
     print("=============================================")
     print("🚀 ADB CONTROL SERVER v2.4 🚀")
@@ -674,5 +4173,11 @@ if __name__ == "__main__":
     print(f"📱 ADB Path: {ADB_PATH}")
     print(f"🌐 Server will run on http://localhost:{PORT}")
     print("\n📋 Use http://localhost:3001/docs for the interactive API documentation.")
+    print(f"👷 Workers: {WORKERS} (shared state: {SHARED_STATE_BACKEND})")
     print("=============================================")
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
+    if WORKERS > 1:
+        # Each worker process imports the app itself, so it is passed by name.
+        uvicorn.run("adb-api:app", host="0.0.0.0", port=PORT, workers=WORKERS,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=PORT)
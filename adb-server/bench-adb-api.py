@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+ADB API Load Benchmark
+Runs adb-api.py in-process against a simulated TV fleet (fake-adb-server.py, "wire" transport)
+and measures throughput and p50/p99 latency per endpoint at several fleet sizes, while a
+rental is running on every TV. Rental timeouts are timed from their SSE events, so drift
+under load is reported as well.
+
+With --replay, a recording made with ADB_RECORD_FILE is played back instead: its API requests are
+sent on their recorded timeline and every ADB command is answered from the recording, so two
+versions of the server can be compared on the same busy night (--compare, --max-regression).
+--speed scales the timeline and the ADB durations but not the server's own waits (HDMI polling,
+settle delays), so only compare runs made at the same speed.
+
+Usage:
+    python bench-adb-api.py                                   # 10, 50 and 200 TVs
+    python bench-adb-api.py --fleet 50 --latency-ms 40 --jitter-ms 30 --json results.json
+    python bench-adb-api.py --replay friday.jsonl --speed 0.25 --json new.json --compare old.json --max-regression 0.2
+Needs httpx (pip install httpx).
+"""
+
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def load_module(name: str, filename: str):
+    """Imports one of the hyphenated scripts in this folder as a fresh module."""
+    spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def log(message: str):
+    """Progress goes to stderr, so stdout carries only the JSON report."""
+    print(message, file=sys.stderr, flush=True)
+
+def percentile(samples: List[float], fraction: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict[str, Any]:
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "max_ms": round(max(latencies, default=0) * 1000, 1),
+    }
+
+# Endpoint scenarios: (name, method, path, body builder). Each one is called once per TV per round.
+SCENARIOS = [
+    ("test-connection", "post", "/test-connection?fresh=true", lambda ip, n: {"tv_ip": ip}),
+    ("get-hdmi-status", "post", "/get-hdmi-status?fresh=true", lambda ip, n: {"tv_ip": ip}),
+    ("set-hdmi-input", "post", "/set-hdmi-input", lambda ip, n: {"tv_ip": ip, "target_input": "hdmi1" if n % 2 else "hdmi2"}),
+    ("tv-control", "post", "/tv-control", lambda ip, n: {"tv_ip": ip, "action": "volume_up"}),
+    ("play-timeout-video", "post", "/play-timeout-video", lambda ip, n: {"tv_ip": ip, "rental_id": 900000 + n}),
+    ("fleet-state", "get", "/fleet-state", None),
+]
+
+async def run_scenario(client: httpx.AsyncClient, scenario: tuple, tv_ips: List[str], rounds: int, concurrency: int) -> Dict[str, Any]:
+    name, method, path, build = scenario
+    gate = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def call(ip: str, n: int):
+        nonlocal errors
+        async with gate:
+            started = time.perf_counter()
+            kwargs = {"json": build(ip, n)} if build else {}
+            try:
+                response = await getattr(client, method)(path, **kwargs)
+                body = response.json()
+                ok = response.status_code == 200 and body.get("success", True) is not False
+            except (httpx.HTTPError, ValueError):
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            errors += 0 if ok else 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(call(ip, n) for n in range(rounds) for ip in tv_ips))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+async def bench_fleet(size: int, args) -> Dict[str, Any]:
+    fake_module = load_module("fake_adb_server", "fake-adb-server.py")
+    api = load_module("adb_api_bench", "adb-api.py")
+
+    profile = fake_module.SimulationProfile(args.latency_ms, args.jitter_ms, args.failure_rate,
+                                            args.connect_failure_rate, args.sleep_scale, args.dumpsys_kb)
+    tv_ips = fake_module.simulated_fleet_ips(size)
+    offline = tv_ips[:int(size * args.offline_fraction)]
+    server, fake = await fake_module.start_fake_adb_server(tv_ips, "127.0.0.1", 0, profile, offline)
+    port = server.sockets[0].getsockname()[1]
+
+    # Point the API at the simulated fleet
+    api.ADB_TRANSPORT = "wire"
+    api.adb_wire_client = api.AdbWireClient("127.0.0.1", port, api.ADB_WIRE_MAX_SOCKETS)
+    profiles = api.read_tv_profiles(api.TV_PROFILES_FILE)
+    profiles["tvs"] = {ip: profiles["default_profile"] for ip in tv_ips}
+    api.install_tv_registry(api.build_tv_registry(profiles, "simulated fleet"))
+    with tempfile.TemporaryDirectory(prefix="adb-bench-") as db_dir:
+        api.rental_timers = api.RentalTimerScheduler(os.path.join(db_dir, "rental-timers.db"))
+
+        log(f"📊 Benchmarking {size} simulated TVs ({len(offline)} offline) on port {port}")
+        result: Dict[str, Any] = {"tvs": size, "offline": len(offline), "endpoints": {}}
+        async with api.app.router.lifespan_context(api.app):
+            transport = httpx.ASGITransport(app=api.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+                # One rental per TV, timing out while the endpoint load is running
+                deadlines, subscriptions = {}, {}
+                for index, ip in enumerate(tv_ips):
+                    rental_id = index + 1
+                    subscriptions[rental_id] = api.event_broker.subscribe(f"rental:{rental_id}")
+                    deadlines[rental_id] = time.time() + args.rental_seconds
+                    await client.post("/start-rental-monitor", json={"tv_ip": ip, "rental_id": rental_id, "timeout_seconds": args.rental_seconds})
+
+                # Rental events are read while the load runs, so each timeout is timed when it happens
+                async def timeout_drift(rental_id: int) -> float:
+                    while True:
+                        for _, event_type, _ in await subscriptions[rental_id].next_events():
+                            if event_type == "timeout_triggered":
+                                return time.time() - deadlines[rental_id]
+
+                async def collect(rental_id: int):
+                    try:
+                        drifts.append(await asyncio.wait_for(timeout_drift(rental_id), timeout=args.rental_seconds + 60))
+                    except asyncio.TimeoutError:
+                        pass
+                    api.event_broker.unsubscribe(subscriptions[rental_id])
+
+                drifts: List[float] = []
+                collectors = asyncio.gather(*(collect(rental_id) for rental_id in deadlines))
+
+                started = time.perf_counter()
+                for scenario in SCENARIOS:
+                    rounds = 1 if scenario[0] == "play-timeout-video" else args.rounds
+                    stats = await run_scenario(client, scenario, tv_ips, rounds, args.concurrency)
+                    result["endpoints"][scenario[0]] = stats
+                    log(f"   {scenario[0]:<20} {stats['throughput_rps']:>8} req/s  p50 {stats['p50_ms']:>7} ms  "
+                    f"p99 {stats['p99_ms']:>7} ms  errors {stats['errors']}")
+                result["load_seconds"] = round(time.perf_counter() - started, 2)
+                await collectors
+                result["rentals"] = {
+                    "count": len(deadlines),
+                    "fired": len(drifts),
+                    "drift_p50_ms": round(percentile(drifts, 0.50) * 1000, 1),
+                    "drift_p99_ms": round(percentile(drifts, 0.99) * 1000, 1),
+                    "drift_mean_ms": round(statistics.fmean(drifts) * 1000, 1) if drifts else 0.0,
+                }
+                log(f"   {'rental timeouts':<20} {len(drifts)}/{len(deadlines)} fired, drift p50 "
+                    f"{result['rentals']['drift_p50_ms']} ms  p99 {result['rentals']['drift_p99_ms']} ms")
+
+    result["adb_commands"] = sum(tv.commands_run for tv in fake.tvs.values())
+    server.close()
+    await server.wait_closed()
+    return result
+
+def endpoint_name(path: str) -> str:
+    """Groups recorded paths by endpoint: "/stop-rental-monitor/5?x=1" -> "/stop-rental-monitor"."""
+    return "/" + path.split("?", 1)[0].strip("/").split("/", 1)[0]
+
+def scale_rental_times(body: Any, speed: float) -> Any:
+    """Rental timers run on the wall clock, so their lengths are scaled along with the timeline."""
+    if isinstance(body, dict) and speed > 0:
+        for field in ("timeout_seconds", "extra_seconds"):
+            if isinstance(body.get(field), (int, float)):
+                body[field] = max(1, round(body[field] * speed))
+    return body
+
+async def bench_replay(args) -> Dict[str, Any]:
+    api = load_module("adb_api_bench", "adb-api.py")
+    api.adb_traffic = api.AdbTrafficLog(None, None, args.speed, args.max_gap)
+    api.adb_traffic.load(args.replay)
+    # Streams stay open for as long as the client listened; they are not request latency
+    timeline = [(offset * args.speed, entry) for offset, entry in api.adb_traffic.api_requests if "/events" not in entry["path"]]
+    with tempfile.TemporaryDirectory(prefix="adb-bench-") as db_dir:
+        api.rental_timers = api.RentalTimerScheduler(os.path.join(db_dir, "rental-timers.db"))
+
+        log(f"📼 Replaying {len(timeline)} API requests from {args.replay} ({timeline[-1][0] if timeline else 0:.0f}s at {args.speed}x)")
+        latencies: Dict[str, List[float]] = {}
+        errors: Dict[str, int] = {}
+        async with api.app.router.lifespan_context(api.app):
+            transport = httpx.ASGITransport(app=api.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+                async def send(offset: float, entry: Dict[str, Any]):
+                    await asyncio.sleep(max(0.0, offset - (time.perf_counter() - started)))
+                    name = f"{entry['method']} {endpoint_name(entry['path'])}"
+                    body = json.loads(entry["body"]) if entry.get("body") else None
+                    request_started = time.perf_counter()
+                    try:
+                        response = await client.request(entry["method"], entry["path"], json=scale_rental_times(body, args.speed))
+                        # Compared with the recorded status, so requests that failed in production too are not errors
+                        ok = response.status_code == entry.get("status", response.status_code)
+                    except httpx.HTTPError:
+                        ok = False
+                    latencies.setdefault(name, []).append(time.perf_counter() - request_started)
+                    errors[name] = errors.get(name, 0) + (0 if ok else 1)
+
+                started = time.perf_counter()
+                api.adb_traffic.restart_clock()
+                await asyncio.gather(*(send(offset, entry) for offset, entry in timeline))
+                elapsed = time.perf_counter() - started
+
+    # What the same requests took when they were recorded
+    recorded_ms: Dict[str, List[float]] = {}
+    for _, entry in timeline:
+        recorded_ms.setdefault(f"{entry['method']} {endpoint_name(entry['path'])}", []).append(entry["ms"] / 1000)
+    recorded = {name: {"recorded_p50_ms": round(percentile(samples, 0.50) * 1000, 1),
+                       "recorded_p99_ms": round(percentile(samples, 0.99) * 1000, 1)} for name, samples in recorded_ms.items()}
+
+    result = {
+        "recording": args.replay,
+        "speed": args.speed,
+        "replay_seconds": round(elapsed, 2),
+        "endpoints": {name: {**summarize(samples, errors[name], elapsed), **recorded.get(name, {})}
+                      for name, samples in sorted(latencies.items())},
+        "adb_matches": {labels[0]: value for labels, value in api.adb_replay_lookups.values.items()},
+    }
+    for name, stats in result["endpoints"].items():
+        log(f"   {name:<32} {stats['requests']:>6} req  p50 {stats['p50_ms']:>7} ms  p99 {stats['p99_ms']:>7} ms  "
+            f"errors {stats['errors']}  (recorded p99 {stats.get('recorded_p99_ms')} ms)")
+    log(f"   ADB answers by match: {result['adb_matches']}")
+    return result
+
+def compare_reports(baseline: Dict[str, Any], current: Dict[str, Any], max_regression: float, min_ms: float) -> List[str]:
+    """
+    Logs the p50/p99 change per endpoint and returns the endpoints whose p99 grew by more than
+    max_regression (a fraction) and by at least min_ms, so jitter on sub-millisecond endpoints is not a regression.
+    """
+    regressions = []
+    for name, stats in current["endpoints"].items():
+        before = baseline["endpoints"].get(name)
+        if before is None:
+            continue
+        change = (stats["p99_ms"] - before["p99_ms"]) / before["p99_ms"] if before["p99_ms"] else 0.0
+        log(f"   {name:<32} p50 {before['p50_ms']:>7} -> {stats['p50_ms']:>7} ms  p99 {before['p99_ms']:>7} -> {stats['p99_ms']:>7} ms ({change:+.0%})")
+        if change > max_regression and stats["p99_ms"] - before["p99_ms"] >= min_ms:
+            regressions.append(name)
+    return regressions
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load benchmark for adb-api.py against a simulated TV fleet")
+    parser.add_argument("--fleet", type=int, action="append", help="Fleet size (repeatable, default 10, 50, 200)")
+    parser.add_argument("--rounds", type=int, default=3, help="Requests per TV per endpoint")
+    parser.add_argument("--concurrency", type=int, default=64, help="Concurrent client requests")
+    parser.add_argument("--rental-seconds", type=int, default=2)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--connect-failure-rate", type=float, default=0)
+    parser.add_argument("--offline-fraction", type=float, default=0)
+    parser.add_argument("--sleep-scale", type=float, default=0)
+    parser.add_argument("--dumpsys-kb", type=int, default=0)
+    parser.add_argument("--replay", help="Play back a recording made with ADB_RECORD_FILE instead of the simulated fleet")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay timing factor (0.5 = twice as fast, 0 = instant)")
+    parser.add_argument("--max-gap", type=float, default=10, help="Longest idle gap (seconds) kept from the recording")
+    parser.add_argument("--compare", help="A previous --replay --json report to compare latencies with")
+    parser.add_argument("--max-regression", type=float, help="With --compare: exit with code 1 if an endpoint's p99 grew by more than this fraction")
+    parser.add_argument("--min-regression-ms", type=float, default=5, help="With --max-regression: ignore p99 increases smaller than this")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the API's own log output")
+    args = parser.parse_args()
+
+    results = []
+    with open(os.devnull, "w") as devnull:
+        # The API logs every command; keep that out of the report unless asked for
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+            if args.replay:
+                results.append(await bench_replay(args))
+            else:
+                for size in args.fleet or [10, 50, 200]:
+                    results.append(await bench_fleet(size, args))
+    report = {"settings": vars(args), "results": results}
+    regressions = []
+    if args.replay and args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        log(f"📈 Compared with {args.compare}:")
+        regressions = compare_reports(baseline["results"][0], results[0], args.max_regression if args.max_regression is not None else float("inf"), args.min_regression_ms)
+        report["regressions"] = regressions
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        log(f"💾 Results written to {args.json}")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if regressions and args.max_regression is not None:
+        log(f"❌ p99 regressed by more than {args.max_regression:.0%} on: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+Fake ADB Server / Simulated TV Fleet
+A stand-in for the real adb server (port 5037) that speaks the ADB host protocol, so the
+"wire" transport of adb-api.py can be exercised and benchmarked without any TVs.
+Each fake TV keeps a little state (focused app, HDMI input) and understands the shell
+commands that adb-api.py sends, with configurable latency, failure rates and offline TVs.
+
+Usage:
+    python fake-adb-server.py --port 5037 --tv 192.168.1.20 --tv 192.168.1.35
+    python fake-adb-server.py --count 50 --latency-ms 40 --jitter-ms 20 --failure-rate 0.01
+"""
+
+import argparse
+import asyncio
+import hashlib
+import random
+import re
+import shlex
+import struct
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+LAUNCHER = "com.google.android.tvlauncher/.MainActivity"
+VLC_PLAYER = "org.videolan.vlc/.gui.video.VideoPlayerActivity"
+INPUT_MENU = "com.tcl.tvinput/.InputSourceActivity"
+HDMI_COMPONENTS = {
+    "hdmi1": "com.tcl.tvinput/tcl.hdmi.HDMIInputService/HW15",
+    "hdmi2": "com.tcl.tvinput/tcl.hdmi.HDMIInputService/HW16",
+}
+INITIAL_FOCUS = {"launcher": LAUNCHER, "vlc": VLC_PLAYER, **HDMI_COMPONENTS}
+TIMEOUT_VIDEO = "/sdcard/Movies/hot.mp4"  # The video_path of every TV config
+
+# One step of a compiled script: `<command>; r=$?; echo "__STEP_<n>__ $r"; [ $r -eq 0 ] || exit $r`
+STEP_LINE_PATTERN = re.compile(r'^(.*); r=\$\?; echo "(__STEP_\d+__) \$r"; \[ \$r -eq 0 \] \|\| exit \$r$')
+
+SCREEN_SIZE = (1920, 1080)  # Width and height of `screencap -p` images
+
+# Shell v2 packet ids
+SHELL_STDOUT = 1
+SHELL_STDERR = 2
+SHELL_EXIT = 3
+
+class SimulationProfile:
+    """How the fake TVs behave. Shared by every TV of a fleet."""
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, failure_rate: float = 0,
+                 connect_failure_rate: float = 0, sleep_scale: float = 0, dumpsys_kb: int = 0,
+                 initial_focus: str = "launcher"):
+        self.latency_ms = latency_ms                      # Base latency of every shell command
+        self.jitter_ms = jitter_ms                        # Extra, uniformly random latency
+        self.failure_rate = failure_rate                  # Chance a shell command fails with "device offline"
+        self.connect_failure_rate = connect_failure_rate  # Chance `adb connect` to an offline TV times out
+        self.sleep_scale = sleep_scale                    # 1.0 honours on-device `sleep N` in real time, 0 skips it
+        self.dumpsys_kb = dumpsys_kb                      # Filler added to dumpsys output, like a busy real TV
+        self.initial_focus = initial_focus                # launcher, vlc, hdmi1, hdmi2 or random
+
+    def command_delay(self) -> float:
+        return (self.latency_ms + random.uniform(0, self.jitter_ms)) / 1000
+
+class FakeTV:
+    """The emulated state of a single Android TV."""
+
+    def __init__(self, ip: str, profile: Optional[SimulationProfile] = None):
+        self.serial = f"{ip}:5555"
+        self.profile = profile or SimulationProfile()
+        self.connected = True
+        self.watchers: List[asyncio.Queue] = []  # Open logcat streams
+        focus = self.profile.initial_focus
+        self._focus = INITIAL_FOCUS[random.choice(list(INITIAL_FOCUS)) if focus == "random" else focus]
+        self.inputs = list(HDMI_COMPONENTS)
+        self.menu_cursor = 0
+        self.key_log: List[int] = []
+        self.files: Dict[str, Tuple[bytes, int]] = {TIMEOUT_VIDEO: (b"fake timeout video", 1700000000)}  # path -> (data, mtime)
+        self.commands_run = 0
+        self.slept = 0.0  # On-device `sleep` seconds of the command being run
+
+    @property
+    def focus(self) -> str:
+        return self._focus
+
+    @focus.setter
+    def focus(self, component: str):
+        if component != self._focus:
+            for queue in self.watchers:
+                queue.put_nowait(f"I/input_focus( 1234): [Focus entering 1a2b3c {component} (server),reason=setFocusedWindow]\n")
+        self._focus = component
+
+    def run(self, command: str) -> Tuple[int, str, str]:
+        """Runs a (possibly piped) shell command and returns (exit code, stdout, stderr)."""
+        if command.startswith("sh -c "):
+            return self.run_single(command)
+        if ";" in command:
+            stdout, stderr, exit_code = "", "", 0
+            for part in command.split(";"):
+                exit_code, out, err = self.run(part.strip())
+                stdout, stderr = stdout + out, stderr + err
+            return exit_code, stdout, stderr
+        stages = [stage.strip() for stage in command.split("|")]
+        exit_code, stdout, stderr = self.run_single(stages[0])
+        for stage in stages[1:]:
+            args = shlex.split(stage)
+            if args and args[0] == "grep":
+                pattern = args[-1]
+                lines = [line for line in stdout.splitlines() if pattern in line]
+                if "-m" in args:
+                    lines = lines[:int(args[args.index("-m") + 1])]
+                stdout = "".join(line + "\n" for line in lines)
+                exit_code = 0 if lines else 1
+        return exit_code, stdout, stderr
+
+    def run_script(self, script: str) -> Tuple[int, str, str]:
+        """Runs the `sh -c` scripts that adb-api.py compiles command sequences into."""
+        stdout, stderr = "", ""
+        for line in script.splitlines():
+            step = STEP_LINE_PATTERN.match(line)
+            exit_code, out, err = self.run(step.group(1) if step else line)
+            stdout, stderr = stdout + out, stderr + err
+            if step:
+                stdout += f"{step.group(2)} {exit_code}\n"
+                if exit_code != 0:
+                    return exit_code, stdout, stderr
+        return 0, stdout, stderr
+
+    def run_single(self, command: str) -> Tuple[int, str, str]:
+        try:
+            args = shlex.split(command)
+        except ValueError as e:
+            return 2, "", f"sh: {e}\n"
+        if not args:
+            return 0, "", ""
+
+        if args[:2] == ["sh", "-c"] and len(args) == 3:
+            return self.run_script(args[2])
+
+        if args[0] == "echo":
+            return 0, " ".join(args[1:]) + "\n", ""
+        if args[0] == "ls":
+            missing = [path for path in args[1:] if path not in self.files]
+            if missing:
+                return 1, "", "".join(f"ls: {path}: No such file or directory\n" for path in missing)
+            return 0, "".join(path + "\n" for path in args[1:]), ""
+        if args[0] in ("stat", "md5sum"):
+            path = args[-1]
+            if path not in self.files:
+                return 1, "", f"{args[0]}: {path}: No such file or directory\n"
+            data, mtime = self.files[path]
+            if args[0] == "stat":
+                return 0, f"{len(data)} {mtime}\n", ""
+            return 0, f"{hashlib.md5(data).hexdigest()}  {path}\n", ""
+        if args[:2] == ["mv", "-f"] and len(args) == 4:
+            if args[2] not in self.files:
+                return 1, "", f"mv: {args[2]}: No such file or directory\n"
+            self.files[args[3]] = self.files.pop(args[2])
+            return 0, "", ""
+        if args[0] == "sleep":
+            self.slept += float(args[1])
+            return 0, "", ""
+        if args[:2] == ["input", "keyevent"]:
+            for key in args[2:]:
+                self.press_key(int(key) if key.isdigit() else key)
+            return 0, "", ""
+        if args[:2] == ["am", "force-stop"]:
+            if self.focus.startswith(args[2] + "/"):
+                self.focus = LAUNCHER
+            return 0, "", ""
+        if args[:2] == ["am", "start"]:
+            if "org.videolan.vlc" in command:
+                self.focus = VLC_PLAYER
+                return 0, "Starting: Intent { act=android.intent.action.VIEW }\n", ""
+            return 1, "", "Error: Activity not started, unable to resolve Intent\n"
+        if args[:2] == ["dumpsys", "window"]:
+            return 0, self.filler("Window") + f"  mCurrentFocus=Window{{1a2b3c u0 {self.focus}}}\n", ""
+        if args[:2] == ["dumpsys", "activity"]:
+            return 0, self.filler("ActivityRecord") + f"  mFocusedActivity: ActivityRecord{{4d5e6f u0 {self.focus} t12}}\n", ""
+        return 127, "", f"sh: {args[0]}: not found\n"
+
+    def screencap(self) -> bytes:
+        """A PNG of the screen: a single colour that follows the focused app."""
+        return solid_png(*SCREEN_SIZE, zlib.crc32(self.focus.encode()) & 0xFFFFFF)
+
+    def filler(self, kind: str) -> str:
+        line = f"  {kind} #0: mDisplayId=0 mSession=Session{{7f00 1234:u0a10042}} mClient=android.os.BinderProxy\n"
+        return line * (self.profile.dumpsys_kb * 1024 // len(line))
+
+    def press_key(self, key):
+        self.key_log.append(key)
+        if key == 3:  # HOME
+            self.focus = LAUNCHER
+        elif key == 178:  # TV_INPUT
+            self.focus = INPUT_MENU
+        elif self.focus == INPUT_MENU and key in (20, 22):
+            self.menu_cursor = min(self.menu_cursor + 1, len(self.inputs) - 1)
+        elif self.focus == INPUT_MENU and key in (19, 21):
+            self.menu_cursor = max(self.menu_cursor - 1, 0)
+        elif self.focus == INPUT_MENU and key == 23:
+            self.focus = HDMI_COMPONENTS[self.inputs[self.menu_cursor]]
+
+def solid_png(width: int, height: int, rgb: int) -> bytes:
+    """Encodes a single-colour RGB image as PNG."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    row = b"\x00" + rgb.to_bytes(3, "big") * width
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(row * height))
+            + chunk(b"IEND", b""))
+
+class FakeAdbServer:
+    """Answers ADB host protocol requests for a set of fake TVs."""
+
+    def __init__(self, tv_ips: List[str], profile: Optional[SimulationProfile] = None, offline_ips: Optional[List[str]] = None):
+        self.profile = profile or SimulationProfile()
+        self.tvs: Dict[str, FakeTV] = {f"{ip}:5555": FakeTV(ip, self.profile) for ip in tv_ips}
+        for ip in offline_ips or []:
+            self.tvs[f"{ip}:5555"].connected = False
+
+    @staticmethod
+    async def read_request(reader: asyncio.StreamReader) -> str:
+        length = int(await reader.readexactly(4), 16)
+        return (await reader.readexactly(length)).decode('utf-8')
+
+    @staticmethod
+    def okay_with_string(text: str) -> bytes:
+        payload = text.encode('utf-8')
+        return b"OKAY" + b"%04x" % len(payload) + payload
+
+    @staticmethod
+    def fail(message: str) -> bytes:
+        payload = message.encode('utf-8')
+        return b"FAIL" + b"%04x" % len(payload) + payload
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            service = await self.read_request(reader)
+            if service == "host:version":
+                writer.write(self.okay_with_string("%04x" % 41))
+            elif service == "host:devices":
+                listing = "".join(f"{serial}\tdevice\n" for serial, tv in self.tvs.items() if tv.connected)
+                writer.write(self.okay_with_string(listing))
+            elif service.startswith("host:connect:"):
+                writer.write(self.okay_with_string(await self.connect(service[len("host:connect:"):])))
+            elif service.startswith("host:transport:"):
+                tv = self.tvs.get(service[len("host:transport:"):])
+                if tv is None or not tv.connected:
+                    writer.write(self.fail(f"device '{service[len('host:transport:'):]}' not found"))
+                else:
+                    writer.write(b"OKAY")
+                    await writer.drain()
+                    await self.handle_device_service(tv, await self.read_request(reader), reader, writer)
+            else:
+                writer.write(self.fail(f"unknown host service '{service}'"))
+            await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def connect(self, serial: str) -> str:
+        tv = self.tvs.get(serial)
+        if tv is None:
+            return f"failed to connect to '{serial}': Connection refused"
+        if tv.connected:
+            return f"already connected to {serial}"
+        await asyncio.sleep(tv.profile.command_delay())
+        if random.random() < tv.profile.connect_failure_rate:
+            return f"failed to connect to '{serial}': Connection timed out"
+        tv.connected = True
+        return f"connected to {serial}"
+
+    async def handle_device_service(self, tv: FakeTV, service: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if service == "sync:":
+            await self.sync_push(tv, reader, writer)
+            return
+        if service.startswith("exec:"):
+            await self.exec_out(tv, service[len("exec:"):], writer)
+            return
+        match = re.match(r"shell(,v2)?(?:,raw)?:(.*)", service, re.S)
+        if not match:
+            writer.write(self.fail(f"unsupported service '{service}'"))
+            return
+        if match.group(2).startswith("logcat"):
+            await self.stream_logcat(tv, bool(match.group(1)), reader, writer)
+            return
+        if random.random() < tv.profile.failure_rate:
+            writer.write(self.fail("device offline"))
+            return
+        writer.write(b"OKAY")
+        tv.commands_run += 1
+        tv.slept = 0.0
+        exit_code, stdout, stderr = tv.run(match.group(2))
+        await asyncio.sleep(tv.profile.command_delay() + tv.slept * tv.profile.sleep_scale)
+        if match.group(1):
+            for packet_id, data in ((SHELL_STDOUT, stdout.encode()), (SHELL_STDERR, stderr.encode())):
+                if data:
+                    writer.write(struct.pack("<BI", packet_id, len(data)) + data)
+            writer.write(struct.pack("<BI", SHELL_EXIT, 1) + bytes([exit_code & 0xFF]))
+        else:
+            writer.write((stdout + stderr).encode())
+
+    async def exec_out(self, tv: FakeTV, command: str, writer: asyncio.StreamWriter):
+        """The `exec:` service: raw stdout, no packets and no exit code."""
+        writer.write(b"OKAY")
+        await asyncio.sleep(tv.profile.command_delay())
+        if command.strip() == "screencap -p":
+            writer.write(tv.screencap())
+        else:
+            _, stdout, stderr = tv.run(command)
+            writer.write((stdout + stderr).encode())
+
+    async def sync_push(self, tv: FakeTV, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """The `sync:` service, SEND only: SEND "<path>,<mode>", DATA packets, then DONE with the mtime."""
+        writer.write(b"OKAY")
+        request, length = struct.unpack("<4sI", await reader.readexactly(8))
+        path = (await reader.readexactly(length)).decode('utf-8').rsplit(",", 1)[0]
+        if request != b"SEND":
+            writer.write(b"FAIL" + struct.pack("<I", 19) + b"unsupported request")
+            return
+        data = bytearray()
+        while True:
+            packet, value = struct.unpack("<4sI", await reader.readexactly(8))
+            if packet == b"DONE":
+                break
+            data += await reader.readexactly(value)
+        await asyncio.sleep(tv.profile.command_delay())
+        tv.files[path] = (bytes(data), value)
+        writer.write(b"OKAY" + struct.pack("<I", 0))
+
+    async def stream_logcat(self, tv: FakeTV, v2: bool, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Streams a focus event line for every focus change until the client disconnects."""
+        writer.write(b"OKAY")
+        queue: asyncio.Queue = asyncio.Queue()
+        queue.put_nowait("--------- beginning of events\n")
+        queue.put_nowait(f"I/input_focus( 1234): [Focus entering 1a2b3c {tv.focus} (server),reason=setFocusedWindow]\n")
+        tv.watchers.append(queue)
+        disconnected = asyncio.ensure_future(reader.read())
+        try:
+            while True:
+                line = asyncio.ensure_future(queue.get())
+                await asyncio.wait({line, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if not line.done():
+                    line.cancel()
+                    return
+                data = line.result().encode()
+                writer.write(struct.pack("<BI", SHELL_STDOUT, len(data)) + data if v2 else data)
+                await writer.drain()
+        finally:
+            tv.watchers.remove(queue)
+            disconnected.cancel()
+
+def simulated_fleet_ips(count: int) -> List[str]:
+    """IP addresses for a simulated fleet of `count` TVs (10.77.0.1, 10.77.0.2, ...)."""
+    return [f"10.77.{index // 250}.{index % 250 + 1}" for index in range(count)]
+
+async def start_fake_adb_server(tv_ips: List[str], host: str = "127.0.0.1", port: int = 5037,
+                                profile: Optional[SimulationProfile] = None, offline_ips: Optional[List[str]] = None):
+    """Starts a fake adb server and returns (asyncio server, FakeAdbServer)."""
+    fake = FakeAdbServer(tv_ips, profile, offline_ips)
+    server = await asyncio.start_server(fake.handle_client, host, port)
+    return server, fake
+
+async def main():
+    parser = argparse.ArgumentParser(description="Fake adb server for testing adb-api.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5037)
+    parser.add_argument("--tv", action="append", default=[], help="IP of a fake TV (repeatable)")
+    parser.add_argument("--count", type=int, default=0, help="Add this many simulated TVs (10.77.x.y)")
+    parser.add_argument("--offline", type=int, default=0, help="How many of the TVs start disconnected")
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--connect-failure-rate", type=float, default=0)
+    parser.add_argument("--sleep-scale", type=float, default=0, help="1.0 honours on-device sleeps in real time")
+    parser.add_argument("--dumpsys-kb", type=int, default=0)
+    parser.add_argument("--focus", default="launcher", choices=[*INITIAL_FOCUS, "random"])
+    args = parser.parse_args()
+
+    tv_ips = args.tv + simulated_fleet_ips(args.count) or ["192.168.1.99"]
+    profile = SimulationProfile(args.latency_ms, args.jitter_ms, args.failure_rate, args.connect_failure_rate,
+                                args.sleep_scale, args.dumpsys_kb, args.focus)
+    server, _ = await start_fake_adb_server(tv_ips, args.host, args.port, profile, tv_ips[:args.offline])
+    print(f"🧪 Fake adb server listening on {args.host}:{args.port} with {len(tv_ips)} TV(s)")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,66 @@
+"""
+Shared fixtures for the adb-api.py tests.
+
+adb-api.py and fake-adb-server.py are scripts with dashes in their names, so they are loaded
+from their paths. Every test gets its own copy of adb-api.py, so module state (the TV registry,
+caches, device actors, timers) never leaks from one test into the next. The tests are plain
+functions that drive their coroutines with asyncio.run, so no pytest plugin is needed.
+
+Run them from the repository root with: python -m pytest adb-server/tests
+"""
+
+import importlib.util
+import os
+from contextlib import asynccontextmanager
+
+import pytest
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_script(module_name: str, filename: str):
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(SERVER_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture
+def api():
+    """A fresh copy of adb-api.py."""
+    return load_script("adb_api", "adb-api.py")
+
+@pytest.fixture(scope="session")
+def fake_adb():
+    """fake-adb-server.py (stateless at module level, so it is loaded once)."""
+    return load_script("fake_adb_server", "fake-adb-server.py")
+
+@pytest.fixture
+def fake_fleet(api, fake_adb, tmp_path):
+    """
+    Returns an async context manager that starts a fake adb server for the given TVs on a free
+    port and points adb-api.py at it through the wire transport. The TVs get the named profile
+    from tv-profiles.json, events are delivered in-process and rental timeouts are journalled to
+    a temporary database, as the server's lifespan would set up. Yields the FakeAdbServer, whose
+    `tvs` (serial -> FakeTV) can be inspected and changed by the test.
+
+        async with fake_fleet(["10.0.0.1"]) as fake:
+            ...
+    """
+    @asynccontextmanager
+    async def start(tv_ips, profile_name="DEFAULT_TCL", simulation=None):
+        server, fake = await fake_adb.start_fake_adb_server(tv_ips, port=0, profile=simulation)
+        data = api.read_tv_profiles(api.TV_PROFILES_FILE)
+        data["tvs"] = {tv_ip: profile_name for tv_ip in tv_ips}
+        api.install_tv_registry(api.build_tv_registry(data, "test"))
+        api.ADB_TRANSPORT = "wire"
+        api.adb_wire_client = api.AdbWireClient("127.0.0.1", server.sockets[0].getsockname()[1], 8)
+        api.shared_state.start(api.event_broker)
+        api.rental_timers = api.RentalTimerScheduler(str(tmp_path / "rental-timers.db"))
+        api.rental_timers.open()
+        try:
+            yield fake
+        finally:
+            await api.rental_timers.stop()
+            await api.stop_all_device_actors()
+            server.close()
+
+    return start
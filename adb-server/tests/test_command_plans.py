@@ -0,0 +1,74 @@
+"""Compiling command sequences into validated plans, and running them as on-device scripts."""
+
+import asyncio
+
+import pytest
+
+@pytest.mark.parametrize("commands, message", [
+    ([""], "step 0 is empty"),
+    (["input keyevent 3", "   "], "step 1 is empty"),
+    ([None], "step 0 is empty"),
+    (["sleep"], "must be 'sleep <seconds>'"),
+    (["sleep 1 2"], "must be 'sleep <seconds>'"),
+    (["sleep -1"], "must be 'sleep <seconds>'"),
+    (["sleep soon"], "must be 'sleep <seconds>'"),
+    (["input keyevent"], "needs numeric or KEYCODE_* key codes"),
+    (["input keyevent 22 down"], "needs numeric or KEYCODE_* key codes"),
+    (["input keyevent 22; reboot"], "needs numeric or KEYCODE_* key codes"),
+    (["am start -n 'com.example/.Main"], "cannot be parsed"),
+])
+def test_malformed_sequences_are_rejected(api, commands, message):
+    with pytest.raises(ValueError, match=message.replace("*", r"\*")):
+        api.CommandPlan(commands)
+
+def test_sleeps_after_focus_changing_keys_become_wait_blocks(api):
+    plan = api.CommandPlan(["input keyevent 178", "sleep 2", "input keyevent 22", "sleep 1", "input keyevent 23"])
+
+    kinds = [(kind, block.index if kind == "wait" else [step.index for step in block]) for kind, block in plan.blocks]
+    assert kinds == [("script", [0]), ("wait", 1), ("script", [2, 3, 4])]
+    assert plan.total_sleep == 3
+    assert [step.changes_focus for step in plan.steps] == [True, False, False, False, False]
+
+def test_plans_are_compiled_once_per_sequence(api):
+    commands = ["input keyevent 3", "sleep 1", "input keyevent 23"]
+    assert api.get_command_plan(commands) is api.get_command_plan(list(commands))
+
+def test_rendered_script_uses_sleep_overrides(api):
+    plan = api.CommandPlan(["input keyevent 22", "sleep 1", "input keyevent 23"])
+
+    script = api.render_plan_script(plan.steps, {1: 0.4})
+    assert "sleep 0.4" in script
+    assert "sleep 1\n" not in script
+    assert '__STEP_0__ $r' in script and '__STEP_2__ $r' in script
+
+def test_script_runs_in_one_round_trip_and_reports_the_failing_step(api, fake_fleet):
+    plan = api.CommandPlan(["input keyevent 3", "sleep 1", "am start -n com.example/.Missing", "input keyevent 23"])
+
+    async def main():
+        async with fake_fleet(["10.0.0.1"]) as fake:
+            tv = fake.tvs["10.0.0.1:5555"]
+            result = await api.run_plan_script("10.0.0.1", plan.steps)
+            return result, tv.key_log, tv.commands_run
+
+    result, key_log, commands_run = asyncio.run(main())
+    assert result["success"] is False
+    assert result["step_exit_codes"] == {0: 0, 2: 1}
+    assert result["error"].startswith("step 2 (am start -n com.example/.Missing) failed")
+    assert key_log == [3]  # Stopped at the failing step, so 23 was never pressed
+    assert commands_run == 1
+
+@pytest.mark.parametrize("initial_focus, learns", [("launcher", True), ("hdmi2", False)])
+def test_untargeted_switch_learns_only_when_the_input_changed(api, fake_fleet, fake_adb, initial_focus, learns):
+    api.HDMI_CONFIRM_TIMEOUT = 0.5
+
+    async def main():
+        simulation = fake_adb.SimulationProfile(initial_focus=initial_focus)
+        async with fake_fleet(["10.0.0.1"], simulation=simulation):
+            plan = api.get_tv_config("10.0.0.1").hdmi_switch_plan
+            result = await api.run_hdmi_switch("10.0.0.1", plan)
+            return result, plan, api.hdmi_wait_limits[("10.0.0.1", plan.commands)]
+
+    result, plan, limits = asyncio.run(main())
+    assert result["success"] and result["hdmi_status"] == "hdmi2"
+    in_menu = [step for kind, block in plan.blocks if kind == "script" for step in block if step.sleep is not None]
+    assert in_menu and all((limits.get(step.index, step.sleep) < step.sleep) == learns for step in in_menu)
@@ -0,0 +1,38 @@
+"""The SSE EventBroker: topic fan-out, replay and cleanup of finished rentals."""
+
+def started_broker(api):
+    api.shared_state.start(api.event_broker)
+    return api.event_broker
+
+def test_only_rental_and_tv_events_reach_the_fleet_topic(api):
+    broker = started_broker(api)
+    rental = api.publish_rental_event(1, "monitor_started", {})
+    tv = broker.publish(broker.FLEET_TOPIC, "input_changed", {"tv_ip": "10.0.0.1"})
+    broker.publish("job:abc", "running", {"job_id": "abc"})
+    broker.publish("video-sync", "push_progress", {"tv_ip": "10.0.0.1"})
+
+    assert [event[0] for event in broker.history[broker.FLEET_TOPIC]] == [rental, tv]
+    assert len(broker.history["job:abc"]) == 1 and len(broker.history["video-sync"]) == 1
+
+def test_replay_resumes_after_the_last_event_id(api):
+    broker = started_broker(api)
+    ids = [api.publish_rental_event(2, "tick", {"i": i}) for i in range(3)]
+
+    subscription = broker.subscribe("rental:2", ids[0])
+    assert [event[0] for event in subscription.events] == ids[1:]
+
+def test_finished_rental_history_is_dropped_after_its_ttl(api):
+    broker = started_broker(api)
+    api.publish_rental_event(3, "timeout_triggered", {})
+    assert "rental:3" in broker.history  # Still replayable right after the final event
+
+    api.SSE_FINISHED_RENTAL_TTL = 0
+    api.publish_rental_event(4, "monitor_stopped", {})
+    assert "rental:3" not in broker.history and "rental:4" not in broker.history
+    assert not broker.finished_rentals
+
+def test_a_new_event_keeps_a_finished_rental(api):
+    broker = started_broker(api)
+    api.publish_rental_event(5, "timeout_triggered", {})
+    api.publish_rental_event(5, "monitor_started", {})  # Started again under the same id
+    assert "rental:5" not in broker.finished_rentals
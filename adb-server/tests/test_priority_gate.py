@@ -0,0 +1,86 @@
+"""Priority classes with aging: the fleet-wide PriorityGate and the per-TV DeviceActor queue."""
+
+import asyncio
+
+def run_waiters(api, gate, waiters, spacing=0.0):
+    """Holds the gate's only slot, queues the (name, priority) waiters in order, then releases it."""
+    async def main():
+        order = []
+
+        async def waiter(name, priority):
+            with api.adb_priority(priority):
+                async with gate:
+                    order.append(name)
+
+        await gate.__aenter__()
+        tasks = []
+        for name, priority in waiters:
+            tasks.append(asyncio.create_task(waiter(name, priority)))
+            await asyncio.sleep(spacing)
+        await asyncio.sleep(0.01)
+        await gate.__aexit__(None, None, None)
+        await asyncio.gather(*tasks)
+        return order
+
+    return asyncio.run(main())
+
+def test_freed_slot_goes_to_the_most_urgent_class(api):
+    gate = api.PriorityGate(1, "test")
+    order = run_waiters(api, gate, [
+        ("background", api.PRIORITY_BACKGROUND),
+        ("interactive", api.PRIORITY_INTERACTIVE),
+        ("critical", api.PRIORITY_RENTAL_CRITICAL),
+        ("interactive-2", api.PRIORITY_INTERACTIVE),
+    ])
+    assert order == ["critical", "interactive", "interactive-2", "background"]
+    assert gate.free == 1 and gate.waiting() == 0
+
+def test_waiting_long_enough_outranks_a_more_urgent_class(api):
+    api.PRIORITY_AGING_SECONDS = 0.05
+    gate = api.PriorityGate(1, "test")
+    # The background waiter has waited more than two classes' worth of aging when the others arrive
+    order = run_waiters(api, gate, [
+        ("background", api.PRIORITY_BACKGROUND),
+        ("critical", api.PRIORITY_RENTAL_CRITICAL),
+    ], spacing=0.15)
+    assert order == ["background", "critical"]
+
+def test_cancelled_waiter_does_not_lose_the_slot(api):
+    async def main():
+        gate = api.PriorityGate(1, "test")
+        await gate.__aenter__()
+        cancelled = asyncio.create_task(gate.__aenter__())
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        await gate.__aexit__(None, None, None)
+        async with gate:
+            pass
+        return gate.free
+
+    assert asyncio.run(main()) == 1
+
+def test_device_actor_runs_queued_jobs_by_priority(api):
+    async def main():
+        actor = api.DeviceActor("10.0.0.1")
+        order = []
+        release = asyncio.Event()
+
+        async def job(name):
+            if name == "running":
+                await release.wait()
+            order.append(name)
+
+        running = asyncio.create_task(actor.submit(lambda: job("running")))
+        await asyncio.sleep(0.01)
+        queued = [asyncio.create_task(actor.submit(lambda name=name: job(name), priority))
+                  for name, priority in (("background", api.PRIORITY_BACKGROUND),
+                                         ("interactive", api.PRIORITY_INTERACTIVE),
+                                         ("critical", api.PRIORITY_RENTAL_CRITICAL))]
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(running, *queued)
+        await actor.stop()
+        return order
+
+    assert asyncio.run(main()) == ["running", "critical", "interactive", "background"]
@@ -0,0 +1,97 @@
+"""The single-flight QueryCache for read-only TV queries, and its invalidation after writes."""
+
+import asyncio
+
+def counting(result="ok", delay=0.0, error=None):
+    """A compute function that counts its runs."""
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+
+    return compute, calls
+
+def test_concurrent_callers_share_one_run(api):
+    async def main():
+        cache = api.QueryCache(16)
+        compute, calls = counting(delay=0.05)
+        results = await asyncio.gather(*(cache.get("hdmi_status", "10.0.0.1", compute) for _ in range(5)))
+        again = await cache.get("hdmi_status", "10.0.0.1", compute)  # Within the TTL
+        return results, again, len(calls)
+
+    results, again, runs = asyncio.run(main())
+    assert results == ["ok"] * 5 and again == "ok"
+    assert runs == 1
+
+def test_invalidate_drops_only_that_tvs_entries(api):
+    async def main():
+        cache = api.QueryCache(16)
+        first, first_calls = counting()
+        other, other_calls = counting()
+        await cache.get("hdmi_status", "10.0.0.1", first)
+        await cache.get("hdmi_status", "10.0.0.2", other)
+        cache.invalidate("10.0.0.1")
+        await cache.get("hdmi_status", "10.0.0.1", first)
+        await cache.get("hdmi_status", "10.0.0.2", other)
+        return len(first_calls), len(other_calls), cache.by_tv
+
+    first_runs, other_runs, by_tv = asyncio.run(main())
+    assert first_runs == 2
+    assert other_runs == 1
+    assert set(by_tv) == {"10.0.0.1", "10.0.0.2"}
+
+def test_failed_runs_and_expired_entries_are_not_reused(api):
+    api.QUERY_CACHE_TTL["hdmi_status"] = 0.05
+
+    async def main():
+        cache = api.QueryCache(16)
+        failing, failing_calls = counting(error=RuntimeError("adb"))
+        for _ in range(2):
+            try:
+                await cache.get("online", "10.0.0.1", failing)
+            except RuntimeError:
+                pass
+        compute, calls = counting()
+        await cache.get("hdmi_status", "10.0.0.1", compute)
+        await asyncio.sleep(0.1)
+        await cache.get("hdmi_status", "10.0.0.1", compute)
+        return len(failing_calls), len(calls)
+
+    assert asyncio.run(main()) == (2, 2)
+
+def test_least_recently_used_entry_is_evicted(api):
+    async def main():
+        cache = api.QueryCache(2)
+        for tv_ip in ("10.0.0.1", "10.0.0.2"):
+            await cache.get("online", tv_ip, counting()[0])
+        await cache.get("online", "10.0.0.1", counting()[0])  # A hit makes it the most recent
+        await cache.get("online", "10.0.0.3", counting()[0])
+        return list(cache.entries)
+
+    assert asyncio.run(main()) == [("online", "10.0.0.1"), ("online", "10.0.0.3")]
+
+def test_write_command_invalidates_the_cached_hdmi_status(api, fake_fleet, fake_adb):
+    async def main():
+        async with fake_fleet(["10.0.0.1"]) as fake:
+            tv = fake.tvs["10.0.0.1:5555"]
+            tv.focus = fake_adb.HDMI_COMPONENTS["hdmi1"]
+
+            async def status():
+                result = await api.query_cache.get(
+                    "hdmi_status", "10.0.0.1", lambda: api.get_hdmi_status_internal("10.0.0.1"))
+                return result["hdmi_status"]
+
+            before = await status()
+            tv.focus = fake_adb.HDMI_COMPONENTS["hdmi2"]  # Changed behind the server's back: still cached
+            cached = await status()
+            await api.execute_shell_command("10.0.0.1", "dumpsys window windows | grep -m 1 mCurrentFocus")
+            after_read = await status()                # A read-only command keeps the entry
+            await api.execute_shell_command("10.0.0.1", "input keyevent 19")
+            after_write = await status()               # A key press drops it
+            return before, cached, after_read, after_write
+
+    assert asyncio.run(main()) == ("hdmi1", "hdmi1", "hdmi1", "hdmi2")
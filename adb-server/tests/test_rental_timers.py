@@ -0,0 +1,97 @@
+"""The durable rental timeout scheduler: journalling, restart recovery and late firing."""
+
+import asyncio
+import sqlite3
+import time
+
+async def next_event(subscription, event_type: str, timeout: float = 10):
+    """Waits for the first event of a type on an event broker subscription."""
+    async def wait():
+        while True:
+            for _, received_type, data in await subscription.next_events():
+                if received_type == event_type:
+                    return data
+    return await asyncio.wait_for(wait(), timeout)
+
+def journal_rows(db_path: str):
+    with sqlite3.connect(db_path) as db:
+        return db.execute("SELECT rental_id, tv_ip, deadline FROM rental_timers ORDER BY rental_id").fetchall()
+
+def test_timeout_that_passed_while_down_fires_late_after_restart(api, fake_fleet, fake_adb, tmp_path):
+    db_path = str(tmp_path / "timers.db")
+
+    async def main():
+        async with fake_fleet(["10.0.0.1"]) as fake:
+            before = api.RentalTimerScheduler(db_path)
+            before.open()
+            deadline = before.schedule(7, "10.0.0.1", 0.2)
+            await before.stop()  # The server goes down before the deadline
+            await asyncio.sleep(0.5)
+
+            api.rental_timers = after = api.RentalTimerScheduler(db_path)
+            after.open()
+            restored = dict(after.get(7))
+            subscription = api.event_broker.subscribe("rental:7")
+            after.start()
+            event = await next_event(subscription, "timeout_triggered")
+            await after.stop()
+            return deadline, restored, event, fake.tvs["10.0.0.1:5555"].focus
+
+    deadline, restored, event, focus = asyncio.run(main())
+    assert restored["tv_ip"] == "10.0.0.1"
+    assert restored["deadline"] == deadline
+    assert event["success"] is True
+    assert event["scheduled_at"] == deadline
+    assert event["fire_drift_ms"] >= 250  # Due 0.2s after scheduling, down for 0.5s
+    assert focus == fake_adb.VLC_PLAYER
+    assert journal_rows(db_path) == []  # Handled, so it does not fire again on the next start
+
+def test_cancel_and_extend_survive_a_restart(api, tmp_path):
+    db_path = str(tmp_path / "timers.db")
+
+    async def main():
+        before = api.RentalTimerScheduler(db_path)
+        before.open()
+        before.schedule(1, "10.0.0.1", 600)
+        first = before.schedule(2, "10.0.0.2", 600)
+        extended = before.extend(2, 300)
+        assert before.cancel(1) is True
+        assert before.extend(3, 60) is None  # Not pending
+        await before.stop()
+
+        after = api.RentalTimerScheduler(db_path)
+        after.open()
+        entries = {rental_id: dict(entry) for rental_id, entry in after.entries().items()}
+        await after.stop()
+        return first, extended, entries
+
+    first, extended, entries = asyncio.run(main())
+    assert extended == first + 300
+    assert list(entries) == [2]
+    assert entries[2]["deadline"] == extended
+    assert entries[2]["tv_ip"] == "10.0.0.2"
+
+def test_timeout_claimed_by_another_worker_is_not_fired_again(api, tmp_path):
+    db_path = str(tmp_path / "timers.db")
+
+    async def main():
+        scheduler = api.RentalTimerScheduler(db_path)
+        scheduler.open()
+        deadline = scheduler.schedule(5, "10.0.0.1", -1)
+        # Another worker claimed it a moment ago and is playing the video
+        with sqlite3.connect(db_path) as db:
+            db.execute("UPDATE rental_timers SET claimed_until = ?", (time.time() + 60,))
+        fired = []
+
+        async def fire(rental_id, tv_ip, deadline):
+            fired.append(rental_id)
+
+        api.fire_rental_timeout = fire
+        scheduler.start()
+        await asyncio.sleep(0.3)
+        await scheduler.stop()
+        return deadline, fired
+
+    deadline, fired = asyncio.run(main())
+    assert fired == []
+    assert journal_rows(db_path) == [(5, "10.0.0.1", deadline)]
@@ -0,0 +1,96 @@
+"""Loading tv-profiles.json: inheritance, validation and duplicate detection."""
+
+import asyncio
+import json
+
+import pytest
+
+BASE = {
+    "model": "tcl",
+    "video_path": "/sdcard/Movies/hot.mp4",
+    "hdmi_switch_commands": ["input keyevent 178", "sleep 2", "input keyevent 22", "sleep 1", "input keyevent 23"],
+    "hdmi_switch_sequences": {"hdmi1": ["input keyevent 178", "sleep 2", "input keyevent 21", "sleep 1", "input keyevent 23"]},
+    "hdmi_status_map": {"com.tcl.tvinput/tcl.hdmi.HDMIInputService/HW15": "hdmi1"},
+    "play_video_commands": ["am start -a android.intent.action.VIEW -d \"file://{video_path}\" -t \"video/*\""],
+}
+
+def profile_file(profiles, tvs, **extra):
+    return {"profiles": profiles, "tvs": tvs, "default_profile": "base", **extra}
+
+def test_shipped_profile_file_loads(api):
+    registry = api.load_tv_registry(api.TV_PROFILES_FILE)
+    assert registry.default.name == "DEFAULT_TCL"
+    assert registry.tvs and all(profile.hdmi_switch_plan.steps for profile in registry.tvs.values())
+
+def test_extends_inherits_and_replaces_whole_keys(api):
+    data = profile_file(
+        {
+            "base": BASE,
+            "special": {"extends": "base", "model": "tcl-special", "hdmi_status_map": {}},
+            "special-right": {"extends": "special", "hdmi_switch_commands": ["input keyevent 178", "sleep 2", "input keyevent 23"]},
+        },
+        {"10.0.0.1": "special-right", "10.0.0.2": {"extends": "base", "video_path": "/sdcard/other.mp4"}},
+    )
+
+    registry = api.build_tv_registry(data, "test")
+    child = registry.tvs["10.0.0.1"]
+    assert child.name == "special-right"
+    assert child.model == "tcl-special"            # From its parent
+    assert dict(child.hdmi_status_map) == {}       # Replaced as a whole, not merged with the base map
+    assert child.hdmi_switch_plan.commands == ("input keyevent 178", "sleep 2", "input keyevent 23")
+    assert set(child.hdmi_switch_sequences) == {"hdmi1"}  # From the grandparent
+
+    own = registry.tvs["10.0.0.2"]                 # A TV with its own overrides is a profile named after it
+    assert own.name == "10.0.0.2"
+    assert own.video_path == "/sdcard/other.mp4"
+    assert own.play_video_commands == ('am start -a android.intent.action.VIEW -d "file:///sdcard/other.mp4" -t "video/*"',)
+
+def test_profiles_are_read_only(api):
+    registry = api.build_tv_registry(profile_file({"base": BASE}, {"10.0.0.1": "base"}), "test")
+    with pytest.raises(TypeError):
+        registry.tvs["10.0.0.1"].hdmi_status_map["x"] = "hdmi9"
+
+@pytest.mark.parametrize("profiles, tvs, message", [
+    ({"base": BASE, "a": {"extends": "b"}, "b": {"extends": "a"}}, {}, "circular extends: a -> b -> a"),
+    ({"base": {**BASE, "extends": "base"}}, {}, "circular extends: base -> base"),
+    ({"base": BASE, "child": {"extends": "missing"}}, {}, "unknown profile 'missing'"),
+    ({"base": BASE}, {"10.0.0.1": "missing"}, "10.0.0.1: unknown profile 'missing'"),
+    ({"base": BASE}, {"10.0.0.1": {"extends": "missing"}}, "unknown profile 'missing'"),
+    ({"base": BASE}, {"tv-one": "base"}, "'tv-one' is not an IP address"),
+    ({"base": {key: value for key, value in BASE.items() if key != "video_path"}}, {}, "base: missing video_path"),
+    ({"base": {**BASE, "colour": "red"}}, {}, "base: unknown keys colour"),
+    ({"base": {**BASE, "hdmi_switch_commands": ["sleep later"]}}, {}, "base hdmi_switch_commands: step 0"),
+    ({"base": {**BASE, "play_video_commands": ["am start {video}"]}}, {}, "base play_video_commands\\[0\\]"),
+])
+def test_invalid_profiles_are_rejected(api, profiles, tvs, message):
+    with pytest.raises(ValueError, match=message):
+        api.build_tv_registry(profile_file(profiles, tvs), "test")
+
+def test_every_problem_is_reported_at_once(api):
+    data = profile_file({"base": BASE, "a": {"extends": "nowhere"}}, {"10.0.0.1": "missing", "not-an-ip": "base"})
+    with pytest.raises(ValueError) as error:
+        api.build_tv_registry(data, "test")
+    assert str(error.value).count("\n") == 3  # One line per problem
+
+def test_unknown_default_profile_is_rejected(api):
+    with pytest.raises(ValueError, match="default_profile: unknown profile 'nope'"):
+        api.build_tv_registry(profile_file({"base": BASE}, {}, default_profile="nope"), "test")
+
+def test_duplicate_keys_are_rejected(api, tmp_path):
+    path = tmp_path / "tv-profiles.json"
+    body = json.dumps(profile_file({"base": BASE}, {}))
+    path.write_text(body.replace('"tvs": {}', '"tvs": {"10.0.0.1": "base", "10.0.0.1": "base"}'), encoding="utf-8")
+
+    with pytest.raises(ValueError, match="listed more than once: 10.0.0.1"):
+        api.read_tv_profiles(str(path))
+
+def test_failed_reload_keeps_the_current_profiles(api, tmp_path):
+    path = tmp_path / "tv-profiles.json"
+    path.write_text(json.dumps(profile_file({"base": BASE}, {"10.0.0.1": "base"})), encoding="utf-8")
+    api.install_tv_registry(api.load_tv_registry(str(path)))
+    path.write_text(json.dumps(profile_file({"base": BASE}, {"10.0.0.1": "missing"})), encoding="utf-8")
+
+    result = asyncio.run(api.reload_tv_profiles())
+    assert result["success"] is False
+    assert api.get_tv_config("10.0.0.1").name == "base"
+    assert api.ALL_TV_IPS == ["10.0.0.1"]
@@ -0,0 +1,43 @@
+"""The adb wire-protocol transport against the fake adb server."""
+
+import asyncio
+
+def test_shell_command_returns_output_and_exit_status(api, fake_fleet):
+    async def main():
+        async with fake_fleet(["10.0.0.1"]):
+            ok = await api.execute_shell_command("10.0.0.1", "echo hello")
+            missing = await api.execute_shell_command("10.0.0.1", "no-such-command")
+            return ok, missing
+
+    ok, missing = asyncio.run(main())
+    assert ok == {"success": True, "output": "hello"}
+    assert missing["success"] is False
+    assert "not found" in missing["error"]
+
+def test_shell_until_stops_at_the_focus_line(api, fake_fleet, fake_adb):
+    async def main():
+        async with fake_fleet(["10.0.0.1"], simulation=fake_adb.SimulationProfile(dumpsys_kb=64)) as fake:
+            fake.tvs["10.0.0.1:5555"].focus = fake_adb.VLC_PLAYER
+            return await api.read_focused_component("10.0.0.1")
+
+    assert asyncio.run(main()) == {"success": True, "focused_app": fake_adb.VLC_PLAYER}
+
+def test_host_devices_lists_the_connected_tvs(api, fake_fleet):
+    async def main():
+        async with fake_fleet(["10.0.0.1", "10.0.0.2"]):
+            return await api.execute_host_command("devices")
+
+    result = asyncio.run(main())
+    assert result["success"] is True
+    assert "10.0.0.1:5555\tdevice" in result["output"]
+    assert "10.0.0.2:5555\tdevice" in result["output"]
+
+def test_disconnected_tv_reports_an_error(api, fake_fleet):
+    async def main():
+        async with fake_fleet(["10.0.0.1"]) as fake:
+            fake.tvs["10.0.0.1:5555"].connected = False
+            return await api.execute_shell_command("10.0.0.1", "echo hello")
+
+    result = asyncio.run(main())
+    assert result["success"] is False
+    assert result["error"]
@@ -56,14 +56,16 @@ protected function sendRequest(string $method, string $endpoint, array $data = [
 
     // --- Core Rental Flow Methods ---
 
-    public function switchToHdmi(string $tvIp): array
+    // With $async = true these return right away with a 'job_id'; poll it with getJob().
+
+    public function switchToHdmi(string $tvIp, bool $async = false): array
     {
-        return $this->sendRequest('post', '/switch-to-hdmi2', ['tv_ip' => $tvIp]);
+        return $this->sendRequest('post', $this->withAsync('/switch-to-hdmi2', $async), ['tv_ip' => $tvIp]);
     }
 
-    public function playTimeoutVideo(string $tvIp, int $rentalId): array
+    public function playTimeoutVideo(string $tvIp, int $rentalId, bool $async = false): array
     {
-        return $this->sendRequest('post', '/play-timeout-video', [
+        return $this->sendRequest('post', $this->withAsync('/play-timeout-video', $async), [
             'tv_ip' => $tvIp,
             'rental_id' => $rentalId
         ]);
@@ -112,9 +114,9 @@ public function getConfiguredTvs(): array
     /**
      * Efficiently tests all TVs at once.
      */
-    public function testAllConnections(): array
+    public function testAllConnections(bool $async = false): array
     {
-        return $this->sendRequest('post', '/test-all-connections');
+        return $this->sendRequest('post', $this->withAsync('/test-all-connections', $async));
     }
 
     public function getConnectedDevices(): array
@@ -158,9 +160,9 @@ public function debugAdbPath(): array
     {
         return $this->sendRequest('get', '/test-adb');
     }
-    public function switchHdmiInput(string $tvIp, string $hdmiInput): array
+    public function switchHdmiInput(string $tvIp, string $hdmiInput, bool $async = false): array
     {
-        return $this->sendRequest('post', '/set-hdmi-input', [
+        return $this->sendRequest('post', $this->withAsync('/set-hdmi-input', $async), [
             'tv_ip' => $tvIp,
             'target_input' => $hdmiInput,
         ]);
@@ -171,4 +173,103 @@ public function getHdmiStatus(string $tvIp): array
     {
         return $this->sendRequest('post', '/get-hdmi-status', ['tv_ip' => $tvIp]);
     }
+
+    // --- Background Job Methods ---
+
+    /**
+     * Status of a job started with $async = true: 'status' is queued, running, succeeded or failed,
+     * and 'result' holds the endpoint's normal response once it has finished.
+     */
+    public function getJob(string $jobId): array
+    {
+        return $this->sendRequest('get', "/jobs/{$jobId}");
+    }
+
+    protected function withAsync(string $endpoint, bool $async): string
+    {
+        return $async ? $endpoint . '?async=true' : $endpoint;
+    }
+
+    // --- Timeout Video Sync Methods ---
+
+    /**
+     * Pushes the master timeout video to every TV (or just $tvIps) whose copy is missing or differs.
+     * Always runs in the background: returns a 'job_id' for getJob(); progress is on /timeout-video/events.
+     */
+    public function syncTimeoutVideo(array $tvIps = [], bool $force = false): array
+    {
+        return $this->sendRequest('post', '/sync-timeout-video', [
+            'tv_ips' => $tvIps ?: null,
+            'force' => $force,
+        ]);
+    }
+
+    // Per TV, the state of its timeout video at the last check ('current', 'stale', 'missing', ...)
+    public function getTimeoutVideoStatus(): array
+    {
+        return $this->sendRequest('get', '/timeout-video');
+    }
+
+    // --- Screen Capture Methods ---
+
+    /**
+     * The thumbnail wall: per TV its 'thumbnail_url', 'captured_at', 'age' and whether it is 'stale'.
+     * Stale thumbnails are refreshed in the background, so calling this again shortly gives newer ones.
+     */
+    public function getThumbnailWall(): array
+    {
+        return $this->sendRequest('get', '/screenshots');
+    }
+
+    /**
+     * Browser-facing URL of a TV's screen capture (full-resolution PNG, or the cached thumbnail),
+     * for use in an <img> tag; the image is not fetched through Laravel.
+     */
+    public function screenshotUrl(string $tvIp, bool $thumbnail = false): string
+    {
+        return $this->baseUrl . "/screenshot/{$tvIp}" . ($thumbnail ? '/thumbnail' : '');
+    }
+
+    /**
+     * Browser-facing WebSocket URL of a TV's remote control. Send {"key": "down", "id": 1}
+     * (a name like up/ok/back/home/input, a keycode, or a KEYCODE_ name); every press is
+     * answered with {"type": "ack", "id": 1, "success": true, "latency_ms": ...}.
+     */
+    public function remoteControlUrl(string $tvIp): string
+    {
+        return preg_replace('#^http#', 'ws', $this->baseUrl) . "/ws/remote/{$tvIp}";
+    }
+
+    // --- Batch (Fleet-wide) Methods ---
+    // Each call handles many TVs in a single request and returns per-TV results under 'results'.
+
+    public function batchSwitchHdmiInput(array $tvIps, string $hdmiInput): array
+    {
+        return $this->sendRequest('post', '/batch/set-hdmi-input', [
+            'items' => array_map(fn ($tvIp) => ['tv_ip' => $tvIp, 'target_input' => $hdmiInput], $tvIps),
+        ]);
+    }
+
+    public function batchSendControl(array $tvIps, string $action): array
+    {
+        return $this->sendRequest('post', '/batch/tv-control', [
+            'items' => array_map(fn ($tvIp) => ['tv_ip' => $tvIp, 'action' => $action], $tvIps),
+        ]);
+    }
+
+    /**
+     * @param array $rentals List of ['tv_ip' => ..., 'rental_id' => ..., 'timeout_seconds' => ...]
+     */
+    public function batchStartRentalMonitors(array $rentals): array
+    {
+        return $this->sendRequest('post', '/batch/start-rental-monitor', ['items' => $rentals]);
+    }
+
+    /**
+     * @param array $rentals List of ['tv_ip' => ..., 'rental_id' => ...]
+     */
+    public function batchPlayTimeoutVideo(array $rentals): array
+    {
+        return $this->sendRequest('post', '/batch/play-timeout-video', ['items' => $rentals]);
+    }
 }